@@ -0,0 +1,429 @@
+"""
+The Duck Machine assembler as one in-process pipeline.
+
+assembler_pass1.py and assembler_pass2.py talk through text:
+pass 1 parses each line twice (build_table, then
+transform_lines) and writes resolved lines, which pass 2 parses
+again.  Here each line is scanned once into a Record (see lexer.py),
+labels are resolved on the records, and the records are encoded
+straight to words:
+
+    from assembler import assemble_source
+    words = assemble_source(lines)     # ready for load_program
+
+Assembly(lines).dasm() gives the resolved text pass 1 would
+write, for looking at.  The optional passes (peephole.py,
+promote.py) rewrite source, so they run before parsing.
+
+    python3 assembler.py programs/fact.asm fact.obj --dasm fact.dasm
+
+For sources too big to hold, --stream (StreamAssembler) reads and
+writes as it goes, in memory proportional to the labels; a label
+out of reach of a displacement is then an error:
+
+    generate | python3 assembler.py --stream | gzip > big.obj.gz
+
+--jobs N assembles a large source file on N processors (see
+parallel.py), with the same output.
+"""
+
+from assembler_pass1 import parse_line, resolve_line, relax_parsed, SyntaxError
+from assembler_pass1 import ERROR_LIMIT, MIN_OFFSET, MAX_OFFSET, RESERVED, AsmSrcKind
+from lexer import Record, lex, lex_lines
+from instr_format import Instruction, OpCode, CondFlag, offset_field
+
+from typing import Dict, Iterable, List, Optional, Sequence, TextIO
+
+import argparse
+import struct
+import sys
+import tempfile
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PC = 15
+HOLE_WINDOW = 32    # Lines the stream holds back, looking for room for the hole
+FAR_HINT = " (to reach it, assemble without --stream)"
+
+# Spool entries: a finished word, an instruction still needing the
+# offset of a symbol, or a word too big for 8 bytes, as text
+_WORD, _REF, _TEXT = 0, 1, 2
+_SPOOL_WORD = struct.Struct("<Bq")
+_SYMBOL = struct.Struct("<I")
+_SPOOL_REF = struct.Struct("<BqI")
+
+
+class AssemblyError(SyntaxError):
+    """The errors found in a program, one message each"""
+
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+class Assembly(object):
+    """A program assembled from source lines: its records, the
+    address of each label, and its words.  inserted lists the
+    records relaxation added.
+    """
+
+    def __init__(self, lines: Sequence[str], optimize: bool = False,
+                 promote: bool = False, reserved: tuple = RESERVED) -> None:
+        # Not imported at the top: the optimizers build on the passes
+        if optimize:
+            import peephole
+            lines, report = peephole.optimize(lines)
+        if promote:
+            import promote as promotion
+            lines, report = promotion.promote(lines)
+        self.errors = []
+        lines = [line.rstrip("\n") for line in lines]
+        try:
+            records = lex_lines(lines)
+        except SyntaxError:
+            # Find all the bad lines
+            for lnum, line in enumerate(lines):
+                self._attempt(lnum, lex, line)
+            self._check()
+        try:
+            relaxed = relax_parsed(lines, records, reserved)
+        except SyntaxError as e:
+            raise AssemblyError([str(e)])
+        # Relaxation adds lines of its own
+        self.records = [record or lex(line) for line, record in relaxed]
+        self.inserted = [k for k, (line, record) in enumerate(relaxed) if record is None]
+        self.labels = self._labels()
+        self._check()
+        self.words = self._encode()
+        self._check()
+
+    def _attempt(self, where, function, *args):
+        try:
+            return function(*args)
+        except SyntaxError as e:
+            self.errors.append("Syntax error in line {}: {}".format(where, e))
+        except KeyError as e:
+            self.errors.append("Unknown word in line {}: {}".format(where, e))
+        if len(self.errors) > ERROR_LIMIT:
+            self._check()
+
+    def _check(self) -> None:
+        if self.errors:
+            raise AssemblyError(self.errors)
+
+    def _labels(self) -> Dict[str, int]:
+        labels = {}
+        addr = 0
+        for record in self.records:
+            if record.label:
+                if record.label in labels:
+                    self.errors.append("Duplicate label {}".format(record.label))
+                labels[record.label] = addr
+            if record.word:
+                addr += 1
+        return labels
+
+    def _encode(self) -> List[int]:
+        words = []
+        for record in self.records:
+            if not record.word:
+                continue
+            offset = 0
+            symbol = record.symbol
+            if symbol is not None:
+                if symbol not in self.labels:
+                    self.errors.append("Unknown label in line {}: {}".format(record.line, symbol))
+                    words.append(0)
+                    continue
+                offset = self.labels[symbol] - len(words)
+                if not MIN_OFFSET <= offset <= MAX_OFFSET:
+                    self.errors.append("Label {} is {} words away from line {}".format(
+                        symbol, offset, record.line))
+                    words.append(0)
+                    continue
+            word = self._attempt(record.line, record.encode, offset)
+            words.append(0 if word is None else word)
+        return words
+
+    def dasm(self) -> List[str]:
+        """The resolved text, as assembler_pass1.py writes it"""
+        out = []
+        addr = 0
+        for record in self.records:
+            if record.symbol is not None:
+                out.append(resolve_line(parse_line(record.line), self.labels, addr))
+            else:
+                out.append(record.line)
+            if record.word:
+                addr += 1
+        return out
+
+
+class StreamAssembler(object):
+    """Assembles a source of any length in memory proportional to
+    its labels rather than its lines.  The first pass reads lines
+    one at a time, keeping only the label table and, for each
+    label referred to before it is defined, the address of the
+    first such reference.  Every word is spooled to a temporary
+    file, finished where it can be, or as an instruction and the
+    symbol whose offset it still needs.  The second pass reads the
+    spool back and writes the words.
+
+    Far references cannot be relaxed without seeing the whole
+    program, so a label out of reach is an error.  Like
+    relaxation, the first pass leaves a hole for the devices, at
+    the last place before them where words may be inserted; it
+    holds back the few lines before the hole until it finds one.
+    """
+
+    def __init__(self, reserved: tuple = RESERVED) -> None:
+        self.reserved = reserved
+        self.labels = {}
+        self.symbols = {}        # Symbol -> number, in the spool
+        self.pending = {}        # Symbol -> address of its first forward reference
+        self.errors = []
+        self.addr = 0
+        self.flows = True        # Can control run into the next word?
+        self.window = []         # Records held back near the devices
+        self.hole = reserved is None
+        self.spool = tempfile.TemporaryFile()
+
+    def _attempt(self, where, function, *args):
+        try:
+            return function(*args)
+        except SyntaxError as e:
+            self.errors.append("Syntax error in line {}: {}".format(where, e))
+        except KeyError as e:
+            self.errors.append("Unknown word in line {}: {}".format(where, e))
+        if len(self.errors) > ERROR_LIMIT:
+            raise AssemblyError(self.errors)
+
+    def read(self, lines: Iterable[str]) -> None:
+        """The first pass"""
+        for lnum, line in enumerate(lines):
+            record = self._attempt(lnum, lex, line.rstrip("\n"))
+            if record is None:
+                continue
+            if self.hole:
+                self._place(record)
+                continue
+            self.window.append(record)
+            words = sum(1 for r in self.window if r.word)
+            if self.addr + words > self.reserved[0]:
+                self._place_hole()
+            elif self.addr + words < self.reserved[0] - HOLE_WINDOW:
+                self._flush()
+        self._flush()
+        for symbol in self.pending:
+            self.errors.append("Unknown label {}".format(symbol))
+        if self.errors:
+            raise AssemblyError(self.errors)
+
+    def _flush(self) -> None:
+        for record in self.window:
+            self._place(record)
+        self.window = []
+
+    def _place_hole(self) -> None:
+        low, high = self.reserved
+        site = hole_site(self.window, self.addr, self.flows, low)
+        if site is None:
+            raise AssemblyError(self.errors + ["Cannot lay out the program around "
+                                               "addresses {}..{}".format(low, high - 1)])
+        i, flows = site
+        window = self.window
+        self.window = window[:i]
+        self._flush()
+        if flows:
+            self._spool_word(Instruction(OpCode.ADD, CondFlag.ALWAYS, PC, 0, PC,
+                                         high - self.addr).encode())
+        while self.addr < high:
+            self._spool_word(0)
+        self.hole = True
+        for record in window[i:]:
+            self._place(record)
+
+    def _place(self, record: Record) -> None:
+        label = record.label
+        if label:
+            if label in self.labels:
+                self.errors.append("Duplicate label {}".format(label))
+            self.labels[label] = self.addr
+            first = self.pending.pop(label, None)
+            if first is not None and self.addr - first > MAX_OFFSET:
+                self.errors.append("Label {} is {} words away from address {}{}".format(
+                    label, self.addr - first, first, FAR_HINT))
+        if not record.word:
+            return
+        symbol = record.symbol
+        if symbol is None:
+            word = self._attempt(record.line, record.encode)
+            self._spool_word(word or 0)
+        elif symbol in self.labels:
+            offset = self.labels[symbol] - self.addr
+            if offset < MIN_OFFSET:
+                self.errors.append("Label {} is {} words away from line {}{}".format(
+                    symbol, -offset, record.line, FAR_HINT))
+            word = self._attempt(record.line, record.encode, offset)
+            self._spool_word(word or 0)
+        else:
+            word = self._attempt(record.line, record.encode, 0)
+            if symbol not in self.symbols:
+                self.symbols[symbol] = len(self.symbols)
+            self.pending.setdefault(symbol, self.addr)
+            self.spool.write(_SPOOL_REF.pack(_REF, word or 0, self.symbols[symbol]))
+            self.addr += 1
+        self.flows = _falls_through(record)
+
+    def _spool_word(self, word: int) -> None:
+        if 0 <= word < 1 << 63:
+            self.spool.write(_SPOOL_WORD.pack(_WORD, word))
+        else:
+            text = str(word).encode()
+            self.spool.write(_SPOOL_WORD.pack(_TEXT, len(text)) + text)
+        self.addr += 1
+
+    def write(self, out: TextIO) -> int:
+        """The second pass: write the words, one per line, and
+        return how many
+        """
+        names = {number: symbol for symbol, number in self.symbols.items()}
+        labels = {number: self.labels[symbol] for number, symbol in names.items()}
+        spool = self.spool
+        spool.seek(0)
+        addr = 0
+        while True:
+            head = spool.read(_SPOOL_WORD.size)
+            if not head:
+                break
+            tag, word = _SPOOL_WORD.unpack(head)
+            if tag == _REF:
+                number, = _SYMBOL.unpack(spool.read(_SYMBOL.size))
+                word = offset_field.insert(labels[number] - addr, word)
+            elif tag == _TEXT:
+                word = spool.read(word).decode()
+            print(word, file=out)
+            addr += 1
+        self.spool.close()
+        return addr
+
+
+def hole_site(records: Sequence[Record], addr: int, flows: bool,
+              low: int) -> Optional[tuple]:
+    """Where relaxation leaves the hole for the devices among
+    records, the first at address addr (flows: whether control
+    runs into it): (index, jump), jump if control runs into the
+    hole; None if there is no room.  As in _Relaxation._place_hole,
+    the hole goes before the last record below low that words may
+    be inserted before (see _Relaxation._safe_point), leaving room
+    for a jump either way, and before any labels naming that record.
+    """
+    best = None
+    for i, record in enumerate(records):
+        if addr + 1 > low:
+            break
+        if record.word and (not flows or (record.kind is not AsmSrcKind.DATA and
+                                          record["predicate"] in (None, "ALWAYS"))):
+            best = (i, flows)
+        if record.word:
+            addr += 1
+            flows = _falls_through(record)
+    if best is None:
+        return None
+    i, flows = best
+    while i > 0 and not records[i - 1].word:
+        i -= 1
+    return i, flows
+
+
+def _falls_through(record: Record) -> bool:
+    """As _Relaxation._falls_through"""
+    if record.kind is AsmSrcKind.DATA:
+        return False
+    always = record["predicate"] in (None, "ALWAYS")
+    if record.kind is AsmSrcKind.SYMBOLIC and record["opcode"] == "JUMP":
+        return not always
+    if record.kind is AsmSrcKind.FULL and record["opcode"] == "HALT":
+        return not always
+    return True
+
+
+def assemble_stream(lines: Iterable[str], out: TextIO, reserved: tuple = RESERVED) -> int:
+    """Assemble lines as they are read, writing object code to out.
+    Raises AssemblyError, before writing anything, if the program
+    has errors.  Returns the number of words written.
+    """
+    assembler = StreamAssembler(reserved)
+    assembler.read(lines)
+    return assembler.write(out)
+
+
+def assemble_source(lines: Sequence[str], optimize: bool = False,
+                    promote: bool = False) -> List[int]:
+    """Object code for a program, in memory.  Raises AssemblyError
+    listing what is wrong with it.
+    """
+    return Assembly(lines, optimize, promote).words
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine Assembler")
+    parser.add_argument("sourcefile", type=argparse.FileType('r'),
+                        nargs="?", default=sys.stdin,
+                        help="Duck Machine assembly code file")
+    parser.add_argument("objfile", type=argparse.FileType('w'),
+                        nargs="?", default=sys.stdout,
+                        help="Object file output")
+    parser.add_argument("--dasm", type=argparse.FileType('w'),
+                        help="Also write the resolved source (.dasm) here")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Apply peephole optimizations (see peephole.py)")
+    parser.add_argument("--promote", action="store_true",
+                        help="Keep variables in registers (see promote.py)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Assemble as the source is read, for very large sources")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Assemble a large source file on this many processors")
+    args = parser.parse_args()
+    if args.stream and (args.dasm or args.optimize or args.promote):
+        parser.error("--stream cannot be combined with --dasm, -O or --promote")
+    if args.jobs and (args.stream or args.dasm or args.optimize or args.promote):
+        parser.error("--jobs cannot be combined with --stream, --dasm, -O or --promote")
+    if args.jobs and args.sourcefile is sys.stdin:
+        parser.error("--jobs needs a source file")
+    return args
+
+
+def main():
+    """"Assemble a Duck Machine program"""
+    args = cli()
+    if args.stream or args.jobs:
+        try:
+            if args.stream:
+                assemble_stream(args.sourcefile, args.objfile)
+            else:
+                # Not imported at the top: it builds on this module
+                import parallel
+                parallel.assemble_parallel(args.sourcefile.name, args.objfile, args.jobs)
+        except SyntaxError as e:
+            print(e)
+            sys.exit(1)
+        return
+    try:
+        assembly = Assembly(args.sourcefile.readlines(), args.optimize, args.promote)
+    except SyntaxError as e:
+        print(e)
+        sys.exit(1)
+    if args.dasm:
+        for line in assembly.dasm():
+            print(line, file=args.dasm)
+    for word in assembly.words:
+        print(word, file=args.objfile)
+
+
+if __name__ == "__main__":
+    main()
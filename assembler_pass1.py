@@ -1,20 +1,22 @@
 """
 by Kristine Stecker
 
-Assembler for DM2018W assembly language.
+Assembler for DM2018W assembly language (pass 1).
 
-This assembler is for fully resolved instructions,
-which may be the output of assm_xform.py, which
-transforms instructions with symbolic addresses into
-instructions with fully resolved (PC-relative) addresses.
+This pass resolves symbolic instructions, e.g.
+   LOAD r1,x
+   JUMP/Z endloop
+into fully resolved instructions addressed relative to
+the program counter (r15), which assembler_pass2.py
+encodes.  Lines that are already fully resolved, DATA,
+and comments are passed through unchanged.
 
 Assembly instruction format with all options is
 
 label: instruction
 
-Labels are resolved (translated into addresses) in
-assm_xform.py; in this pass of the interpreter they
-are only for documentation.
+Labels are resolved (translated into addresses) in this
+pass; in the output they are only for documentation.
 
 Both parts are optional:  A label may appear without
 an instruction, and an instruction may appear without
@@ -52,15 +54,17 @@ a DM2018S instruction.
 
 """
 from instr_format import Instruction, instruction_from_dict
+from assembler_pass2 import value_parse
 import memory
 import argparse
 
-from typing import Union, List
+from typing import Union, List, Optional, Tuple
 from enum import Enum, auto
 
 import sys
 import io
 import re
+import bisect
 import logging
 
 logging.basicConfig()
@@ -229,7 +233,6 @@ def parse_line(line: str) -> dict:
         if match:
             fields = match.groupdict()
             fields["kind"] = kind
-            print(fields)
             log.debug("Extracted fields {}".format(fields))
             return fields
     raise SyntaxError("Assembler syntax error in {}".format(line))
@@ -240,100 +243,51 @@ def fill_defaults(fields: dict) -> None:
         if fields[key] == None:
             fields[key] = value
 
-# PSEUDOCODE
-# Build a table (dictionary) associating labels and addresses ///
-# (FIRST PASS)
-# examine each line
-# if it has a label, put the label and its address in the dictionary
-# if it is NOT a comment-type line (regex ...)
-#           advance the address counter
-
-
-# use table
-# (SECOND PASS)
-# examine each line
-# if it IS a SYMBOLIC line (regex ...)
-#           transform it into a resolved line
-#           (WRITE A FUNCTION FOR THIS)
-
-
-#DESIGN NOTES
-
-# FIRST PASS:
-# Build a table (dictionary!)
-#   (label: addr) pairs
-
-# SECOND PASS:
-# go through the lines
-# find ones that match symbolic instruction (regex)
-# resolve them to complete (FULL) asm instructions
-
-
-
-def build_table(lines: List[str]):
-    '''
-    First Pass
-    Build table - dictionary which maps labels to addresses
-    Go through each line
-    If line has a label, put label and its corresponding address
-    in the dictionary
-    If it is not a comment-type line (use regex to figure this out)
-    then increment our address
-
-    # go through the lines
-    # keep track of the address as we go
-            # keep address counter
-            # increment only if the line is NOT a comment
-    # how do I tell if my line is not a comment?
-    # REGEX!!!
-    #apply parse_line, figure out what kind it was
-    '''
-    curr_addr = 0
-    sym_table = { }
+# The displacement field is 10 bits, signed
+MIN_OFFSET = -512
+MAX_OFFSET = 511
+
 
+def build_table(lines: List[str]) -> dict:
+    """First pass: map each label to the address of the word
+    it names.  A label on a line by itself names the next
+    instruction or DATA word.
+    """
+    curr_addr = 0
+    sym_table = {}
     for lnum in range(len(lines)):
-        line = lines[lnum]
-        fields = parse_line(line)
-        #print("Fields at address", curr_addr, "is:", fields)
+        fields = parse_line(lines[lnum])
+        label = fields["label"]
+        if label:
+            if label in sym_table:
+                raise SyntaxError("Duplicate label {} in line {}".format(label, lnum))
+            sym_table[label] = curr_addr
         if fields["kind"] != AsmSrcKind.COMMENT:
-            curr_addr += curr_addr
-            print("Recognized a comment!")
-        if fields["kind"] == AsmSrcKind.SYMBOLIC:
-            sym_table['label'] = fields["symbol"]
-            sym_table['position'] = curr_addr
+            curr_addr += 1
     return sym_table
 
 
-def transform_lines(lines: List[str], sym_table: dict) -> None:
-    '''
-    # wrapper function that drives second pass
-
-    # second pass, iterateing over all the lines again
-    in order to calculate the "pc-relative-address" for resolving
-    - need to know:
-    where we are in our program
-    (i.e. another address counter will show up here)
-    '''
+def transform_lines(lines: List[str], sym_table: dict) -> List[str]:
+    """Second pass: rewrite symbolic instructions as fully
+    resolved (PC-relative) instructions; other lines are
+    passed through.
+    """
     error_count = 0
     curr_addr = 0
-
+    resolved = []
     for lnum in range(len(lines)):
-        line = lines[lnum]
+        line = lines[lnum].rstrip("\n")
         try:
             fields = parse_line(line)
-            #this is a handy one to print
-            print(fields)
-            if fields["kind"] != AsmSrcKind.COMMENT:
-                curr_addr += curr_addr
-            if fields["kind"] == AsmSrcKind.FULL or AsmSrcKind.SYMBOLIC:
-                new_line = resolve_line(fields, sym_table, curr_addr)
-                # need to write new line to file, but how???
-                print(new_line,file=args.objfile)
+            if fields["kind"] == AsmSrcKind.SYMBOLIC:
+                resolved.append(resolve_line(fields, sym_table, curr_addr))
             else:
-                log.debug("Problem trying to build table")
+                resolved.append(line)
+            if fields["kind"] != AsmSrcKind.COMMENT:
+                curr_addr += 1
         except SyntaxError as e:
             error_count += 1
-            print("Syntax error in line {}: {}".format(lnum, line))
+            print("Syntax error in line {}: {}".format(lnum, e))
         except KeyError as e:
             error_count += 1
             print("Unknown label in line {}: {}".format(lnum, e))
@@ -341,48 +295,537 @@ def transform_lines(lines: List[str], sym_table: dict) -> None:
             error_count += 1
             print("Exception encountered in line {}: {}".format(lnum, e))
         if error_count > ERROR_LIMIT:
-            print("Too many errors; abandoning")
-            sys.exit(1)
-
-    return None
-
-def resolve_line(fields: dict, curr_addr: int, sym_table: dict) -> str:
-    #FIXME
-    # used by transform_lines function
-    # fiddly string format stuff happens
-    new_line = ''
-    if fields["symbol"] in sym_table:
-        fields["offset"] = curr_addr + sym_table['position']
-        # do I need an opcode in here somewhere?
-        # what is opcode again? lol
-        if fields["opcode"] == 'LOAD' or 'STORE':
-            new_line = "{}/{} {},{},r15[{}] " \
-                       "# Access variable '{}'".format(
-                        fields["opcode"], fields["predicate"],
-                        fields["target"], fields["src1"],
-                        fields["offset"], fields["comment"],
-                        sym_table['label'])
-        elif fields["opcode"] == 'JUMP':
-            fields["opcode"] = 'ADD'
-            new_line = "{} {},{},{}[{}] " \
-                       "# Jump to {}".format(
-                        fields["opcode"], fields["target"],
-                        fields["src1"], fields["src2"],
-                        fields["offset"], fields["comment"],
-                        sym_table['label'])
-
-    return new_line
+            raise SyntaxError("Too many errors; abandoning")
+    return resolved
+
+
+def resolve_line(fields: dict, sym_table: dict, curr_addr: int) -> str:
+    """A symbolic LOAD, STORE or JUMP as a resolved instruction,
+    addressed relative to r15, which holds the address of the
+    instruction being executed.
+    """
+    symbol = fields["symbol"]
+    offset = sym_table[symbol] - curr_addr
+    if not MIN_OFFSET <= offset <= MAX_OFFSET:
+        raise SyntaxError("Label {} is {} words away; the limit is {}..{}".format(
+            symbol, offset, MIN_OFFSET, MAX_OFFSET))
+    label = "{}: ".format(fields["label"]) if fields["label"] else "   "
+    predicate = "/{}".format(fields["predicate"]) if fields["predicate"] else ""
+    if fields["opcode"] == "JUMP":
+        return "{}ADD{} r15,r0,r15[{}] # Jump to {}".format(
+            label, predicate, offset, symbol)
+    if fields["target"] is None:
+        raise SyntaxError("{} needs a register".format(fields["opcode"]))
+    return "{}{}{} {},r0,r15[{}] # Access variable '{}'".format(
+        label, fields["opcode"], predicate, fields["target"], offset, symbol)
+
+
+###
+# Branch relaxation and literal pools.
+#
+# A symbolic reference is resolved relative to r15 if its label
+# is within reach of the displacement, or else to an absolute
+# address from r0 if the label is at an address below 512.
+# Other references are "far", and go through a literal pool: a
+# few words the program never executes, holding the address of
+# the label (or, for a DATA word that is never stored to, its
+# value):
+#
+#   JUMP x     ->  LOAD r15,pool         (the pool holds x)
+#   LOAD r1,x  ->  LOAD r1,pool ; LOAD r1,r1,r0[0]
+#                  or LOAD r1,pool       (the pool holds x's value)
+#   STORE r1,x ->  STORE r14,save ; LOAD r14,pool ;
+#                  STORE r1,r14,r0[0] ; LOAD r14,save
+#
+# Pools go after unconditional jumps and HALTs, at the end of the
+# program, or, if no such place is in reach, in an island that
+# the program jumps around.  Every reference starts short; a
+# layout pass makes any reference that cannot reach its label
+# far, and moves pools that have drifted out of reach, until
+# nothing changes.  Encodings only ever grow, so this converges.
+#
+# The devices are at RESERVED; a program that would reach them
+# is laid out around them, with a jump over the hole if control
+# could run into it.  The hole is filled with zeros, which a
+# loader must not write to the devices (see
+# MemoryMappedIO.load_program).
+###
+
+RESERVED = (480, 512)
+POOL_REACH = 480    # Choose pools this near, leaving slack for growth
+RELAX_ROUNDS = 100
+SHORT, ABSOLUTE, FAR, CONSTANT = "short", "absolute", "far", "constant"
+
+
+class _Site(object):
+    """A place for a literal pool: after item (an unconditional
+    jump or HALT), before item (an island), or at the end
+    """
+
+    def __init__(self, name: str, item: int, before: bool = False,
+                 jump: bool = False) -> None:
+        self.name = name
+        self.item = item
+        self.before = before
+        self.jump = jump          # Control may reach it, so jump around it
+        self.hole = False         # Pad to the end of RESERVED
+        self.entries = []         # ("address", label) or ("value", n)
+        self.save = False         # A slot to save the scratch register
+        self.base = 0
+        self.pad = 0
+
+    def size(self) -> int:
+        return int(self.jump) + len(self.entries) + int(self.save) + self.pad
+
+    def entry_address(self, key) -> int:
+        if key == "save":
+            return self.base + int(self.jump) + len(self.entries)
+        return self.base + int(self.jump) + self.entries.index(key)
+
+
+class _Relaxation(object):
+    """Lays out a program, choosing an encoding for each symbolic
+    reference
+    """
+
+    def __init__(self, lines: List[str], reserved: Optional[tuple] = RESERVED,
+                 imports: Optional[set] = None, fields: List[dict] = None) -> None:
+        self.lines = [line.rstrip("\n") for line in lines]
+        if fields is None:
+            fields = [parse_line(line) for line in self.lines]
+        self.fields = fields
+        self.reserved = reserved
+        # With imports the program may be loaded anywhere, so no
+        # reference may use an absolute address
+        self.relocatable = imports is not None
+        self.imports = set(imports or ())
+        n = len(self.fields)
+        self.word = [f["kind"] != AsmSrcKind.COMMENT for f in self.fields]
+        self.names = {}          # Label -> item index of the word it names
+        pending = []
+        for i, f in enumerate(self.fields):
+            if f["label"]:
+                if f["label"] in self.names or f["label"] in pending:
+                    raise SyntaxError("Duplicate label {} in line {}".format(f["label"], i))
+                pending.append(f["label"])
+            if self.word[i]:
+                for name in pending:
+                    self.names[name] = i
+                pending = []
+        for name in pending:
+            self.names[name] = n     # Labels at the very end
+        for name in self.imports & set(self.names):
+            raise SyntaxError("Imported symbol {} is also a label".format(name))
+        self.refs = [i for i, f in enumerate(self.fields) if f["kind"] == AsmSrcKind.SYMBOLIC]
+        self.form = {i: SHORT for i in self.refs}
+        self.pool_of = {}
+        self.flows = n * [False]  # Can control run from the previous word into item i?
+        previous = None
+        for i in range(n):
+            if self.word[i]:
+                # Execution starts at the first word
+                self.flows[i] = previous is None or self._falls_through(previous)
+                previous = i
+        self.sites = {}
+        for i, f in enumerate(self.fields):
+            if self.word[i] and not self._falls_through(i) and f["kind"] != AsmSrcKind.DATA:
+                self.sites["a{}".format(i)] = _Site("a{}".format(i), i)
+        self.sites["end"] = _Site("end", n)
+        self.hole_site = None
+        self.constants = self._constants()
+        self.prefix = "pool"
+        while any(name.startswith(self.prefix) for name in self.names):
+            self.prefix += "x"
+
+    def _falls_through(self, i: int) -> bool:
+        f = self.fields[i]
+        if f["kind"] == AsmSrcKind.DATA:
+            return False
+        always = f["predicate"] in (None, "ALWAYS")
+        if f["kind"] == AsmSrcKind.SYMBOLIC and f["opcode"] == "JUMP":
+            return not always
+        if f["kind"] == AsmSrcKind.FULL and f["opcode"] == "HALT":
+            return not always
+        return True
+
+    def _constants(self) -> dict:
+        """Labels of DATA words nothing can store to, and their values"""
+        stored = set()
+        for f in self.fields:
+            if f["kind"] == AsmSrcKind.SYMBOLIC and f["opcode"] == "STORE":
+                stored.add(f["symbol"])
+            elif f["kind"] == AsmSrcKind.FULL and f["opcode"] == "STORE" and \
+                    (f["src1"], f["src2"]) != ("r0", "r0"):
+                return {}
+        values = {}
+        for name, i in self.names.items():
+            if i < len(self.fields) and name not in stored:
+                f = self.fields[i]
+                if f["kind"] == AsmSrcKind.DATA and f["value"]:
+                    values[name] = value_parse(f["value"])
+        return values
+
+    def size(self, i: int) -> int:
+        if not self.word[i]:
+            return 0
+        form = self.form.get(i, SHORT)
+        if form == FAR:
+            return {"JUMP": 1, "LOAD": 2, "STORE": 4}[self.fields[i]["opcode"]]
+        return 1
+
+    def accesses(self, i: int) -> List[tuple]:
+        """(offset in the expansion of item i, pool key) for each
+        word of a far reference that reads the pool
+        """
+        f = self.fields[i]
+        if self.form[i] == CONSTANT:
+            return [(0, ("value", self.constants[f["symbol"]]))]
+        key = ("address", f["symbol"])
+        if f["opcode"] == "STORE":
+            return [(0, "save"), (1, key), (3, "save")]
+        return [(0, key)]
+
+    def layout(self) -> None:
+        """Addresses of items, sites, and labels"""
+        before = {s.item: s for s in self.sites.values() if s.before}
+        after = {s.item: s for s in self.sites.values() if not s.before}
+        for site in self.sites.values():
+            site.entries = []
+            site.save = False
+        for i in self.refs:
+            if self.form[i] in (FAR, CONSTANT):
+                site = self.sites[self.pool_of[i]]
+                for offset, key in self.accesses(i):
+                    if key == "save":
+                        site.save = True
+                    elif key not in site.entries:
+                        site.entries.append(key)
+        self.addr = (len(self.fields) + 1) * [0]
+        addr = 0
+        for i in range(len(self.fields) + 1):
+            site = before.get(i)
+            if site is not None:
+                site.base = addr
+                site.pad = 0
+                if site.hole:
+                    site.pad = max(0, self.reserved[1] - (addr + site.size()))
+                addr += site.size()
+            self.addr[i] = addr
+            if i < len(self.fields):
+                addr += self.size(i)
+            site = after.get(i)
+            if site is not None:
+                site.base = addr
+                addr += site.size()
+        self.length = addr
+        # For finding the nearest pool; sites made before the next
+        # layout have no address yet
+        self.site_bases = sorted((site.base, site.name) for site in self.sites.values())
+        self.new_sites = []
+
+    def label_address(self, name: str) -> int:
+        if name not in self.names:
+            raise KeyError(name)
+        return self.addr[self.names[name]]
+
+    def _reaches(self, i: int, site: _Site) -> bool:
+        for offset, key in self.accesses(i):
+            if not MIN_OFFSET <= site.entry_address(key) - (self.addr[i] + offset) <= MAX_OFFSET:
+                return False
+        return True
+
+    def _safe_point(self, i: int, lowest: int) -> Optional[int]:
+        """The nearest item at or before i, and after lowest, before
+        which words may be inserted: control does not run into it,
+        or it is unpredicated and so ignores what a jump around
+        the inserted words does to the condition code
+        """
+        for j in range(i, lowest, -1):
+            if self.word[j] and (not self.flows[j] or
+                                 (self.fields[j]["kind"] != AsmSrcKind.DATA and
+                                  self.fields[j]["predicate"] in (None, "ALWAYS"))):
+                return j
+        return None
+
+    def _place_pool(self, i: int) -> bool:
+        """Give far reference i a pool in reach; True if anything
+        changed
+        """
+        current = self.pool_of.get(i)
+        if current is not None and self._reaches(i, self.sites[current]):
+            return False
+        here = self.addr[i]
+        best = None
+        bases = self.site_bases
+        k = bisect.bisect_left(bases, (here, ""))
+        nearest = [bases[j] for j in (k - 1, k) if 0 <= j < len(bases)]
+        for base, name in nearest + [(self.sites[name].base, name) for name in self.new_sites]:
+            distance = abs(base - here)
+            if name in self.sites and distance <= POOL_REACH and \
+                    (best is None or distance < best[0]):
+                best = (distance, name)
+        if best is None:
+            j = self._safe_point(i, max(-1, i - 2 * POOL_REACH))
+            if j is None or self.addr[i] - self.addr[j] > POOL_REACH:
+                j = next((k for k in range(i + 1, len(self.fields))
+                          if self._safe_point(k, k - 1) == k), None)
+            if j is None or abs(self.addr[j] - here) > POOL_REACH:
+                raise SyntaxError("No room for a literal pool near line {}".format(i))
+            name = "i{}".format(j)
+            if name not in self.sites:
+                self.sites[name] = _Site(name, j, before=True, jump=self.flows[j])
+                self.new_sites.append(name)
+            best = (0, name)
+        self.pool_of[i] = best[1]
+        return best[1] != current
+
+    def _place_hole(self) -> bool:
+        """Keep words out of the reserved addresses; True if the
+        hole had to move
+        """
+        if self.reserved is None:
+            return False
+        low, high = self.reserved
+        site = self.hole_site
+        if site is not None and site.base + site.size() - site.pad <= low:
+            return False
+        if site is None and self.length <= low:
+            return False
+        # The first item that would not fit below the hole
+        limit = site.item if site is not None else len(self.fields)
+        first = next((i for i in range(limit) if self.word[i] and
+                      self.addr[i] + self.size(i) + 1 > low), limit)
+        j = self._safe_point(min(first, len(self.fields) - 1), -1)
+        while j is not None and (j >= limit or self.addr[j] + 1 > low):
+            j = self._safe_point(j - 1, -1)
+        if j is None:
+            raise SyntaxError("Cannot lay out the program around addresses {}..{}"
+                              .format(low, high - 1))
+        name = "i{}".format(j)
+        hole = self.sites.get(name)
+        if hole is None:
+            hole = _Site(name, j, before=True, jump=self.flows[j])
+            self.sites[name] = hole
+        if site is not None:
+            # Its pool moves with it; the next round checks the reach
+            del self.sites[site.name]
+            for i, pool in self.pool_of.items():
+                if pool == site.name:
+                    self.pool_of[i] = name
+        hole.hole = True
+        self.hole_site = hole
+        return True
+
+    def run(self) -> None:
+        for round in range(RELAX_ROUNDS):
+            self.layout()
+            # The hole first, since pools may use it
+            if self._place_hole():
+                continue
+            changed = False
+            for i in self.refs:
+                f = self.fields[i]
+                if f["symbol"] in self.imports:
+                    # Always far: only the linker knows where it is
+                    if self.form[i] != FAR:
+                        self._make_far(i)
+                        changed = True
+                    changed |= self._place_pool(i)
+                    continue
+                if f["symbol"] not in self.names:
+                    continue    # transform_lines reports it
+                target = self.label_address(f["symbol"])
+                if self.form[i] in (SHORT, ABSOLUTE):
+                    if MIN_OFFSET <= target - self.addr[i] <= MAX_OFFSET:
+                        self.form[i] = SHORT
+                    elif 0 <= target <= MAX_OFFSET and not self.relocatable:
+                        self.form[i] = ABSOLUTE
+                    elif f["opcode"] == "LOAD" and f["symbol"] in self.constants:
+                        self.form[i] = CONSTANT
+                        changed = True
+                    else:
+                        self._make_far(i)
+                        changed = True
+                if self.form[i] in (FAR, CONSTANT):
+                    changed |= self._place_pool(i)
+            if not changed:
+                return
+        raise SyntaxError("Layout did not settle in {} rounds".format(RELAX_ROUNDS))
+
+    def _make_far(self, i: int) -> None:
+        f = self.fields[i]
+        if f["opcode"] != "JUMP" and f["predicate"] not in (None, "ALWAYS"):
+            raise SyntaxError("Predicated {} cannot reach {} from line {}"
+                              .format(f["opcode"], f["symbol"], i))
+        self.form[i] = FAR
+
+    def relocations(self) -> List[tuple]:
+        """(address, symbol) of each pool word holding an address:
+        symbol is None for a label of this program, whose address
+        is given as if the program were loaded at 0
+        """
+        result = []
+        for site in self.sites.values():
+            for kind, what in site.entries:
+                if kind == "address":
+                    symbol = what if what in self.imports else None
+                    result.append((site.entry_address((kind, what)), symbol))
+        return sorted(result)
+
+    def changes_layout(self) -> bool:
+        return any(form == FAR or form == CONSTANT for form in self.form.values()) or \
+            self.hole_site is not None
+
+    def _pool_label(self, site: _Site, key) -> str:
+        if key == "save":
+            return "{}{}_save".format(self.prefix, site.name)
+        return "{}{}_{}".format(self.prefix, site.name, site.entries.index(key))
+
+    def _site_lines(self, site: _Site) -> List[str]:
+        out = []
+        if site.jump:
+            out.append("   JUMP {}{}_end".format(self.prefix, site.name))
+        for k, (kind, what) in enumerate(site.entries):
+            if kind == "value":
+                value = what
+            elif what in self.imports:
+                value = 0       # Filled in by the linker
+            else:
+                value = self.label_address(what)
+            out.append("{}{}_{}: DATA {}  # {} {}".format(
+                self.prefix, site.name, k, value, kind, what))
+        if site.save:
+            out.append("{}{}_save: DATA 0".format(self.prefix, site.name))
+        out.extend(["   DATA 0  # Reserved for devices"] * site.pad)
+        if site.jump:
+            out.append("{}{}_end:".format(self.prefix, site.name))
+        return out
+
+    def _ref_lines(self, i: int) -> List[str]:
+        f = self.fields[i]
+        form = self.form[i]
+        if form == SHORT:
+            return [self.lines[i]]
+        label = "{}: ".format(f["label"]) if f["label"] else "   "
+        predicate = "/{}".format(f["predicate"]) if f["predicate"] else ""
+        symbol = f["symbol"]
+        comment = "  # {} {}".format(f["opcode"], symbol)
+        if form == ABSOLUTE:
+            target = self.label_address(symbol)
+            if f["opcode"] == "JUMP":
+                return ["{}ADD{} r15,r0,r0[{}]{}".format(label, predicate, target, comment)]
+            return ["{}{}{} {},r0,r0[{}]{}".format(label, f["opcode"], predicate,
+                                                  f["target"], target, comment)]
+        site = self.sites[self.pool_of[i]]
+        pool = [self._pool_label(site, key) for offset, key in self.accesses(i)]
+        if form == CONSTANT:
+            return ["{}LOAD{} {},{}{}".format(label, predicate, f["target"], pool[0], comment)]
+        if f["opcode"] == "JUMP":
+            return ["{}LOAD{} r15,{}{}".format(label, predicate, pool[0], comment)]
+        reg = f["target"]
+        if f["opcode"] == "LOAD":
+            return ["{}LOAD {},{}{}".format(label, reg, pool[0], comment),
+                    "   LOAD {},{},r0[0]".format(reg, reg)]
+        scratch = "r13" if reg == "r14" else "r14"
+        return ["{}STORE {},{}{}".format(label, scratch, pool[0], comment),
+                "   LOAD {},{}".format(scratch, pool[1]),
+                "   STORE {},{},r0[0]".format(reg, scratch),
+                "   LOAD {},{}".format(scratch, pool[2])]
+
+    def output(self) -> List[str]:
+        """The program with far references expanded and pools placed"""
+        return [line for line, fields in self.items()]
+
+    def items(self) -> List[tuple]:
+        """output() as (line, fields) pairs, with the parsed fields
+        of each line passed through and None for new lines
+        """
+        if self.changes_layout():
+            for f in self.fields:
+                if f["kind"] == AsmSrcKind.FULL and "r15" in (f["src1"], f["src2"]):
+                    raise SyntaxError("Cannot move code addressed relative to r15 by hand: {}"
+                                      .format(f["opcode"]))
+        before = {s.item: s for s in self.sites.values() if s.before}
+        after = {s.item: s for s in self.sites.values() if not s.before}
+        # Inserted words go before the labels that name the next word
+        insert_at = {}
+        for item, site in before.items():
+            p = item
+            while p > 0 and not self.word[p - 1]:
+                p -= 1
+            insert_at[p] = site
+        out = []
+        for i in range(len(self.fields) + 1):
+            if i in insert_at:
+                out.extend((line, None) for line in self._site_lines(insert_at[i]))
+            if i == len(self.fields):
+                break
+            if self.form.get(i, SHORT) == SHORT:
+                out.append((self.lines[i], self.fields[i]))
+            else:
+                out.extend((line, None) for line in self._ref_lines(i))
+            if i in after:
+                out.extend((line, None) for line in self._site_lines(after[i]))
+        if len(self.fields) in after:
+            out.extend((line, None) for line in self._site_lines(after[len(self.fields)]))
+        return out
+
+
+def relax(lines: List[str], reserved: tuple = RESERVED) -> List[str]:
+    """Expand references that cannot reach their labels, placing
+    literal pools and keeping clear of the reserved addresses.
+    The result resolves with build_table and transform_lines.
+    """
+    relaxation = _Relaxation(lines, reserved)
+    relaxation.run()
+    return relaxation.output()
+
+
+def relax_parsed(lines: List[str], fields: List[dict],
+                 reserved: tuple = RESERVED) -> List[tuple]:
+    """relax() for lines already parsed: (line, fields) pairs,
+    fields None for the lines relaxation adds
+    """
+    relaxation = _Relaxation(lines, reserved, fields=fields)
+    relaxation.run()
+    return relaxation.items()
+
+
+def relocatable(lines: List[str], imports: set) -> Tuple[List[str], dict]:
+    """Lay out a program that may be loaded at any address and
+    may refer to imported symbols, which are always reached
+    through literal pools.  Returns the laid-out lines and
+    {"relocations": [(address, symbol)], "constants": {label: value}}:
+    the pool words a linker must fill in (see
+    _Relaxation.relocations) and the DATA words nothing stores to.
+    The devices are the linker's business, so no hole is left.
+    """
+    relaxation = _Relaxation(lines, None, imports)
+    relaxation.run()
+    lines = relaxation.output()
+    return lines, {"relocations": relaxation.relocations(),
+                   "constants": relaxation.constants}
+
+
+def resolve(lines: List[str], reserved: tuple = RESERVED) -> List[str]:
+    """Both passes: lay out the program and resolve its labels"""
+    relaxed = relax(lines, reserved)
+    return transform_lines(relaxed, build_table(relaxed))
 
 
 def cli() -> object:
     """Get arguments from command line"""
-    parser = argparse.ArgumentParser(description="Duck Machine Assembler (pass 2)")
+    parser = argparse.ArgumentParser(description="Duck Machine Assembler (pass 1)")
     parser.add_argument("sourcefile", type=argparse.FileType('r'),
                         nargs="?", default=sys.stdin,
                         help="Duck Machine assembly code file")
     parser.add_argument("resolved", type=argparse.FileType('w'),
                         nargs="?", default=sys.stdout,
                         help="Resolved output")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Apply peephole optimizations before resolving")
+    parser.add_argument("--promote", action="store_true",
+                        help="Keep variables in registers (see promote.py)")
     args = parser.parse_args()
     return args
 
@@ -391,8 +834,22 @@ def main():
     """"Assemble a Duck Machine program"""
     args = cli()
     lines = args.sourcefile.readlines()
-    table = build_table(lines)
-    lines = transform_lines(lines, table)
+    # Not imported at the top: the optimizers build on this module
+    if args.optimize:
+        import peephole
+        lines, report = peephole.optimize(lines)
+        log.info(peephole.format_report(args.sourcefile.name, report))
+    if args.promote:
+        import promote
+        lines, report = promote.promote(lines)
+        log.info("Registers: {}".format(report["registers"]))
+    try:
+        resolved = resolve(lines)
+    except SyntaxError as e:
+        print(e)
+        sys.exit(1)
+    for line in resolved:
+        print(line, file=args.resolved)
 
 
 if __name__ == "__main__":
@@ -199,7 +199,6 @@ def parse_line(line: str) -> dict:
         if match:
             fields = match.groupdict()
             fields["kind"] = kind
-            print(fields)
             log.debug("Extracted fields {}".format(fields))
             return fields
     raise SyntaxError("Assembler syntax error in {}".format(line))
@@ -234,8 +233,6 @@ def assemble(lines: List[str]) -> List[int]:
         log.debug("Processing line {}: {}".format(lnum, line))
         try: 
             fields = parse_line(line)
-            #FIXME I added this
-            print(fields)
             if fields["kind"] == AsmSrcKind.FULL:
                 log.debug("Constructing instruction")
                 fill_defaults(fields)
@@ -257,8 +254,7 @@ def assemble(lines: List[str]) -> List[int]:
             error_count += 1
             print("Exception encountered in line {}: {}".format(lnum, e))
         if error_count > ERROR_LIMIT:
-            print("Too many errors; abandoning")
-            sys.exit(1)
+            raise SyntaxError("Too many errors; abandoning")
     return instructions
 
 def cli() -> object:
@@ -278,7 +274,11 @@ def main():
     """"Assemble a Duck Machine program"""
     args = cli()
     lines = args.sourcefile.readlines()
-    object_code = assemble(lines)
+    try:
+        object_code = assemble(lines)
+    except SyntaxError as e:
+        print(e)
+        sys.exit(1)
     log.debug("Object code: \n{}".format(object_code))
     for word in object_code:
         log.debug("Instruction word {}".format(word))
@@ -0,0 +1,194 @@
+"""
+Assemble many programs at once.
+
+Takes directories (every .asm file under them) and glob patterns,
+and assembles the sources across a pool of worker processes, each
+writing its .obj beside its source.  With --outdir, object files
+keep the tree the sources are in, so students/ann/p.asm and
+students/bob/p.asm become out/ann/p.obj and out/bob/p.obj.  Like
+make, a source whose .obj is newer than it is skipped.  A program
+with errors does not stop the batch: its errors are collected with
+its name and reported at the end, and the batch exits with status 1.
+A source whose object file would be another's fails.
+
+    python3 batch.py programs 'students/**/*.asm' -j 8
+    python3 batch.py programs --force -O
+"""
+
+from assembler import Assembly, AssemblyError
+from build_cache import remove_quietly
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Sequence
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+SKIP_DIRS = {"__duckcache__", "__pycache__"}
+
+
+def find_sources(patterns: Sequence[str]) -> List[str]:
+    """Sources named by directories and glob patterns, each once,
+    in order
+    """
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+                found.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.endswith(".asm"))
+        else:
+            found.extend(sorted(glob.glob(pattern, recursive=True)))
+    seen = set()
+    return [path for path in found if not (path in seen or seen.add(path))]
+
+
+def output_path(source: str, outdir: str = None, base: str = None) -> str:
+    """The object file for source: beside it, or under outdir at
+    the place source has under base (its own directory by default)
+    """
+    obj = os.path.splitext(source)[0] + ".obj"
+    if outdir is None:
+        return obj
+    if base is None:
+        return os.path.join(outdir, os.path.basename(obj))
+    return os.path.join(outdir, os.path.relpath(os.path.abspath(obj), base))
+
+
+def up_to_date(source: str, obj: str) -> bool:
+    try:
+        return os.stat(obj).st_mtime >= os.stat(source).st_mtime
+    except OSError:
+        return False
+
+
+def assemble_one(job: tuple) -> tuple:
+    """Assemble one source to its object file, in a worker.
+    Returns (source, lines, words, errors), errors a list of
+    messages, empty on success.
+    """
+    source, obj, optimize, promote = job
+    try:
+        with open(source) as f:
+            lines = f.readlines()
+        words = Assembly(lines, optimize, promote).words
+        # Written whole or not at all, so a failed batch leaves no
+        # half file that looks up to date
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(obj) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("".join("{}\n".format(word) for word in words))
+            os.replace(temp, obj)
+        except OSError:
+            remove_quietly(temp)
+            raise
+    except AssemblyError as e:
+        return source, 0, 0, e.errors
+    except (OSError, UnicodeDecodeError) as e:
+        return source, 0, 0, [str(e)]
+    return source, len(lines), len(words), []
+
+
+def assemble_batch(sources: Sequence[str], jobs: int = None, optimize: bool = False,
+                   promote: bool = False, force: bool = False, outdir: str = None) -> dict:
+    """Assemble sources, jobs at a time (1: in this process).
+    Returns a report: the sources assembled and skipped, the errors
+    of those that failed, and lines, words and seconds in all.
+    """
+    start = time.perf_counter()
+    base = None
+    if outdir is not None and sources:
+        # Sources in different directories may share a name, so
+        # keep the tree they are in
+        base = os.path.commonpath([os.path.dirname(os.path.abspath(source))
+                                   for source in sources])
+    todo, skipped, clashes = [], [], {}
+    owners = {}
+    for source in sources:
+        obj = output_path(source, outdir, base)
+        owner = owners.setdefault(os.path.abspath(obj), source)
+        if owner != source:
+            clashes[source] = ["Object file {} is also {}'s".format(obj, owner)]
+        elif not force and up_to_date(source, obj):
+            skipped.append(source)
+        else:
+            todo.append((source, obj, optimize, promote))
+    if outdir is not None:
+        for _, obj, _, _ in todo:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+    if jobs == 1 or len(todo) <= 1:
+        results = [assemble_one(job) for job in todo]
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            # Programs are small; hand them out a few at a time
+            chunk = max(1, len(todo) // (4 * (jobs or os.cpu_count() or 1)))
+            results = list(pool.map(assemble_one, todo, chunksize=chunk))
+    report = {"assembled": [], "skipped": skipped, "failed": clashes, "lines": 0, "words": 0}
+    for source, lines, words, errors in results:
+        if errors:
+            report["failed"][source] = errors
+        else:
+            report["assembled"].append(source)
+            report["lines"] += lines
+            report["words"] += words
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def format_report(report: dict) -> str:
+    out = []
+    for source, errors in report["failed"].items():
+        out.append("{}:".format(source))
+        out.extend("    {}".format(error) for error in errors)
+    seconds = max(report["seconds"], 1e-9)
+    out.append("{} assembled, {} up to date, {} failed in {:.2f} s".format(
+        len(report["assembled"]), len(report["skipped"]), len(report["failed"]), seconds))
+    out.append("{:.0f} files/s, {:.0f} lines/s, {:.0f} words/s".format(
+        len(report["assembled"]) / seconds, report["lines"] / seconds,
+        report["words"] / seconds))
+    return "\n".join(out)
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Assemble many Duck Machine programs")
+    parser.add_argument("sources", nargs="+", help="Directories and glob patterns of .asm files")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Worker processes (default: one per CPU)")
+    parser.add_argument("-o", "--outdir", help="Write object files here, not beside sources")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Assemble sources even if their object files are up to date")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Apply peephole optimizations (see peephole.py)")
+    parser.add_argument("--promote", action="store_true",
+                        help="Keep variables in registers (see promote.py)")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Assemble a batch and report on it"""
+    args = cli()
+    sources = find_sources(args.sources)
+    if not sources:
+        log.error("No sources found")
+        sys.exit(1)
+    report = assemble_batch(sources, args.jobs, args.optimize, args.promote,
+                            args.force, args.outdir)
+    print(format_report(report))
+    if report["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
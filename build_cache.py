@@ -0,0 +1,205 @@
+"""
+A build cache for assembled programs.
+
+Like __pycache__ for Python, assembling programs/fact.asm through
+the cache leaves the object code in programs/__duckcache__, named
+by a hash of everything that decides it: the source, the options,
+and the assembler itself (the text of the modules that assemble).
+A later run with the same source and options loads the words
+from there and does not assemble at all; any change to the
+source, options or assembler gives a new name, so a stale entry is
+never used.
+
+Each cache directory is kept under a size limit.  Using an entry
+touches it, and when a new entry takes the directory over the
+limit, the entries used longest ago are removed first.  Entries
+are written to a temporary file and renamed, so a reader never
+sees half of one.  If the directory cannot be written, programs
+are still assembled, just not cached.
+
+    python3 duck_machine.py programs/fact.asm    # through the cache
+    python3 build_cache.py programs              # what is cached
+    python3 build_cache.py programs --clear
+"""
+
+from assembler import Assembly
+from assembler_pass1 import RESERVED
+
+from typing import List, Optional
+
+import argparse
+import hashlib
+import os
+import tempfile
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+CACHE_DIR = "__duckcache__"
+SUFFIX = ".obj"
+DEFAULT_LIMIT = 16 * 1024 * 1024    # Bytes per cache directory
+
+# What the object code depends on, besides the source
+ASSEMBLER_MODULES = ["assembler.py", "assembler_pass1.py", "assembler_pass2.py", "lexer.py",
+                     "instr_format.py", "peephole.py", "promote.py"]
+
+_fingerprint = None
+
+
+def assembler_fingerprint() -> bytes:
+    """A digest of the assembler's source, standing for its version"""
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ASSEMBLER_MODULES:
+            with open(os.path.join(here, name), "rb") as f:
+                digest.update(f.read())
+        _fingerprint = digest.digest()
+    return _fingerprint
+
+
+def remove_quietly(path: str) -> None:
+    """Remove a file if it can be removed"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class BuildCache(object):
+    """Object code in one directory, keyed by content hash"""
+
+    def __init__(self, directory: str, limit: int = DEFAULT_LIMIT) -> None:
+        self.directory = directory
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source: bytes, optimize: bool = False, promote: bool = False,
+            reserved: tuple = RESERVED) -> str:
+        digest = hashlib.sha256(assembler_fingerprint())
+        digest.update(repr((optimize, promote, reserved)).encode())
+        digest.update(source)
+        return digest.hexdigest()[:32]
+
+    def path(self, name: str, key: str) -> str:
+        return os.path.join(self.directory, "{}.{}{}".format(name, key, SUFFIX))
+
+    def get(self, name: str, key: str) -> Optional[List[int]]:
+        """The cached words, or None"""
+        path = self.path(name, key)
+        try:
+            with open(path) as f:
+                words = list(map(int, f.read().split()))
+            os.utime(path)          # Recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return words
+
+    def put(self, name: str, key: str, words: List[int]) -> None:
+        """Store words, then evict what no longer fits"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError as e:
+            log.debug("Not caching {}: {}".format(name, e))
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("".join("{}\n".format(word) for word in words))
+            os.replace(temp, self.path(name, key))
+        except OSError as e:
+            # entries() does not see temporary files, so one left
+            # here would never be evicted
+            remove_quietly(temp)
+            log.debug("Not caching {}: {}".format(name, e))
+            return
+        self.evict()
+
+    def entries(self) -> List[tuple]:
+        """(last use, size, path) of each entry, most recently used last"""
+        found = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return found
+        for name in names:
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue        # Evicted by another process
+            found.append((stat.st_mtime, stat.st_size, path))
+        return sorted(found)
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the rest fit"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            remove_quietly(path)
+            total -= size
+
+    def clear(self) -> None:
+        for _, _, path in self.entries():
+            os.remove(path)
+
+
+def cache_for(path: str, limit: int = DEFAULT_LIMIT) -> BuildCache:
+    """The cache beside a source file"""
+    return BuildCache(os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR), limit)
+
+
+def assemble_file(path: str, optimize: bool = False, promote: bool = False,
+                  reserved: tuple = RESERVED, cache: BuildCache = None) -> List[int]:
+    """Object code for a source file, from the cache if it has
+    been assembled before.  Raises AssemblyError as Assembly does.
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+    if cache is None:
+        cache = cache_for(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    key = cache.key(source, optimize, promote, reserved)
+    words = cache.get(name, key)
+    if words is None:
+        lines = source.decode().splitlines()
+        words = Assembly(lines, optimize, promote, reserved).words
+        cache.put(name, key, words)
+    return words
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine build cache")
+    parser.add_argument("directory", help="Directory of sources, whose cache to look at")
+    parser.add_argument("--clear", action="store_true", help="Remove every entry")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """List or clear the cache of a directory"""
+    args = cli()
+    cache = BuildCache(os.path.join(args.directory, CACHE_DIR))
+    if args.clear:
+        cache.clear()
+        return
+    entries = cache.entries()
+    for _, size, path in reversed(entries):
+        print("{:8} {}".format(size, os.path.basename(path)))
+    print("{} entries, {} bytes".format(len(entries), sum(size for _, size, _ in entries)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Cache timing model for the Duck Machine.
+
+The Duck Machine itself has no caches (see docs/duck_machine.md);
+this is an optional model that watches a running CPU and estimates
+how a hierarchy of set-associative caches would have performed.
+It does not change what the program computes.
+
+Sizes are in words, since Duck Machine memory is word-addressed.
+"""
+
+from mvc import MVCListener
+from cpu import CPU, CPUStep
+from instr_format import OpCode
+
+from typing import List, Tuple
+
+import array
+import random
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+REPLACEMENT_POLICIES = ["lru", "fifo", "random"]
+WRITE_POLICIES = ["wb", "wt"]   # Write-back, write-through
+
+EMPTY = -1   # Tag of an invalid line
+
+
+class MainMemoryTiming(object):
+    """The level below the last cache: every access costs latency"""
+
+    def __init__(self, latency: int = 100) -> None:
+        self.name = "memory"
+        self.latency = latency
+        self.reads = 0
+        self.writes = 0
+
+    def access(self, addr: int, write: bool = False) -> int:
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+        return self.latency
+
+    def report(self, instructions: int) -> str:
+        return "{:8} reads {:>10} writes {:>10}".format(
+            self.name, self.reads, self.writes)
+
+
+class Cache(object):
+    """One set-associative cache.  Tags and replacement stamps are
+    kept in flat arrays, one slot per (set, way), so a lookup is
+    a search of a short array slice.  Write-back caches allocate
+    on write misses; write-through caches do not.
+    """
+
+    def __init__(self, name: str, size: int, line_size: int = 4,
+                 ways: int = 2, policy: str = "lru", latency: int = 1,
+                 write: str = "wb", next_level=None) -> None:
+        if policy not in REPLACEMENT_POLICIES:
+            raise ValueError("Unknown replacement policy {}".format(policy))
+        if write not in WRITE_POLICIES:
+            raise ValueError("Unknown write policy {}".format(write))
+        if size % (line_size * ways):
+            raise ValueError("Cache size {} is not a multiple of line size {} x {} ways"
+                             .format(size, line_size, ways))
+        self.name = name
+        self.size = size
+        self.line_size = line_size
+        self.ways = ways
+        self.sets = size // (line_size * ways)
+        self.policy = policy
+        self.latency = latency
+        self.write_back = write == "wb"
+        self.next_level = next_level if next_level is not None else MainMemoryTiming()
+        self.tags = array.array("q", [EMPTY]) * (self.sets * ways)
+        self.stamps = array.array("q", [0]) * (self.sets * ways)
+        self.dirty = bytearray(self.sets * ways)
+        self._clock = 0
+        self._random = random.Random(0)   # Repeatable runs
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+
+    def access(self, addr: int, write: bool = False) -> int:
+        """Read or write the word at addr; returns the cycles taken"""
+        self._clock += 1
+        line = addr // self.line_size
+        base = (line % self.sets) * self.ways
+        tag = line // self.sets
+        tags = self.tags
+        try:
+            slot = tags.index(tag, base, base + self.ways)
+        except ValueError:
+            slot = None
+        if slot is not None:
+            self.hits += 1
+            if self.policy == "lru":
+                self.stamps[slot] = self._clock
+            if write:
+                if self.write_back:
+                    self.dirty[slot] = 1
+                else:
+                    return self.latency + self.next_level.access(addr, True)
+            return self.latency
+        self.misses += 1
+        if write and not self.write_back:
+            # No allocation on a write-through miss
+            return self.latency + self.next_level.access(addr, True)
+        cycles = self.latency
+        slot = self._victim(base)
+        if self.dirty[slot]:
+            victim_line = tags[slot] * self.sets + base // self.ways
+            cycles += self.next_level.access(victim_line * self.line_size, True)
+            self.writebacks += 1
+        cycles += self.next_level.access(addr, False)
+        tags[slot] = tag
+        self.stamps[slot] = self._clock
+        self.dirty[slot] = 1 if write else 0
+        return cycles
+
+    def _victim(self, base: int) -> int:
+        """Slot to replace in the set starting at base"""
+        end = base + self.ways
+        try:
+            return self.tags.index(EMPTY, base, end)
+        except ValueError:
+            pass
+        if self.policy == "random":
+            return self._random.randrange(base, end)
+        stamps = self.stamps
+        return min(range(base, end), key=stamps.__getitem__)
+
+    def hit_rate(self) -> float:
+        accesses = self.hits + self.misses
+        return self.hits / accesses if accesses else 0.0
+
+    def report(self, instructions: int) -> str:
+        mpki = 1000 * self.misses / instructions if instructions else 0.0
+        return ("{:8} hits {:>10} misses {:>10} hit rate {:6.2%} "
+                "MPKI {:8.2f} writebacks {:>8}".format(
+                    self.name, self.hits, self.misses, self.hit_rate(),
+                    mpki, self.writebacks))
+
+
+def parse_cache_spec(spec: str) -> dict:
+    """A cache is specified as NAME:SIZE[:LINE[:WAYS[:POLICY[:LATENCY[:WRITE]]]]],
+    e.g. L1D:1024:8:4:lru:1:wb.  A NAME beginning L1I is an
+    instruction cache, L1D a data cache; other caches are unified.
+    """
+    fields = spec.split(":")
+    if len(fields) < 2 or len(fields) > 7:
+        raise ValueError("Bad cache specification '{}'".format(spec))
+    names = ["name", "size", "line_size", "ways", "policy", "latency", "write"]
+    config = dict(zip(names, fields))
+    for key in ["size", "line_size", "ways", "latency"]:
+        if key in config:
+            config[key] = int(config[key])
+    if "policy" in config:
+        config["policy"] = config["policy"].lower()
+    if "write" in config:
+        config["write"] = config["write"].lower()
+    return config
+
+
+def build_hierarchy(specs: List[str], memory_latency: int = 100) -> Tuple[Cache, Cache, List]:
+    """Build caches from specifications (see parse_cache_spec),
+    listed from the top level down.  Returns the instruction-side
+    cache, the data-side cache (the same object if unified), and
+    a list of every level including main memory.
+    """
+    memory = MainMemoryTiming(memory_latency)
+    configs = [parse_cache_spec(spec) for spec in specs]
+    split = [c for c in configs if c["name"].upper().startswith(("L1I", "L1D"))]
+    unified = [c for c in configs if c not in split]
+    # Build bottom up so each cache knows its next level
+    below = memory
+    shared = []
+    for config in reversed(unified):
+        below = Cache(next_level=below, **config)
+        shared.insert(0, below)
+    icache = dcache = below
+    top = []
+    for config in split:
+        cache = Cache(next_level=below, **config)
+        top.append(cache)
+        if config["name"].upper().startswith("L1I"):
+            icache = cache
+        else:
+            dcache = cache
+    if icache is memory or dcache is memory:
+        raise ValueError("A cache hierarchy needs at least one cache")
+    return icache, dcache, top + shared + [memory]
+
+
+class CacheModel(MVCListener):
+    """Listens to a CPU and sends each instruction fetch to the
+    instruction cache and each executed LOAD or STORE to the data
+    cache.  Addresses in the uncached range (device registers) go
+    to neither.  Costs nothing unless it is registered.
+    """
+
+    def __init__(self, cpu: CPU, icache: Cache, dcache: Cache,
+                 levels: List, uncached: Tuple[int, int] = (0, 0)) -> None:
+        self.cpu = cpu
+        self.icache = icache
+        self.dcache = dcache
+        self.levels = levels
+        self.uncached = uncached
+        self.instructions = 0
+        self.cycles = 0
+        self.uncached_accesses = 0
+        cpu.register_listener(self)
+
+    def notify(self, event: CPUStep) -> None:
+        if not isinstance(event, CPUStep):
+            return
+        self.instructions += 1
+        self.cycles += self.icache.access(event.pc_addr)
+        instr = event.instr
+        if instr.op is OpCode.LOAD or instr.op is OpCode.STORE:
+            if not self.cpu.will_execute(instr):
+                return
+            addr = self.cpu.effective_address(instr)
+            low, high = self.uncached
+            if low <= addr < high:
+                self.uncached_accesses += 1
+                self.cycles += self.levels[-1].latency
+            else:
+                self.cycles += self.dcache.access(addr, instr.op is OpCode.STORE)
+
+    def report(self) -> str:
+        lines = [level.report(self.instructions) for level in self.levels]
+        cpi = self.cycles / self.instructions if self.instructions else 0.0
+        lines.append("Instructions {}, estimated cycles {}, CPI {:.2f}".format(
+            self.instructions, self.cycles, cpi))
+        return "\n".join(lines)
@@ -0,0 +1,279 @@
+"""
+Single-pass cache sweep for Duck Machine programs.
+
+Runs a program once and records the LRU stack (reuse) distance of
+every instruction fetch and data access: the number of distinct
+cache lines touched since the last access to the same line.  A
+fully-associative LRU cache of C lines hits exactly the accesses
+with distance less than C, so one histogram of distances gives the
+miss ratio of every cache size at once.  Set-associative caches
+are approximated by assuming the intervening lines fall into sets
+at random.
+
+Distances are computed with a Fenwick (binary indexed) tree over
+access times, in O(log n) per access.
+"""
+
+from memory import MemoryMappedIO
+from cpu import CPU, CPUStep
+from mvc import MVCListener
+from instr_format import OpCode
+from devices import ConsoleIn, ConsoleOut
+
+from typing import Dict, List, Tuple
+
+import argparse
+import collections
+import csv
+import io
+import os
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class ReuseDistances(object):
+    """Stack distances of a stream of cache line numbers.
+    Each line has a mark at the time of its latest access; the
+    distance of an access is the number of marks after the
+    previous mark of the same line.
+    """
+
+    def __init__(self, capacity: int = 1 << 16) -> None:
+        self._size = capacity
+        self._tree = (capacity + 1) * [0]
+        self._time = 0
+        self._last = {}   # line -> time of its latest access
+        self.histogram = collections.Counter()
+        self.cold = 0     # First accesses: infinite distance
+        self.accesses = 0
+
+    def _add(self, pos: int, delta: int) -> None:
+        pos += 1
+        tree, size = self._tree, self._size
+        while pos <= size:
+            tree[pos] += delta
+            pos += pos & -pos
+
+    def _prefix(self, pos: int) -> int:
+        """Number of marks at times 0 .. pos"""
+        pos += 1
+        total = 0
+        tree = self._tree
+        while pos > 0:
+            total += tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _compact(self) -> None:
+        """Renumber the marks 0 .. k-1 when the tree is full"""
+        order = sorted(self._last, key=self._last.__getitem__)
+        self._size = max(self._size, 2 * len(order))
+        self._tree = (self._size + 1) * [0]
+        for time, line in enumerate(order):
+            self._last[line] = time
+            self._add(time, 1)
+        self._time = len(order)
+
+    def access(self, line: int) -> None:
+        self.accesses += 1
+        if self._time == self._size:
+            self._compact()
+        last = self._last.get(line)
+        if last is None:
+            self.cold += 1
+        else:
+            self.histogram[len(self._last) - self._prefix(last)] += 1
+            self._add(last, -1)
+        self._add(self._time, 1)
+        self._last[line] = self._time
+        self._time += 1
+
+
+def miss_ratios(distances: ReuseDistances, sizes: List[int]) -> List[float]:
+    """Miss ratio of a fully-associative LRU cache of each size (in lines)"""
+    if not distances.accesses:
+        return [0.0 for size in sizes]
+    hist = sorted(distances.histogram.items())
+    ratios = []
+    for size in sizes:
+        hits = sum(count for distance, count in hist if distance < size)
+        ratios.append(1.0 - hits / distances.accesses)
+    return ratios
+
+
+def miss_ratio_curve(distances: ReuseDistances) -> List[Tuple[int, float]]:
+    """(size in lines, miss ratio) for every size from 1 up to the
+    size at which only cold misses remain
+    """
+    curve = []
+    if not distances.accesses:
+        return curve
+    hits = 0
+    hist = distances.histogram
+    largest = max(hist) if hist else 0
+    for size in range(1, largest + 2):
+        hits += hist.get(size - 1, 0)
+        curve.append((size, 1.0 - hits / distances.accesses))
+    return curve
+
+
+def set_assoc_miss_ratio(distances: ReuseDistances, sets: int, ways: int) -> float:
+    """Approximate miss ratio of an LRU cache of sets x ways lines.
+    An access at distance d hits if fewer than ways of the d
+    intervening lines map to its set; each is taken to do so
+    with probability 1/sets.
+    """
+    if not distances.accesses:
+        return 0.0
+    p = 1.0 / sets
+    hits = 0.0
+    for d, count in distances.histogram.items():
+        if sets == 1:
+            hits += count if d < ways else 0
+            continue
+        # Binomial(d, p) probability of fewer than ways successes
+        pmf = (1.0 - p) ** d
+        cdf = pmf
+        for k in range(1, min(ways, d + 1)):
+            pmf *= (d - k + 1) / k * p / (1.0 - p)
+            cdf += pmf
+        hits += count * min(cdf, 1.0)
+    return 1.0 - hits / distances.accesses
+
+
+class SweepTrace(MVCListener):
+    """Listens to a CPU and feeds line numbers of instruction fetches
+    and executed data accesses to reuse distance trackers
+    """
+
+    def __init__(self, cpu: CPU, line_size: int = 4) -> None:
+        self.cpu = cpu
+        self.line_size = line_size
+        self.instructions = ReuseDistances()
+        self.data = ReuseDistances()
+        cpu.register_listener(self)
+
+    def notify(self, event: CPUStep) -> None:
+        if not isinstance(event, CPUStep):
+            return
+        self.instructions.access(event.pc_addr // self.line_size)
+        instr = event.instr
+        if instr.op is OpCode.LOAD or instr.op is OpCode.STORE:
+            if self.cpu.will_execute(instr):
+                self.data.access(self.cpu.effective_address(instr) // self.line_size)
+
+
+def sweep(objfile: io.IOBase, line_size: int = 4, capacity: int = 512,
+          inputs: List[int] = ()) -> SweepTrace:
+    """Run one program and return its trace.  Memory grows to
+    hold the program if capacity is too small.
+    """
+    words = list(map(int, objfile.read().split()))
+    mem = MemoryMappedIO(max(capacity, len(words)))
+    mem.attach(ConsoleIn(inputs, eof_value=0), 510)
+    mem.attach(ConsoleOut(io.BytesIO()), 511)
+    cpu = CPU(mem)
+    trace = SweepTrace(cpu, line_size)
+    # As duck_machine.py loads it (importing duck_machine opens the
+    # display): the hole a long program leaves for the devices is
+    # not written to them
+    mem.load_program(words)
+    cpu.run()
+    return trace
+
+
+def sweep_table(trace: SweepTrace, sizes: List[int], ways: List[int]) -> List[Dict]:
+    """One row per cache size (in words): fully-associative miss
+    ratios and set-associative approximations for each stream
+    """
+    rows = []
+    for stream, distances in [("instr", trace.instructions), ("data", trace.data)]:
+        lines = [max(size // trace.line_size, 1) for size in sizes]
+        full = miss_ratios(distances, lines)
+        for size, n_lines, ratio in zip(sizes, lines, full):
+            row = {"stream": stream, "size": size, "lines": n_lines, "full": ratio}
+            for w in ways:
+                if n_lines % w == 0:
+                    row["{}-way".format(w)] = set_assoc_miss_ratio(distances, n_lines // w, w)
+                else:
+                    row["{}-way".format(w)] = None
+            rows.append(row)
+    return rows
+
+
+def format_table(name: str, trace: SweepTrace, rows: List[Dict], ways: List[int]) -> str:
+    columns = ["full"] + ["{}-way".format(w) for w in ways]
+    lines = ["{}: {} fetches, {} data accesses, line size {} words".format(
+        name, trace.instructions.accesses, trace.data.accesses, trace.line_size)]
+    lines.append("{:6} {:>8} ".format("stream", "words") +
+                 " ".join("{:>8}".format(c) for c in columns))
+    for row in rows:
+        cells = ["{:8.4f}".format(row[c]) if row[c] is not None else "{:>8}".format("-")
+                 for c in columns]
+        lines.append("{:6} {:>8} ".format(row["stream"], row["size"]) + " ".join(cells))
+    return "\n".join(lines)
+
+
+def write_csv(path: str, rows: List[Dict], ways: List[int]) -> None:
+    fields = ["stream", "size", "lines", "full"] + ["{}-way".format(w) for w in ways]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_curve_csv(path: str, trace: SweepTrace) -> None:
+    """Fully-associative miss ratio at every size, in lines"""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["stream", "lines", "words", "miss_ratio"])
+        for stream, distances in [("instr", trace.instructions), ("data", trace.data)]:
+            for lines, ratio in miss_ratio_curve(distances):
+                writer.writerow([stream, lines, lines * trace.line_size, ratio])
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine single-pass cache sweep")
+    parser.add_argument("objfiles", nargs="+", help="Object files to sweep")
+    parser.add_argument("--line-size", type=int, default=4, help="Words per cache line")
+    parser.add_argument("--max-size", type=int, default=4096,
+                        help="Largest cache size in words (sizes are powers of two)")
+    parser.add_argument("--ways", default="1,2,4,8",
+                        help="Associativities to approximate, comma-separated")
+    parser.add_argument("--input", type=argparse.FileType('rb'),
+                        help="Console input for the programs")
+    parser.add_argument("--csv-dir",
+                        help="Write NAME.csv (table) and NAME.curve.csv (every size) here")
+    parser.add_argument("--capacity", type=int, default=512, help="Memory capacity in words")
+    return parser.parse_args()
+
+
+def main():
+    """Sweep cache sizes for each program"""
+    args = cli()
+    ways = [int(w) for w in args.ways.split(",")]
+    sizes = []
+    size = args.line_size
+    while size <= args.max_size:
+        sizes.append(size)
+        size *= 2
+    inputs = []
+    if args.input:
+        inputs = [int(token) for token in args.input.read().split()]
+    for path in args.objfiles:
+        with open(path) as objfile:
+            trace = sweep(objfile, args.line_size, args.capacity, inputs)
+        rows = sweep_table(trace, sizes, ways)
+        print(format_table(path, trace, rows, ways))
+        if args.csv_dir:
+            name = os.path.splitext(os.path.basename(path))[0]
+            write_csv(os.path.join(args.csv_dir, name + ".csv"), rows, ways)
+            write_curve_csv(os.path.join(args.csv_dir, name + ".curve.csv"), trace)
+
+
+if __name__ == "__main__":
+    main()
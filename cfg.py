@@ -0,0 +1,538 @@
+"""
+Control-flow graphs and dataflow analysis for Duck Machine code.
+
+A Program is a sequence of words, each either an Instruction or
+data (None).  build_cfg splits the code into basic blocks and
+links them:
+
+* An instruction that writes r15 is a branch.  If its target can
+  be computed from the instruction alone (r0, r15, and the
+  displacement, as in JUMP), there is an edge to it; otherwise
+  (LOAD r15, or arithmetic on other registers) the block is
+  marked computed and has no known successors.
+* A predicated branch or HALT may be skipped, so it also falls
+  through.  A branch or HALT predicated NEVER is just skipped.
+
+On the graph we compute dominators (Cooper, Harvey and Kennedy's
+iterative algorithm over reverse postorder), natural loops,
+register liveness, and reaching definitions.  Registers are
+numbered 0..15 as usual, and the condition code is register
+FLAGS (16): every executed instruction sets it, and every
+predicated instruction reads it.  A predicated instruction may
+not execute, so it uses its operands but does not kill earlier
+definitions.
+
+Register sets are bit masks, so liveness runs in time linear in
+the size of the program times the (small) number of passes.
+"""
+
+from instr_format import Instruction, OpCode, CondFlag, decode, instruction_from_dict
+from assembler_pass2 import AsmSrcKind, fill_defaults, parse_line
+
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import argparse
+import bisect
+import sys
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PC = 15
+FLAGS = 16                   # Pseudo-register for the condition code
+ALL_REGISTERS = (1 << 17) - 2   # Every register but r0
+
+
+class Program(object):
+    """Words of a program: code[addr] is an Instruction, or None
+    for data.  labels maps addresses to names, if known.
+    """
+
+    def __init__(self, code: List[Optional[Instruction]],
+                 words: List[int] = None, labels: Dict[int, str] = None,
+                 entry: int = 0) -> None:
+        self.code = code
+        self.words = words
+        self.labels = labels or {}
+        self.entry = entry
+
+    @classmethod
+    def from_image(cls, words: Sequence[int], entry: int = 0) -> "Program":
+        """Object code: words reachable from entry are decoded as
+        instructions; other words are data.
+        """
+        code = len(words) * [None]
+        work = [entry]
+        while work:
+            pc = work.pop()
+            while 0 <= pc < len(words) and code[pc] is None:
+                instr = decode(words[pc])
+                code[pc] = instr
+                targets, falls_through = successors(pc, instr)
+                work.extend(t for t in targets if t is not None)
+                if not falls_through:
+                    break
+                pc += 1
+        return cls(code, list(words), entry=entry)
+
+    @classmethod
+    def from_parsed(cls, lines: Iterable[dict], entry: int = 0) -> "Program":
+        """Parsed assembly, as dicts from assembler_pass2.parse_line
+        (fully resolved instructions, DATA, and comments)
+        """
+        code = []
+        labels = {}
+        for fields in lines:
+            if fields["label"]:
+                labels[len(code)] = fields["label"]
+            if fields["kind"] == AsmSrcKind.FULL:
+                fields = dict(fields)
+                fill_defaults(fields)
+                code.append(instruction_from_dict(fields))
+            elif fields["kind"] == AsmSrcKind.DATA:
+                code.append(None)
+        return cls(code, labels=labels, entry=entry)
+
+
+def writes(instr: Instruction) -> Optional[int]:
+    """The register an instruction writes, if any"""
+    if instr.op is OpCode.STORE or instr.op is OpCode.HALT:
+        return None
+    return instr.reg_target
+
+
+def successors(pc: int, instr: Instruction) -> Tuple[List[Optional[int]], bool]:
+    """Branch targets of the instruction at pc (None for a target
+    that cannot be known statically) and whether it may fall
+    through to pc + 1
+    """
+    cond = instr.cond
+    if cond is CondFlag.NEVER:
+        return [], True
+    conditional = cond is not CondFlag.ALWAYS
+    if instr.op is OpCode.HALT:
+        return [], conditional
+    if writes(instr) != PC:
+        return [], True
+    srcs = (instr.reg_src1, instr.reg_src2)
+    if instr.op is OpCode.LOAD or any(r not in (0, PC) for r in srcs):
+        return [None], conditional
+    val1 = pc if instr.reg_src1 == PC else 0
+    val2 = (pc if instr.reg_src2 == PC else 0) + instr.offset
+    if instr.op is OpCode.ADD:
+        target = val1 + val2
+    elif instr.op is OpCode.SUB:
+        target = val1 - val2
+    elif instr.op is OpCode.MUL:
+        target = val1 * val2
+    else:
+        target = val1 // val2 if val2 else 0
+    return [target], conditional
+
+
+def uses_and_defs(instr: Instruction) -> Tuple[int, int]:
+    """Bit masks of registers read and (certainly) written"""
+    use = (1 << instr.reg_src1) | (1 << instr.reg_src2)
+    if instr.op is OpCode.STORE:
+        use |= 1 << instr.reg_target
+    if instr.cond is CondFlag.NEVER:
+        return 0, 0
+    define = 0
+    if instr.cond is CondFlag.ALWAYS:
+        define = 1 << FLAGS
+        target = writes(instr)
+        if target is not None:
+            define |= 1 << target
+    else:
+        use |= 1 << FLAGS
+    # r0 is constant and r15 is the address of the instruction
+    mask = ~((1 << 0) | (1 << PC))
+    return use & mask, define & mask
+
+
+def defines(instr: Instruction) -> int:
+    """Bit mask of registers an instruction may write"""
+    if instr.cond is CondFlag.NEVER:
+        return 0
+    define = 1 << FLAGS
+    target = writes(instr)
+    if target is not None and target not in (0, PC):
+        define |= 1 << target
+    return define
+
+
+class Block(object):
+    """Instructions start .. end - 1, with no branches in or out
+    except at the ends
+    """
+
+    def __init__(self, index: int, start: int, end: int) -> None:
+        self.index = index
+        self.start = start
+        self.end = end
+        self.succs = []       # Block indexes
+        self.preds = []
+        self.computed = False   # Ends in a jump to an unknown target
+        self.exits = False      # May halt, or run off the end of the code
+
+    def __repr__(self) -> str:
+        return "Block({}, {}..{})".format(self.index, self.start, self.end - 1)
+
+
+class Loop(object):
+    """A natural loop: its header dominates every block in it"""
+
+    def __init__(self, header: int, blocks: Set[int], back_edges: List[Tuple[int, int]]) -> None:
+        self.header = header
+        self.blocks = blocks
+        self.back_edges = back_edges
+
+    def __repr__(self) -> str:
+        return "Loop(header={}, blocks={})".format(self.header, sorted(self.blocks))
+
+
+class CFG(object):
+    """Basic blocks of a Program and the analyses over them"""
+
+    def __init__(self, program: Program) -> None:
+        self.program = program
+        self.blocks = []
+        self.block_at = {}     # Start address -> block index
+        self.entry = None
+        self._build()
+        self._starts = [block.start for block in self.blocks]
+        self._dominators = None
+        self._dom_numbers = None
+        self._liveness = None
+
+    def _build(self) -> None:
+        code = self.program.code
+        n = len(code)
+        leaders = set()
+        if 0 <= self.program.entry < n and code[self.program.entry] is not None:
+            leaders.add(self.program.entry)
+        for pc, instr in enumerate(code):
+            if instr is None:
+                continue
+            if pc == 0 or code[pc - 1] is None:
+                leaders.add(pc)
+            targets, falls_through = successors(pc, instr)
+            if targets or not falls_through:
+                leaders.add(pc + 1)
+            for t in targets:
+                if t is not None and 0 <= t < n and code[t] is not None:
+                    leaders.add(t)
+        starts = sorted(addr for addr in leaders if addr < n and code[addr] is not None)
+        for i, start in enumerate(starts):
+            end = start + 1
+            limit = starts[i + 1] if i + 1 < len(starts) else n
+            while end < limit and code[end] is not None:
+                end += 1
+            self.block_at[start] = len(self.blocks)
+            self.blocks.append(Block(len(self.blocks), start, end))
+        for block in self.blocks:
+            last = block.end - 1
+            targets, falls_through = successors(last, code[last])
+            for t in targets:
+                if t is None:
+                    block.computed = True
+                elif t in self.block_at:
+                    self._link(block, self.block_at[t])
+                else:
+                    block.exits = True   # Into data or outside the code
+            if code[last].op is OpCode.HALT and code[last].cond is not CondFlag.NEVER:
+                block.exits = True
+            if falls_through:
+                if block.end in self.block_at:
+                    self._link(block, self.block_at[block.end])
+                else:
+                    block.exits = True
+        self.entry = self.block_at.get(self.program.entry)
+
+    def _link(self, block: Block, succ: int) -> None:
+        if succ not in block.succs:
+            block.succs.append(succ)
+            self.blocks[succ].preds.append(block.index)
+
+    def instructions(self, block: Block) -> List[Tuple[int, Instruction]]:
+        code = self.program.code
+        return [(pc, code[pc]) for pc in range(block.start, block.end)]
+
+    # Dominators and loops
+
+    def reverse_postorder(self) -> List[int]:
+        """Blocks reachable from the entry, in reverse postorder"""
+        if self.entry is None:
+            return []
+        order = []
+        visited = {self.entry}
+        stack = [(self.entry, iter(self.blocks[self.entry].succs))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child not in visited:
+                    visited.add(child)
+                    stack.append((child, iter(self.blocks[child].succs)))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        order.reverse()
+        return order
+
+    def dominators(self) -> Dict[int, int]:
+        """Immediate dominator of each reachable block (the entry
+        is its own)
+        """
+        if self._dominators is not None:
+            return self._dominators
+        order = self.reverse_postorder()
+        rank = {b: i for i, b in enumerate(order)}
+        idom = {}
+        if order:
+            idom[order[0]] = order[0]
+
+        def intersect(a: int, b: int) -> int:
+            while a != b:
+                while rank[a] > rank[b]:
+                    a = idom[a]
+                while rank[b] > rank[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for b in order[1:]:
+                new = None
+                for p in self.blocks[b].preds:
+                    if p in idom:
+                        new = p if new is None else intersect(p, new)
+                if idom.get(b) != new:
+                    idom[b] = new
+                    changed = True
+        self._dominators = idom
+        return idom
+
+    def dominates(self, a: int, b: int) -> bool:
+        """Does block a dominate block b?  Constant time, by the
+        preorder and postorder numbers of the dominator tree.
+        """
+        if self._dom_numbers is None:
+            idom = self.dominators()
+            children = {}
+            for node, parent in idom.items():
+                if node != parent:
+                    children.setdefault(parent, []).append(node)
+            pre, post = {}, {}
+            counter = 0
+            stack = [(self.entry, False)] if self.entry in idom else []
+            while stack:
+                node, done = stack.pop()
+                if done:
+                    post[node] = counter
+                else:
+                    pre[node] = counter
+                    stack.append((node, True))
+                    stack.extend((child, False) for child in children.get(node, []))
+                counter += 1
+            self._dom_numbers = pre, post
+        pre, post = self._dom_numbers
+        if a not in pre or b not in pre:
+            return False
+        return pre[a] <= pre[b] and post[b] <= post[a]
+
+    def loops(self) -> List[Loop]:
+        """Natural loops, one per header, outermost first"""
+        idom = self.dominators()
+        by_header = {}
+        for b in idom:
+            for s in self.blocks[b].succs:
+                if self.dominates(s, b):
+                    by_header.setdefault(s, []).append((b, s))
+        loops = []
+        for header, back_edges in by_header.items():
+            body = {header}
+            work = [tail for tail, head in back_edges if tail != header]
+            body.update(work)
+            while work:
+                node = work.pop()
+                for p in self.blocks[node].preds:
+                    if p not in body and p in idom:
+                        body.add(p)
+                        work.append(p)
+            loops.append(Loop(header, body, back_edges))
+        loops.sort(key=lambda loop: -len(loop.blocks))
+        return loops
+
+    # Dataflow
+
+    def _block_use_def(self) -> Tuple[List[int], List[int]]:
+        uses, defs = [], []
+        for block in self.blocks:
+            use = define = 0
+            for pc, instr in self.instructions(block):
+                u, d = uses_and_defs(instr)
+                use |= u & ~define
+                define |= d
+            uses.append(use)
+            defs.append(define)
+        return uses, defs
+
+    def liveness(self) -> Tuple[List[int], List[int]]:
+        """Registers live into and out of each block, as bit masks
+        (bit FLAGS for the condition code).  Nothing is live after
+        a HALT; everything is live after a computed jump.
+        """
+        if self._liveness is not None:
+            return self._liveness
+        uses, defs = self._block_use_def()
+        live_in = len(self.blocks) * [0]
+        live_out = len(self.blocks) * [0]
+        work = list(range(len(self.blocks)))
+        queued = set(work)
+        while work:
+            b = work.pop()
+            queued.discard(b)
+            block = self.blocks[b]
+            out = ALL_REGISTERS if block.computed else 0
+            for s in block.succs:
+                out |= live_in[s]
+            live_out[b] = out
+            new_in = uses[b] | (out & ~defs[b])
+            if new_in != live_in[b]:
+                live_in[b] = new_in
+                for p in block.preds:
+                    if p not in queued:
+                        queued.add(p)
+                        work.append(p)
+        self._liveness = live_in, live_out
+        return self._liveness
+
+    def live_after(self, pc: int) -> int:
+        """Registers live just after the instruction at pc"""
+        block = self.blocks[self.block_containing(pc)]
+        live = self.liveness()[1][block.index]
+        for addr in range(block.end - 1, pc, -1):
+            use, define = uses_and_defs(self.program.code[addr])
+            live = use | (live & ~define)
+        return live
+
+    def block_containing(self, pc: int) -> int:
+        return bisect.bisect_right(self._starts, pc) - 1
+
+    def reaching_definitions(self) -> Tuple[List[Tuple[int, int]], List[int], List[int]]:
+        """Definitions (address, register) and, for each block, the
+        bit sets (over the definition list) reaching its entry and
+        exit.  Definitions by predicated instructions reach but do
+        not kill.
+        """
+        definitions = []
+        by_register = {}
+        gen, kill_regs = [], []
+        for block in self.blocks:
+            g = 0
+            k = 0
+            for pc, instr in self.instructions(block):
+                regs = defines(instr)
+                certain = uses_and_defs(instr)[1]
+                for r in range(17):
+                    if regs >> r & 1:
+                        if certain >> r & 1:
+                            g &= ~by_register.get(r, 0)
+                        i = len(definitions)
+                        definitions.append((pc, r))
+                        by_register[r] = by_register.get(r, 0) | (1 << i)
+                        g |= 1 << i
+                k |= certain
+            gen.append(g)
+            kill_regs.append(k)
+        kill = []
+        for k in kill_regs:
+            mask = 0
+            for r in range(17):
+                if k >> r & 1:
+                    mask |= by_register.get(r, 0)
+            kill.append(mask)
+        # Gen within a block wins over its own kill
+        reach_in = len(self.blocks) * [0]
+        reach_out = list(gen)
+        work = list(range(len(self.blocks)))
+        queued = set(work)
+        while work:
+            b = work.pop()
+            queued.discard(b)
+            new_in = 0
+            for p in self.blocks[b].preds:
+                new_in |= reach_out[p]
+            reach_in[b] = new_in
+            new_out = gen[b] | (new_in & ~kill[b])
+            if new_out != reach_out[b]:
+                reach_out[b] = new_out
+                for s in self.blocks[b].succs:
+                    if s not in queued:
+                        queued.add(s)
+                        work.append(s)
+        return definitions, reach_in, reach_out
+
+
+def register_names(mask: int) -> List[str]:
+    """Names of the registers in a bit mask"""
+    return ["cc" if r == FLAGS else "r{}".format(r) for r in range(17) if mask >> r & 1]
+
+
+def build_cfg(program: Program) -> CFG:
+    return CFG(program)
+
+
+def to_dot(cfg: CFG, name: str = "cfg") -> str:
+    """GraphViz DOT text for the graph; loop back edges are dashed,
+    computed jumps point to a '?' node
+    """
+    labels = cfg.program.labels
+    back = {edge for loop in cfg.loops() for edge in loop.back_edges}
+    lines = ["digraph {} {{".format(name), '  node [shape=box, fontname="monospace"];']
+    for block in cfg.blocks:
+        text = []
+        for pc, instr in cfg.instructions(block):
+            label = labels.get(pc)
+            text.append("{}{:>5}: {}".format(label + ":\\l" if label else "", pc, instr))
+        lines.append('  b{} [label="{}\\l"];'.format(block.index, "\\l".join(text)))
+        for s in block.succs:
+            style = " [style=dashed]" if (block.index, s) in back else ""
+            lines.append("  b{} -> b{}{};".format(block.index, s, style))
+        if block.computed:
+            lines.append('  b{}_computed [label="?", shape=circle];'.format(block.index))
+            lines.append("  b{0} -> b{0}_computed;".format(block.index))
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine control-flow graph")
+    parser.add_argument("source", type=argparse.FileType('r'),
+                        help="Object code (.obj), or fully resolved assembly code")
+    parser.add_argument("dotfile", type=argparse.FileType('w'), nargs="?",
+                        default=sys.stdout, help="DOT output")
+    return parser.parse_args()
+
+
+def main():
+    """Write the control-flow graph of a program as DOT"""
+    args = cli()
+    if args.source.name.endswith(".obj"):
+        program = Program.from_image([int(word) for word in args.source.read().split()])
+    else:
+        program = Program.from_parsed(parse_line(line.rstrip("\n")) for line in args.source)
+    graph = build_cfg(program)
+    for loop in graph.loops():
+        log.info("Loop at {}: blocks {}".format(
+            graph.blocks[loop.header].start, sorted(loop.blocks)))
+    print(to_dot(graph), file=args.dotfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,9 @@ from register import Register, ZeroRegister
 from alu import ALU
 from mvc import MVCEvent, MVCListenable
 
+from typing import Callable, List
+
+import heapq
 import logging
 
 logging.basicConfig()
@@ -26,6 +29,18 @@ class CPUStep(MVCEvent):
         self.instr = instr
 
 
+class Trap(Exception):
+    """Raised by memory (e.g. an MMU) to abandon the current
+    instruction and continue at a handler address.  The CPU
+    remembers where it was, so the handler can resume the
+    instruction with resume().
+    """
+
+    def __init__(self, handler: int, message: str = "") -> None:
+        super().__init__(message)
+        self.handler = handler
+
+
 class CPU(MVCListenable):
     '''
     Contains 16 registers (register 0 will always be of type
@@ -45,64 +60,245 @@ class CPU(MVCListenable):
         self.halted = False
         self.program_pointer = self.registers[15]
         self.alu = ALU()
+        # Performance counters
+        self.step_count = 0
+        self.loads = 0
+        self.stores = 0
+        self.skips = 0
+        # Event wheel: heap of [step count, sequence, action] entries,
+        # checked only when the step count reaches next_event.
+        # Cancelled entries have action None and are dropped lazily.
+        self._events = []
+        self._event_seq = 0
+        self._cancelled = 0
+        self.next_event = float("inf")
+        # Where the last trap happened, for resume()
+        self.trap_pc = None
+        self.trap_flags = None
+
+    def schedule(self, delay: int, action: Callable[[], None]) -> list:
+        """Call action after delay more steps.  Returns a handle
+        for cancel().
+        """
+        entry = [self.step_count + max(delay, 1), self._event_seq, action]
+        heapq.heappush(self._events, entry)
+        self._event_seq += 1
+        self.next_event = self._events[0][0]
+        return entry
+
+    def cancel(self, entry: list) -> None:
+        """Cancel a scheduled action that has not yet happened"""
+        if entry[2] is None:
+            return
+        entry[2] = None
+        self._cancelled += 1
+        if self._cancelled > len(self._events) // 2:
+            # Mostly dead entries; rebuild the heap without them
+            self._events = [e for e in self._events if e[2] is not None]
+            heapq.heapify(self._events)
+            self._cancelled = 0
+        self._drop_cancelled()
+
+    def _drop_cancelled(self) -> None:
+        while self._events and self._events[0][2] is None:
+            heapq.heappop(self._events)
+            self._cancelled -= 1
+        self.next_event = self._events[0][0] if self._events else float("inf")
+
+    def _fire_events(self) -> None:
+        """Call the actions that are due"""
+        while self._events and self._events[0][0] <= self.step_count:
+            entry = heapq.heappop(self._events)
+            action = entry[2]
+            if action is None:
+                self._cancelled -= 1
+            else:
+                entry[2] = None
+                action()
+        self._drop_cancelled()
+
+    def will_execute(self, instr: Instruction) -> bool:
+        """Does the predicate of instr hold for the current condition
+        code?  Listeners to CPUStep events may use this, since the
+        event is announced before the instruction executes.
+        """
+        return bool(self.cond_flag & instr.cond)
+
+    def effective_address(self, instr: Instruction) -> int:
+        """The address a LOAD or STORE of instr will use, from the
+        current register values.  Like will_execute, this is for
+        listeners to CPUStep events.
+        """
+        return (self.registers[instr.reg_src1].get() +
+                self.registers[instr.reg_src2].get() + instr.offset)
 
     def step(self) -> None:
         '''Fetches instructions in memory. Decodes instruction word. Determines if
         instruction should be executed or skipped. Executes if applicable.
         '''
-        #fetch
         address = self.program_pointer.get()
-        instruction_word = self.memory.get(address)
+        flags = self.cond_flag
+        try:
+            #fetch
+            instruction_word = self.memory.get(address)
 
-        #decode
-        decoded_word = decode(instruction_word)
+            #decode
+            decoded_word = decode(instruction_word)
 
-        self.notify_all(CPUStep(self, address, instruction_word, decoded_word))
+            self.notify_all(CPUStep(self, address, instruction_word, decoded_word))
 
-        #execute
-        predicate = self.cond_flag & decoded_word.cond
+            #execute
+            predicate = self.cond_flag & decoded_word.cond
 
-        if predicate:
-            # get values for source registers
-            val1 = self.registers[decoded_word.reg_src1].get()
-            val2 = self.registers[decoded_word.reg_src2].get()
+            if predicate:
+                # get values for source registers
+                val1 = self.registers[decoded_word.reg_src1].get()
+                val2 = self.registers[decoded_word.reg_src2].get()
 
-            # add offset to register
-            val2 =  val2 + decoded_word.offset
+                # add offset to register
+                val2 =  val2 + decoded_word.offset
 
-            #increment program counter
-            self.program_pointer.put(self.program_pointer.get() + 1)
+                #increment program counter
+                self.program_pointer.put(self.program_pointer.get() + 1)
 
-            #sending op code to ALU to execute with 2 values
-            result, self.cond_flag = self.alu.exec(decoded_word.op, val1, val2)
+                #sending op code to ALU to execute with 2 values
+                result, self.cond_flag = self.alu.exec(decoded_word.op, val1, val2)
 
-            if decoded_word.op == OpCode.HALT:
-                self.halted = True
+                if decoded_word.op == OpCode.HALT:
+                    self.halted = True
 
-            #load
-            elif decoded_word.op == OpCode.LOAD:
-                self.registers[decoded_word.reg_target].put(self.memory.get(result))
+                #load
+                elif decoded_word.op == OpCode.LOAD:
+                    value = self.memory.get(result)
+                    self.loads += 1
+                    self.registers[decoded_word.reg_target].put(value)
 
-            #store
-            elif decoded_word.op == OpCode.STORE:
-                self.memory.put(result, self.registers[decoded_word.reg_target].get())
+                #store
+                elif decoded_word.op == OpCode.STORE:
+                    self.memory.put(result, self.registers[decoded_word.reg_target].get())
+                    self.stores += 1
 
+                else:
+                    self.registers[decoded_word.reg_target].put(result)
             else:
-                self.registers[decoded_word.reg_target].put(result)
-        else:
-            self.program_pointer.put(self.program_pointer.get() + 1)
+                self.skips += 1
+                self.program_pointer.put(self.program_pointer.get() + 1)
+        except Trap as trap:
+            # Abandon the instruction as if it had not started
+            self.trap_pc = address
+            self.trap_flags = flags
+            self.cond_flag = flags
+            self.program_pointer.put(trap.handler)
+
+    def resume(self) -> None:
+        """Return from a trap handler to retry the trapped instruction"""
+        self.program_pointer.put(self.trap_pc)
+        self.cond_flag = self.trap_flags
+
+    def cycle(self) -> None:
+        """One turn of the run loop: a step, then any events due.
+        For other run loops, such as the debugger's.
+        """
+        self.step()
+        self.step_count += 1
+        if self.step_count >= self.next_event:
+            self._fire_events()
+
+    def fast_mode_problems(self, verified, from_addr: int = 0) -> List[str]:
+        """Reasons the verified program (see verifier.py) cannot run
+        unchecked on this CPU from from_addr; empty if it can.
+        """
+        if not verified.ok:
+            return list(verified.reasons)
+        problems = []
+        memory = self.memory
+        ram = getattr(memory, "_mem", None)
+        if type(ram) is not list:
+            problems.append("memory is not a plain list of words")
+        elif ram[:verified.length] != verified.words:
+            problems.append("memory does not hold the verified program")
+        if getattr(memory, "capacity", None) != verified.capacity:
+            problems.append("memory capacity differs from the verified capacity")
+        if (getattr(memory, "io_base", 0), getattr(memory, "io_end", 0)) != verified.io_span:
+            problems.append("device windows differ from the verified ones")
+        if any(device.writes_memory for device in getattr(memory, "devices", list)()):
+            problems.append("a device (DMA) may change memory")
+        if self.listeners or getattr(memory, "listeners", None):
+            problems.append("listeners need every step and memory access announced")
+        if from_addr != verified.entry:
+            problems.append("verified from {}, not {}".format(verified.entry, from_addr))
+        if (any(reg.get() for reg in self.registers[:15]) or
+                self.cond_flag is not CondFlag.ALWAYS or self.halted):
+            problems.append("the CPU is not freshly reset")
+        return problems
 
-    def run(self, from_addr=0, single_step=False) -> None:
+    def _run_verified(self, verified) -> None:
+        """The run loop for a verified program: each instruction is
+        decoded once, and RAM is indexed directly without bounds
+        checks or events.  Device addresses still go through memory.
+        """
+        program = verified.instructions
+        memory = self.memory
+        ram = memory._mem
+        io_base, io_end = verified.io_span
+        registers = self.registers
+        pc_register = self.program_pointer
+        alu = self.alu
+        HALT, LOAD, STORE = OpCode.HALT, OpCode.LOAD, OpCode.STORE
+        while not self.halted:
+            pc = pc_register.get()
+            instr = program[pc]
+            if self.cond_flag & instr.cond:
+                val1 = registers[instr.reg_src1].get()
+                val2 = registers[instr.reg_src2].get() + instr.offset
+                pc_register.put(pc + 1)
+                op = instr.op
+                result, self.cond_flag = alu.exec(op, val1, val2)
+                if op is HALT:
+                    self.halted = True
+                elif op is LOAD:
+                    if io_base <= result < io_end:
+                        value = memory.get(result)
+                    else:
+                        value = ram[result]
+                    self.loads += 1
+                    registers[instr.reg_target].put(value)
+                elif op is STORE:
+                    value = registers[instr.reg_target].get()
+                    if io_base <= result < io_end:
+                        memory.put(result, value)
+                    else:
+                        ram[result] = value
+                    self.stores += 1
+                else:
+                    registers[instr.reg_target].put(result)
+            else:
+                self.skips += 1
+                pc_register.put(pc + 1)
+            self.step_count += 1
+            if self.step_count >= self.next_event:
+                self._fire_events()
+
+    def run(self, from_addr=0, single_step=False, verified=None) -> None:
         ''' Calls step method until it executes the HALT instruction.
         Allows the option of a single-step mode for debugging.
+        A program verified by verifier.py runs in a faster unchecked
+        mode, if nothing has changed since it was verified; otherwise
+        it runs checked, and the reasons are logged.
         '''
         self.program_pointer.put(from_addr)
 
-        step_count = 0
+        if verified is not None and not single_step:
+            problems = self.fast_mode_problems(verified, from_addr)
+            if not problems:
+                self._run_verified(verified)
+                return
+            log.info("Running checked: {}".format("; ".join(problems)))
 
         while not self.halted:
             if single_step:
-                input("Step {}; press enter".format(step_count))
+                input("Step {}; press enter".format(self.step_count))
             self.step()
-            step_count += 1
-
+            self.step_count += 1
+            if self.step_count >= self.next_event:
+                self._fire_events()
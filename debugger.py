@@ -0,0 +1,258 @@
+"""
+Breakpoints and watchpoints for the Duck Machine.
+
+A Debugger runs a CPU in its own loop, which checks the program
+counter against a set of breakpoint addresses before each step;
+with no breakpoints or watchpoints it just calls CPU.run, so
+plain runs pay nothing.  A conditional breakpoint is an
+expression over registers and condition flags, e.g.
+
+    r1 == 0 and not Z
+    pc > 100 or r2 * 2 >= r3
+
+compiled once to a Python function when it is set.
+
+Watchpoints are ranges of memory addresses.  While any are set,
+the CPU's memory is wrapped in a WatchedMemory, which looks up
+each address in an index of the watched ranges: one comparison
+for addresses outside all of them, a binary search otherwise.
+Read watchpoints also see instruction fetches.
+"""
+
+from cpu import CPU
+
+from typing import Callable, List, Optional
+
+import ast
+import bisect
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+WATCH_KINDS = ["read", "write", "change"]
+
+FLAG_NAMES = {"M": 1, "Z": 2, "P": 4, "V": 8}
+
+
+class BreakpointError(Exception):
+    """A breakpoint condition we cannot compile"""
+    pass
+
+
+class _Compiler(ast.NodeTransformer):
+    """Rewrites a condition to use R (the registers) and F (the
+    condition code value), rejecting anything but arithmetic,
+    comparisons, and logic on register and flag names.
+    """
+    ALLOWED = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+               ast.USub, ast.UAdd, ast.Invert, ast.BinOp, ast.Add, ast.Sub, ast.Mult,
+               ast.FloorDiv, ast.Mod, ast.BitAnd, ast.BitOr, ast.BitXor,
+               ast.LShift, ast.RShift, ast.Compare, ast.Eq, ast.NotEq, ast.Lt,
+               ast.LtE, ast.Gt, ast.GtE, ast.Load)
+
+    def generic_visit(self, node):
+        if not isinstance(node, self.ALLOWED):
+            raise BreakpointError("{} not allowed in a breakpoint condition"
+                                  .format(type(node).__name__))
+        return super().generic_visit(node)
+
+    def visit_Constant(self, node):
+        if type(node.value) is not int:
+            raise BreakpointError("Only integer constants are allowed, not {!r}"
+                                  .format(node.value))
+        return node
+
+    def visit_Name(self, node):
+        name = node.id
+        if name in FLAG_NAMES:
+            # (F & bit) != 0
+            expr = ast.Compare(
+                left=ast.BinOp(left=ast.Name(id="F", ctx=ast.Load()), op=ast.BitAnd(),
+                               right=ast.Constant(value=FLAG_NAMES[name])),
+                ops=[ast.NotEq()], comparators=[ast.Constant(value=0)])
+        else:
+            if name == "pc":
+                reg = 15
+            elif name[:1] == "r" and name[1:].isdigit() and int(name[1:]) < 16:
+                reg = int(name[1:])
+            else:
+                raise BreakpointError("Unknown name {} in a breakpoint condition".format(name))
+            # R[reg].get()
+            expr = ast.Call(
+                func=ast.Attribute(
+                    value=ast.Subscript(value=ast.Name(id="R", ctx=ast.Load()),
+                                        slice=ast.Constant(value=reg), ctx=ast.Load()),
+                    attr="get", ctx=ast.Load()),
+                args=[], keywords=[])
+        return ast.copy_location(expr, node)
+
+
+def compile_condition(text: str) -> Callable[[list, int], bool]:
+    """Compile a condition to a function of the registers and the
+    condition code value
+    """
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError as e:
+        raise BreakpointError("Bad breakpoint condition '{}': {}".format(text, e))
+    body = _Compiler().visit(tree).body
+    args = ast.arguments(posonlyargs=[], args=[ast.arg(arg="R"), ast.arg(arg="F")],
+                         kwonlyargs=[], kw_defaults=[], defaults=[])
+    func = ast.Expression(body=ast.Lambda(args=args, body=body))
+    ast.fix_missing_locations(func)
+    return eval(compile(func, "<breakpoint {}>".format(text), "eval"), {"__builtins__": {}})
+
+
+class Watchpoint(object):
+    """Addresses low up to (not including) high"""
+
+    def __init__(self, low: int, high: int, kind: str = "write") -> None:
+        if kind not in WATCH_KINDS:
+            raise ValueError("Unknown watchpoint kind {}; choose from {}"
+                             .format(kind, ", ".join(WATCH_KINDS)))
+        if high <= low:
+            raise ValueError("Empty watchpoint range {}..{}".format(low, high))
+        self.low = low
+        self.high = high
+        self.kind = kind
+
+    def __str__(self) -> str:
+        return "{} watchpoint {}..{}".format(self.kind, self.low, self.high - 1)
+
+
+class Stop(object):
+    """Why the debugger stopped the CPU"""
+
+    def __init__(self, pc: int, reason: str, watchpoint: Watchpoint = None,
+                 addr: int = None, old: int = None, new: int = None) -> None:
+        self.pc = pc
+        self.reason = reason
+        self.watchpoint = watchpoint
+        self.addr = addr
+        self.old = old
+        self.new = new
+
+    def __str__(self) -> str:
+        if self.watchpoint is None:
+            return "{} at {}".format(self.reason, self.pc)
+        return "{} at {}: address {} {} -> {}".format(
+            self.watchpoint, self.pc, self.addr, self.old, self.new)
+
+
+class WatchedMemory(object):
+    """Wraps a memory (or MMU) and records accesses to watched
+    addresses.  The index is the sorted boundaries of the watched
+    ranges; the segment between two boundaries has the list of
+    watchpoints covering it.
+    """
+
+    def __init__(self, memory, watchpoints: List[Watchpoint]) -> None:
+        self.memory = memory
+        self.hits = []   # (watchpoint, addr, old, new)
+        bounds = sorted({w.low for w in watchpoints} | {w.high for w in watchpoints})
+        self._bounds = bounds
+        self._segments = [[w for w in watchpoints if w.low <= start < w.high]
+                          for start in bounds]
+        self.low = bounds[0]
+        self.high = bounds[-1]
+
+    def _watching(self, addr: int) -> List[Watchpoint]:
+        return self._segments[bisect.bisect_right(self._bounds, addr) - 1]
+
+    def get(self, addr: int) -> int:
+        value = self.memory.get(addr)
+        if self.low <= addr < self.high:
+            for w in self._watching(addr):
+                if w.kind == "read":
+                    self.hits.append((w, addr, value, value))
+        return value
+
+    def put(self, addr: int, value: int) -> None:
+        if not self.low <= addr < self.high:
+            self.memory.put(addr, value)
+            return
+        watching = self._watching(addr)
+        old = None
+        if any(w.kind == "change" for w in watching):
+            old = self.memory.get(addr)
+        self.memory.put(addr, value)
+        for w in watching:
+            if w.kind == "write" or (w.kind == "change" and old != value):
+                self.hits.append((w, addr, old, value))
+
+
+class Debugger(object):
+    """Runs a CPU, stopping at breakpoints and watchpoints"""
+
+    def __init__(self, cpu: CPU) -> None:
+        self.cpu = cpu
+        self.memory = cpu.memory
+        self.breakpoints = {}   # Address -> list of conditions, None for always
+        self.watchpoints = []
+        self._watched = None
+        self._resume_pc = None  # Do not stop here again at once
+
+    def add_breakpoint(self, addr: int, condition: str = None) -> None:
+        """Stop before executing the instruction at addr, if the
+        condition (see compile_condition) holds
+        """
+        check = compile_condition(condition) if condition else None
+        self.breakpoints.setdefault(addr, []).append(check)
+
+    def remove_breakpoint(self, addr: int) -> None:
+        self.breakpoints.pop(addr, None)
+
+    def add_watchpoint(self, low: int, high: int = None, kind: str = "write") -> Watchpoint:
+        watchpoint = Watchpoint(low, high if high is not None else low + 1, kind)
+        self.watchpoints.append(watchpoint)
+        self._install()
+        return watchpoint
+
+    def remove_watchpoint(self, watchpoint: Watchpoint) -> None:
+        self.watchpoints.remove(watchpoint)
+        self._install()
+
+    def _install(self) -> None:
+        """Wrap the memory in a fresh index, or unwrap it"""
+        if self.watchpoints:
+            self._watched = WatchedMemory(self.memory, self.watchpoints)
+            self.cpu.memory = self._watched
+        else:
+            self._watched = None
+            self.cpu.memory = self.memory
+
+    def _break_here(self, pc: int) -> bool:
+        registers = self.cpu.registers
+        flags = self.cpu.cond_flag.value
+        for check in self.breakpoints[pc]:
+            if check is None or check(registers, flags):
+                return True
+        return False
+
+    def run(self, from_addr: int = None) -> Optional[Stop]:
+        """Run until the CPU halts (returning None) or a breakpoint
+        or watchpoint stops it.  Call again to continue.
+        """
+        cpu = self.cpu
+        if not self.breakpoints and not self.watchpoints:
+            cpu.run(from_addr if from_addr is not None else cpu.program_pointer.get())
+            return None
+        if from_addr is not None:
+            cpu.program_pointer.put(from_addr)
+        breakpoints = self.breakpoints
+        watched = self._watched
+        pc_register = cpu.program_pointer
+        while not cpu.halted:
+            pc = pc_register.get()
+            if pc in breakpoints and pc != self._resume_pc and self._break_here(pc):
+                self._resume_pc = pc
+                return Stop(pc, "breakpoint")
+            self._resume_pc = None
+            cpu.cycle()
+            if watched is not None and watched.hits:
+                watchpoint, addr, old, new = watched.hits[0]
+                watched.hits.clear()
+                return Stop(pc, "watchpoint", watchpoint, addr, old, new)
+        return None
@@ -0,0 +1,392 @@
+"""
+Devices for the Duck Machine memory bus.
+
+Each device is attached to a window of addresses of a
+MemoryMappedIO memory, and is triggered by ordinary
+LOAD and STORE instructions.
+"""
+
+from memory import Device, MemoryMappedIO, SegFault, WORD_BYTES, to_word, to_word_array
+
+from typing import Iterable, List, Sequence, Tuple, Union
+
+import array
+import io
+import mmap
+import time
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+class ConsoleIn(Device):
+    """Non-interactive console input.  Every read of the device
+    address produces the next value from a source, which may be a
+    binary file or pipe, or simply a sequence of integers.  With text
+    framing the source holds integers separated by whitespace; with
+    binary framing it holds signed 32-bit words in native byte order,
+    like MappedMemory images and BlockStorage files.  The
+    source is read in large chunks, not a value at a time.
+
+    When the input is exhausted, reads return eof_value, or raise
+    EOFError if eof_value is None.
+    """
+
+    def __init__(self, source: Union[io.IOBase, Iterable[int]],
+                 binary: bool = False, eof_value: int = None,
+                 chunk_size: int = 1 << 16) -> None:
+        self.binary = binary
+        self.eof_value = eof_value
+        self.chunk_size = chunk_size
+        self.values = 0   # Values transferred
+        self.bytes = 0    # Bytes read from the source
+        self._partial = b""
+        if hasattr(source, "read"):
+            self._file = source
+            self._buffer = []
+        else:
+            self._file = None
+            self._buffer = list(source)
+        self._pos = 0
+
+    def _refill(self) -> bool:
+        """Read the next chunk of values; False at end of input"""
+        while self._file is not None:
+            data = self._file.read(self.chunk_size)
+            self.bytes += len(data)
+            if not data:
+                self._file = None
+                self._buffer = self._words(self._partial, True)
+            else:
+                self._buffer = self._words(self._partial + data, False)
+            self._pos = 0
+            if self._buffer:
+                return True
+        return False
+
+    def _words(self, data: bytes, at_end: bool) -> List[int]:
+        """Decode the complete values in data, keeping any
+        incomplete value at the end for the next chunk
+        """
+        if self.binary:
+            whole = len(data) - len(data) % WORD_BYTES
+            if at_end and whole < len(data):
+                log.warning("Ignoring {} trailing bytes of binary input"
+                            .format(len(data) - whole))
+            self._partial = data[whole:]
+            return array.array("i", data[:whole]).tolist()
+        tokens = data.split()
+        if tokens and not at_end and not data[-1:].isspace():
+            self._partial = tokens.pop()
+        else:
+            self._partial = b""
+        return [int(token) for token in tokens]
+
+    def read(self, offset: int) -> int:
+        if self._pos >= len(self._buffer) and not self._refill():
+            if self.eof_value is None:
+                raise EOFError("Console input exhausted after {} values"
+                               .format(self.values))
+            return self.eof_value
+        value = self._buffer[self._pos]
+        self._pos += 1
+        self.values += 1
+        return value
+
+    def read_block(self, offset: int, count: int) -> List[int]:
+        block = []
+        while len(block) < count:
+            if self._pos >= len(self._buffer) and not self._refill():
+                block.append(self.read(offset))
+                continue
+            take = self._buffer[self._pos:self._pos + count - len(block)]
+            self._pos += len(take)
+            self.values += len(take)
+            block.extend(take)
+        return block
+
+    def write(self, offset: int, value: int) -> None:
+        log.warning("Ignoring write of {} to console input".format(value))
+
+
+class ConsoleOut(Device):
+    """Buffered console output.  Values written to the device
+    address are collected and written to a binary sink (file,
+    pipe, or sys.stdout.buffer) block_size values at a time.
+    Call flush() when the machine halts.  Text framing writes
+    each value formatted by template; binary framing writes
+    signed 32-bit words in native byte order.
+    """
+
+    def __init__(self, sink: io.IOBase, binary: bool = False,
+                 template: str = "{}\n", block_size: int = 4096) -> None:
+        self.sink = sink
+        self.binary = binary
+        self.template = template
+        self.block_size = block_size
+        self.values = 0   # Values transferred
+        self.bytes = 0    # Bytes written to the sink
+        self._buffer = []
+
+    def read(self, offset: int) -> int:
+        log.warning("Read from console output returns 0")
+        return 0
+
+    def write(self, offset: int, value: int) -> None:
+        self._buffer.append(value)
+        if len(self._buffer) >= self.block_size:
+            self.flush()
+
+    def write_block(self, offset: int, words: Sequence[int]) -> None:
+        self._buffer.extend(words)
+        if len(self._buffer) >= self.block_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write out everything buffered so far"""
+        if not self._buffer:
+            return
+        if self.binary:
+            data = to_word_array(self._buffer).tobytes()
+        else:
+            template = self.template
+            data = "".join([template.format(value) for value in self._buffer]).encode()
+        self.sink.write(data)
+        self.sink.flush()
+        self.values += len(self._buffer)
+        self.bytes += len(data)
+        self._buffer = []
+
+
+class BlockStorage(object):
+    """A disk-like store of fixed-size blocks of 32-bit words,
+    kept in a host file that is memory-mapped, so only the blocks
+    actually transferred are read or written.  The file holds
+    signed 32-bit words in native byte order, like a MappedMemory
+    image.  With shared=False, changes are not written back.
+    """
+
+    def __init__(self, path: str, block_size: int = 256,
+                 shared: bool = True) -> None:
+        self.path = path
+        self.block_size = block_size
+        access = mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY
+        with open(path, "r+b" if shared else "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=access)
+        self._words = memoryview(self._map).cast("i")
+        self.blocks = len(self._words) // block_size
+
+    @classmethod
+    def create(cls, path: str, blocks: int, block_size: int = 256) -> "BlockStorage":
+        """Create a zero-filled (sparse) storage file of blocks blocks"""
+        with open(path, "wb") as f:
+            f.truncate(blocks * block_size * WORD_BYTES)
+        return cls(path, block_size)
+
+    def _span(self, block: int, count: int) -> Tuple[int, int]:
+        start = block * self.block_size
+        end = start + count
+        if block < 0 or count < 0 or end > len(self._words):
+            raise SegFault("{} words at block {} exceed storage of {} blocks"
+                           .format(count, block, self.blocks))
+        return start, end
+
+    def read_words(self, block: int, count: int) -> memoryview:
+        """count words starting at the beginning of block"""
+        start, end = self._span(block, count)
+        return self._words[start:end]
+
+    def write_words(self, block: int, words: Sequence[int]) -> None:
+        """Store words starting at the beginning of block"""
+        start, end = self._span(block, len(words))
+        self._words[start:end] = to_word_array(words)
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        self._words.release()
+        self._map.close()
+
+
+# DMA controller registers, as offsets within its window
+DMA_BLOCK = 0     # Storage block number
+DMA_ADDR = 1      # Memory address
+DMA_LENGTH = 2    # Number of words
+DMA_CONTROL = 3   # Write a command to start; read the status
+DMA_REGISTERS = 4
+
+# DMA commands
+DMA_TO_MEMORY = 1     # Copy from storage to memory
+DMA_TO_STORAGE = 2    # Copy from memory to storage
+
+# DMA status
+DMA_IDLE = 0
+DMA_DONE = 1
+DMA_ERROR = -1
+
+
+class DMAController(Device):
+    """Direct memory access between BlockStorage and Memory.
+    A program sets the block, address, and length registers with
+    STORE instructions, then stores a command in the control
+    register.  The whole transfer is one slice copy on the host;
+    afterward the control register reads DMA_DONE, or DMA_ERROR
+    if the transfer was out of bounds, touched a device window
+    (DMA moves plain memory only), or the command was unknown.
+    A failed transfer changes nothing.
+    """
+    writes_memory = True
+
+    def __init__(self, storage: BlockStorage, memory: MemoryMappedIO) -> None:
+        self.storage = storage
+        self.memory = memory
+        self.registers = DMA_REGISTERS * [0]
+        self.registers[DMA_CONTROL] = DMA_IDLE
+        self.transfers = 0
+        self.words = 0
+
+    def read(self, offset: int) -> int:
+        return self.registers[offset]
+
+    def write(self, offset: int, value: int) -> None:
+        if offset != DMA_CONTROL:
+            self.registers[offset] = value
+            return
+        block = self.registers[DMA_BLOCK]
+        addr = self.registers[DMA_ADDR]
+        length = self.registers[DMA_LENGTH]
+        try:
+            if value == DMA_TO_MEMORY:
+                with self.storage.read_words(block, length) as words:
+                    self.memory.load_ram_image(words, addr)
+            elif value == DMA_TO_STORAGE:
+                self.storage.write_words(block, self.memory.read_ram_block(addr, length))
+            else:
+                raise ValueError("Unknown DMA command {}".format(value))
+        except (SegFault, ValueError) as e:
+            log.warning("DMA transfer failed: {}".format(e))
+            self.registers[DMA_CONTROL] = DMA_ERROR
+            return
+        self.transfers += 1
+        self.words += length
+        self.registers[DMA_CONTROL] = DMA_DONE
+
+
+# Performance counter registers, as offsets within their window
+PERF_INSTRUCTIONS = 0   # Instructions retired (executed, not skipped)
+PERF_LOADS = 1
+PERF_STORES = 2
+PERF_SKIPS = 3          # Instructions skipped by their predicate
+PERF_NANOS = 4          # Host nanoseconds
+PERF_REGISTERS = 5
+
+
+class PerfCounters(Device):
+    """The CPU performance counters as device registers, so that
+    programs can time themselves.  Host nanoseconds count from
+    the creation of the device.  Storing a value in a counter
+    register makes it count on from that value, so a program can
+    zero a counter before the code it measures; the counters in
+    the CPU are not changed.  Reads wrap to 32-bit words.
+    """
+
+    def __init__(self, cpu: "CPU") -> None:
+        self.cpu = cpu
+        self._base = PERF_REGISTERS * [0]
+        self._base[PERF_NANOS] = time.perf_counter_ns()
+
+    def _raw(self, offset: int) -> int:
+        cpu = self.cpu
+        if offset == PERF_INSTRUCTIONS:
+            return cpu.step_count - cpu.skips
+        elif offset == PERF_LOADS:
+            return cpu.loads
+        elif offset == PERF_STORES:
+            return cpu.stores
+        elif offset == PERF_SKIPS:
+            return cpu.skips
+        return time.perf_counter_ns()
+
+    def read(self, offset: int) -> int:
+        return to_word(self._raw(offset) - self._base[offset])
+
+    def write(self, offset: int, value: int) -> None:
+        self._base[offset] = self._raw(offset) - value
+
+
+# Interval timer registers, as offsets within its window
+TIMER_PERIOD = 0      # Steps between expirations
+TIMER_CONTROL = 1     # Mode: write to start or stop the timer
+TIMER_EXPIRED = 2     # Number of expirations so far
+TIMER_REMAINING = 3   # Steps until the next expiration
+TIMER_REGISTERS = 4
+
+# Timer modes
+TIMER_STOPPED = 0
+TIMER_ONE_SHOT = 1
+TIMER_PERIODIC = 2
+
+
+class IntervalTimer(Device):
+    """A programmable timer counting CPU steps.  The Duck Machine
+    has no interrupts, so a program polls the expiration count.
+    Expirations are scheduled on the CPU event wheel, so the timer
+    costs nothing on the steps in between.
+    """
+
+    def __init__(self, cpu: "CPU") -> None:
+        self.cpu = cpu
+        self.period = 0
+        self.mode = TIMER_STOPPED
+        self.expired = 0
+        self._due = None
+        self._event = None   # Handle of the scheduled expiration
+
+    def _arm(self) -> None:
+        self._disarm()
+        delay = max(self.period, 1)
+        self._due = self.cpu.step_count + delay
+        self._event = self.cpu.schedule(delay, self._expire)
+
+    def _disarm(self) -> None:
+        if self._event is not None:
+            self.cpu.cancel(self._event)
+            self._event = None
+        self._due = None
+
+    def _expire(self) -> None:
+        self._event = None
+        self.expired += 1
+        if self.mode == TIMER_PERIODIC:
+            self._arm()
+        else:
+            self.mode = TIMER_STOPPED
+            self._due = None
+
+    def read(self, offset: int) -> int:
+        if offset == TIMER_PERIOD:
+            return self.period
+        elif offset == TIMER_CONTROL:
+            return self.mode
+        elif offset == TIMER_EXPIRED:
+            return self.expired
+        if self._due is None:
+            return 0
+        return self._due - self.cpu.step_count
+
+    def write(self, offset: int, value: int) -> None:
+        if offset == TIMER_PERIOD:
+            self.period = value
+        elif offset == TIMER_CONTROL:
+            self.mode = value
+            if value in (TIMER_ONE_SHOT, TIMER_PERIODIC):
+                self._arm()
+            else:
+                self.mode = TIMER_STOPPED
+                self._disarm()
+        elif offset == TIMER_EXPIRED:
+            self.expired = value
+        else:
+            log.warning("Ignoring write of {} to timer remaining count".format(value))
@@ -5,13 +5,26 @@ a simulated computer.
 Interprets Duck Machine object code. 
 """
 
-from memory import Memory, MemoryMappedIO
+from memory import Memory, MemoryMappedIO, MappedMemoryIO, SparseMemoryIO
 from cpu import CPU
+from cache import CacheModel, build_hierarchy
+from pipeline import PipelineModel, make_predictor, PREDICTORS
+from mmu import MMU, MMUControl, TLB, MMU_REGISTERS
+from debugger import Debugger
+from verifier import verify_memory
+from assembler import assemble_source
+from build_cache import assemble_file
+from assembler_pass1 import SyntaxError
+from devices import ConsoleIn, ConsoleOut, BlockStorage, DMAController, DMA_REGISTERS
+from devices import PerfCounters, IntervalTimer, PERF_REGISTERS, TIMER_REGISTERS
 
 import view
 
 import argparse
 import io
+import sys
+
+from typing import List
 
 import logging
 
@@ -19,26 +32,83 @@ logging.basicConfig()
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# Device addresses, within reach of a displacement from r0
+MMU_BASE = 480
+PERF_BASE = 490
+TIMER_BASE = 496
+DMA_BASE = 500
+
 
 def cli() -> object:
     """Get arguments from command line"""
     parser = argparse.ArgumentParser(description="Duck Machine Simulator")
     parser.add_argument("objfile", type=argparse.FileType('r'),
-                        help="Object file input")
+                        nargs="?", help="Object file input, or assembly source (.asm), "
+                                        "assembled through the build cache")
     parser.add_argument("-d", "--display", help="Graphical display",
                         action="store_true")
     parser.add_argument("-s", "--step", help="Single step mode",
                         action="store_true")
+    parser.add_argument("--image", help="Binary memory image to map as main memory")
+    parser.add_argument("--shared", action="store_true",
+                        help="Write memory changes through to the image file")
+    parser.add_argument("--capacity", type=int, default=512,
+                        help="Memory capacity in words")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Allocate memory in pages on first write")
+    parser.add_argument("--input", type=argparse.FileType('rb'),
+                        help="Read console input from this file ('-' for stdin)")
+    parser.add_argument("--output", type=argparse.FileType('wb'),
+                        help="Write console output to this file ('-' for stdout)")
+    parser.add_argument("--binary-io", action="store_true",
+                        help="Console files hold 32-bit words in native byte order "
+                             "(as in --image and --storage files) rather than text")
+    parser.add_argument("--storage", help="Block storage file, reached by DMA")
+    parser.add_argument("--block-size", type=int, default=256,
+                        help="Words per storage block")
+    parser.add_argument("--counters", action="store_true",
+                        help="Map performance counters and an interval timer")
+    parser.add_argument("--cache", action="append", metavar="SPEC",
+                        help="Model a cache NAME:SIZE[:LINE[:WAYS[:POLICY[:LATENCY[:WRITE]]]]], "
+                             "e.g. L1D:1024:8:4:lru:1:wb; repeat for each level")
+    parser.add_argument("--memory-latency", type=int, default=100,
+                        help="Cycles for a main memory access in the cache model")
+    parser.add_argument("--pipeline", choices=sorted(PREDICTORS),
+                        help="Model a 5-stage pipeline with this branch predictor")
+    parser.add_argument("--mmu", action="store_true",
+                        help="Place an MMU between CPU and memory, with registers at {}"
+                             .format(MMU_BASE))
+    parser.add_argument("--page-size", type=int, default=256, help="Words per page")
+    parser.add_argument("--pages", type=int, default=1024,
+                        help="Entries in a page table")
+    parser.add_argument("--tlb-entries", type=int, default=16)
+    parser.add_argument("--tlb-ways", type=int, default=4)
+    parser.add_argument("--tlb-policy", default="lru", help="lru, fifo or random")
+    parser.add_argument("--break", dest="breaks", action="append", metavar="ADDR[:COND]",
+                        help="Stop before the instruction at ADDR, if the condition "
+                             "(e.g. 'r1 == 0 and Z') holds; repeatable")
+    parser.add_argument("--watch", action="append", metavar="LOW[-HIGH][:KIND]",
+                        help="Stop after an access to addresses LOW..HIGH; KIND is "
+                             "read, write (default) or change; repeatable")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Assemble .asm source even if __duckcache__ has it")
+    parser.add_argument("--fast", action="store_true",
+                        help="Verify the program and, if it is safe, run it without "
+                             "bounds checks")
     args = parser.parse_args()
+    if args.objfile is None and args.image is None:
+        parser.error("an object file or a memory image is required")
     return args
 
 
-def load(file: io.IOBase, memory: Memory) -> None:
-    addr = 0
-    for line in file:
-        word = int(line)
-        memory.put(addr, word)
-        addr += 1
+def read_object_code(file: io.IOBase) -> List[int]:
+    """Parse a whole object file (one integer per line) at once"""
+    return list(map(int, file.read().split()))
+
+
+def load(file: io.IOBase, memory: Memory, base: int = 0) -> None:
+    """Load object code into memory as a single image"""
+    memory.load_image(read_object_code(file), base)
 
 
 def duck_out(addr: int, value: int) -> None:
@@ -54,21 +124,122 @@ def main():
     object code file.
     """
     args = cli()
-    mem = MemoryMappedIO(512)
+    if args.image:
+        mem = MappedMemoryIO(args.image, shared=args.shared)
+    elif args.sparse:
+        mem = SparseMemoryIO(args.capacity)
+    else:
+        mem = MemoryMappedIO(args.capacity)
     # We'd like to make it simple to trigger I/O with
     # a single instruction, so it would be good to fit
     # the memory mapped addresses into the offset field.
     # For that, maximum positive value is 511.  We'll
     # reserve addresses 510 and 511 for input and output
     # respectively.
-    mem.map_address_in(510, duck_in)
-    mem.map_address_out(511, duck_out)
-    cpu = CPU(mem)
+    console_out = None
+    if args.input:
+        mem.attach(ConsoleIn(args.input, binary=args.binary_io), 510)
+    else:
+        mem.map_address_in(510, duck_in)
+    if args.output:
+        console_out = ConsoleOut(args.output, binary=args.binary_io)
+        mem.attach(console_out, 511)
+    else:
+        mem.map_address_out(511, duck_out)
+    storage = None
+    if args.storage:
+        # DMA control registers just below the console
+        storage = BlockStorage(args.storage, args.block_size)
+        mem.attach(DMAController(storage, mem), DMA_BASE, DMA_REGISTERS)
+    mmu = None
+    if args.mmu:
+        mmu = MMU(mem, args.page_size, args.pages,
+                  TLB(args.tlb_entries, args.tlb_ways, args.tlb_policy))
+        cpu = CPU(mmu)
+        mem.attach(MMUControl(mmu, cpu), MMU_BASE, MMU_REGISTERS)
+    else:
+        cpu = CPU(mem)
+    if args.counters:
+        mem.attach(PerfCounters(cpu), PERF_BASE, PERF_REGISTERS)
+        mem.attach(IntervalTimer(cpu), TIMER_BASE, TIMER_REGISTERS)
+    cache_model = None
+    if args.cache:
+        icache, dcache, levels = build_hierarchy(args.cache, args.memory_latency)
+        cache_model = CacheModel(cpu, icache, dcache, levels,
+                                 uncached=(mem.io_base, mem.io_end))
+    pipeline_model = None
+    if args.pipeline:
+        pipeline_model = PipelineModel(cpu, make_predictor(args.pipeline))
     if args.display:
         display = view.MachineStateView(cpu, 1500, 1000)
-    load(args.objfile, mem)
-    cpu.run(single_step=args.step)
+    program_length = mem.capacity
+    if args.objfile:
+        if args.objfile.name.endswith(".asm"):
+            try:
+                if args.no_cache:
+                    words = assemble_source(args.objfile.readlines())
+                else:
+                    words = assemble_file(args.objfile.name)
+            except SyntaxError as e:
+                log.error("Cannot assemble {}:\n{}".format(args.objfile.name, e))
+                return
+        else:
+            words = read_object_code(args.objfile)
+        mem.load_program(words)
+        program_length = len(words)
+    verified = None
+    if args.fast:
+        verified = verify_memory(mem, program_length)
+        if not verified.ok:
+            log.info(verified.report())
+    debugger = None
+    if args.breaks or args.watch:
+        debugger = Debugger(cpu)
+        for spec in args.breaks or []:
+            addr, _, condition = spec.partition(":")
+            debugger.add_breakpoint(int(addr), condition or None)
+        for spec in args.watch or []:
+            span, _, kind = spec.partition(":")
+            low, _, high = span.partition("-")
+            debugger.add_watchpoint(int(low), int(high or low) + 1, kind or "write")
+    try:
+        if debugger:
+            stop = debugger.run(0)
+            while stop:
+                print("Stopped: {}".format(stop))
+                print(" ".join("r{}={}".format(i, reg.get())
+                               for i, reg in enumerate(cpu.registers)))
+                input("Press enter to continue")
+                stop = debugger.run()
+        else:
+            cpu.run(single_step=args.step, verified=verified)
+    except EOFError:
+        # ConsoleIn has no eof_value: reading past the end of the
+        # input is the program's error, not the simulator's
+        log.error("Program read past the end of its input")
+        exhausted = True
+    else:
+        exhausted = False
+    finally:
+        if console_out:
+            console_out.flush()
+            log.debug("Console output: {} values, {} bytes"
+                      .format(console_out.values, console_out.bytes))
+        if storage:
+            storage.flush()
+    if exhausted:
+        sys.exit(1)
     print("Halted")
+    if cache_model:
+        print(cache_model.report())
+    if pipeline_model:
+        print(pipeline_model.report())
+    if mmu:
+        log.info("MMU: {}".format(mmu.stats()))
+    if args.image and args.shared:
+        mem.flush()
+    if args.sparse:
+        log.info("Sparse memory: {}".format(mem.stats()))
     if args.display:
         input("Press enter to end")
 
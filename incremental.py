@@ -0,0 +1,301 @@
+"""
+Incremental re-assembly of an edited source.
+
+A Session keeps an assembled program: its source lines, the laid-out
+records (see assembler.Assembly), the address of each label and
+the words.  An edit replaces a range of source lines.  Only the new
+lines are scanned; if the edit changes how many words there are,
+the labels after it move by the difference.  Every reference whose
+offset can change lies within a displacement (511 words) of the
+edit, so only the references in that window are re-encoded.  The
+cost of an edit is proportional to its size, plus the number of
+labels when it changes the program's length.
+
+Relaxation (assembler_pass1.relax) decides the layout for the whole
+program, so a Session falls back to assembling everything again
+whenever an edit could change it:
+
+* the program has far references (literal pools), or comes to need
+  them;
+* the edit changes the length of the code below the hole left for
+  the devices, or is near enough to the hole to change where it goes;
+* the program grows into, or shrinks out of, needing a hole;
+* anything is wrong with the new source (so the errors are reported
+  the same way as by Assembly).
+
+A Session always holds what Assembly would make of its source.
+
+    session = Session(lines)
+    session.edit(10, 11, ["   ADD r1,r1,r0[2]"])   # replace line 10
+    session.update(new_lines)                       # or diff whole sources
+
+    python3 incremental.py programs/fact.asm fact.obj   # re-assemble on save
+"""
+
+from assembler import Assembly, AssemblyError
+from assembler_pass1 import MIN_OFFSET, MAX_OFFSET, RESERVED, SyntaxError
+from lexer import Record, lex, FULL
+
+from typing import List, Optional, Sequence
+
+import argparse
+import os
+import time
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class Session(object):
+    """An assembled program that can be edited line by line.
+    words is the object code; incremental tells whether the last
+    change was made without assembling everything again.
+    """
+
+    def __init__(self, lines: Sequence[str], reserved: tuple = RESERVED) -> None:
+        self.reserved = reserved
+        self.incremental = False
+        self._build([line.rstrip("\n") for line in lines])
+
+    def _build(self, lines: List[str]) -> None:
+        """Assemble all of lines, leaving the session unchanged on error"""
+        assembly = Assembly(lines, reserved=self.reserved)
+        self.lines = lines
+        self.records = assembly.records
+        self.labels = assembly.labels
+        self.words = assembly.words
+        self.flags = bytearray(record.word for record in self.records)
+        self.code = [record for record in self.records if record.word]   # By address
+        self.hole = None         # (index, count) of the records of the hole
+        self.plain = True        # Laid out as written, but for the hole
+        inserted = assembly.inserted
+        if inserted:
+            first = inserted[0]
+            self.plain = (inserted[-1] - first + 1 == len(inserted) and
+                          len(self.records) - len(inserted) == len(lines))
+            self.hole = (first, len(inserted))
+        self.incremental = False
+
+    def edit(self, start: int, stop: int, lines: Sequence[str]) -> None:
+        """Replace source lines start..stop-1 with lines.  Raises
+        AssemblyError, leaving the session as it was, if the new
+        source has errors.
+        """
+        lines = [line.rstrip("\n") for line in lines]
+        try:
+            records = [lex(line) for line in lines]
+        except SyntaxError:
+            records = None
+        if records is None or not self._patch(start, stop, lines, records):
+            self._build(self.lines[:start] + lines + self.lines[stop:])
+            return
+        self.incremental = True
+
+    def _patch(self, start: int, stop: int, lines: List[str], records: List[Record]) -> bool:
+        """Make the edit in place; False, changing nothing, if it
+        needs a full assembly
+        """
+        if not self.plain:
+            return False
+        first, last = start, stop      # Among the records
+        if self.hole is not None and stop > self.hole[0]:
+            if start < self.hole[0]:
+                return False
+            first, last = start + self.hole[1], stop + self.hole[1]
+        addr = self.flags.count(1, 0, first)
+        old = self.flags.count(1, first, last)
+        new = sum(1 for record in records if record.word)
+        delta = new - old
+        if not self._keeps_layout(first, addr, old, delta):
+            return False
+        removed = set(record.label for record in self.records[first:last] if record.label)
+        moved = {}       # Labels the edit defines, or that name its first word
+        at = addr
+        for record in records:
+            if record.label:
+                if record.label in moved or (record.label in self.labels and
+                                             record.label not in removed):
+                    return False    # Duplicate
+                moved[record.label] = at
+            if record.word:
+                at += 1
+        k = first - 1
+        while k >= 0 and not self.flags[k]:
+            if self.records[k].label:
+                moved[self.records[k].label] = addr
+            k -= 1
+        if self.hole is not None and any(record.kind is FULL and "r15" in
+                                         (record["src1"], record["src2"])
+                                         for record in records):
+            return False    # Assembly refuses these where there is a hole
+        end = addr + old
+
+        def address(label: str) -> Optional[int]:
+            """Where label is after the edit"""
+            if label in moved:
+                return moved[label]
+            if label in removed or label not in self.labels:
+                return None
+            at = self.labels[label]
+            return at + delta if at >= end else at
+
+        words = self._encode(records)
+        if words is None:
+            return False
+        patched = self._window(addr, new, words, records, delta, address)
+        if patched is None:
+            return False
+        # Nothing can fail from here
+        for label in removed:
+            del self.labels[label]
+        if delta:
+            for label, at in self.labels.items():
+                if at >= end:
+                    self.labels[label] = at + delta
+        self.labels.update(moved)
+        self.lines[start:stop] = lines
+        self.records[first:last] = records
+        self.flags[first:last] = bytearray(record.word for record in records)
+        self.code[addr:end] = [record for record in records if record.word]
+        self.words[addr:end] = words
+        for at, word in patched:
+            self.words[at] = word
+        if self.hole is not None and first < self.hole[0]:
+            self.hole = (self.hole[0] + len(records) - (last - first), self.hole[1])
+        return True
+
+    def _keeps_layout(self, first: int, addr: int, old: int, delta: int) -> bool:
+        """Would relaxation lay out the edited program as this one,
+        but for the words of the edit?
+        """
+        if self.reserved is None:
+            return True
+        low, high = self.reserved
+        length = len(self.words) + delta
+        if self.hole is None:
+            return length <= low
+        index, count = self.hole
+        hole_words = self.flags.count(1, index, index + count)
+        if length - hole_words <= low:
+            return False
+        if first < index:
+            # Below the hole: the same length, and clear of the
+            # word before it, which decides whether it needs a jump
+            hole_addr = self.flags.count(1, 0, index)
+            return delta == 0 and addr + old < hole_addr
+        # Above it: past the words that could have held it instead
+        return addr > low - 1 + hole_words
+
+    def _encode(self, records: List[Record]) -> Optional[List[int]]:
+        """Words for the new records, 0 for references, which are
+        resolved with the window; None if one cannot be encoded
+        """
+        words = []
+        for record in records:
+            if not record.word:
+                continue
+            try:
+                words.append(0 if record.symbol is not None else record.encode())
+            except (SyntaxError, KeyError):
+                return None
+        return words
+
+    def _window(self, addr: int, new: int, words: List[int], records: List[Record],
+                delta: int, address) -> Optional[List[tuple]]:
+        """Resolve the references within a displacement of the
+        edit, at addr..addr+new-1 of the edited program, finding
+        labels with address().  The edit's own words are filled
+        in, others returned as (address, word) pairs.  None if a
+        reference cannot be resolved.
+        """
+        code = [record for record in records if record.word]
+        low = max(addr - MAX_OFFSET - 1, 0)
+        high = min(addr + new + MAX_OFFSET + 1, len(self.words) + delta)
+        patched = []
+        for at in range(low, high):
+            if at < addr:
+                record = self.code[at]
+            elif at < addr + new:
+                record = code[at - addr]
+            else:
+                record = self.code[at - delta]
+            symbol = record.symbol
+            if symbol is None:
+                continue
+            target = address(symbol)
+            if target is None or not MIN_OFFSET <= target - at <= MAX_OFFSET:
+                return None
+            try:
+                word = record.encode(target - at)
+            except (SyntaxError, KeyError):
+                return None
+            if at < addr or at >= addr + new:
+                patched.append((at, word))
+            else:
+                words[at - addr] = word
+        return patched
+
+    def update(self, lines: Sequence[str]) -> None:
+        """Change the source to lines, editing only the range of
+        lines that differs
+        """
+        lines = [line.rstrip("\n") for line in lines]
+        old = self.lines
+        start = 0
+        limit = min(len(old), len(lines))
+        while start < limit and old[start] == lines[start]:
+            start += 1
+        end = 0
+        while end < limit - start and old[-1 - end] == lines[-1 - end]:
+            end += 1
+        self.edit(start, len(old) - end, lines[start:len(lines) - end])
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Re-assemble a source each time it changes")
+    parser.add_argument("sourcefile", help="Duck Machine assembly code file")
+    parser.add_argument("objfile", help="Object file output")
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="Seconds between looks at the source")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Watch a source, writing its object code each time it changes"""
+    args = cli()
+    session = None
+    seen = None
+    while True:
+        try:
+            mtime = os.stat(args.sourcefile).st_mtime
+            if mtime != seen:
+                seen = mtime
+                with open(args.sourcefile) as f:
+                    lines = f.readlines()
+                start = time.perf_counter()
+                try:
+                    if session is None:
+                        session = Session(lines)
+                    else:
+                        session.update(lines)
+                except AssemblyError as e:
+                    log.error(e)
+                    continue
+                elapsed = time.perf_counter() - start
+                with open(args.objfile, "w") as f:
+                    for word in session.words:
+                        print(word, file=f)
+                log.info("{} words in {:.1f} ms ({})".format(
+                    len(session.words), 1000 * elapsed,
+                    "incremental" if session.incremental else "full"))
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            break
+
+
+if __name__ == "__main__":
+    main()
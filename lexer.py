@@ -0,0 +1,241 @@
+"""
+A single-scan lexer for Duck Machine assembly lines.
+
+assembler_pass1.parse_line tries up to four regular expressions
+in turn and builds a dict from the one that matches.  lex() scans
+a line once, with one regular expression holding the four forms
+as alternatives.  No line fits two forms, so it accepts, rejects
+and classifies exactly the lines parse_line does.  A Record keeps
+the match's groups as they are and finds a field among them only
+when it is asked for, so no dict is built.  The tables that
+translate opcode, predicate and register names are keyed by
+interned strings.
+
+Line for line, lex() runs about 2-2.5 times as fast as
+parse_line, short of the 5x target: the one regular expression
+match alone takes more than a fifth of parse_line's time.
+lex_lines() does better only on sources that repeat lines, as
+generated code does, by scanning each distinct line once; on a
+source that does not, it soon stops looking lines up and runs
+as lex() does.
+
+A Record can be indexed like parse_line's dict (record["opcode"]),
+so code written for those dicts, such as the relaxation in
+assembler_pass1, takes records too.
+
+    python3 lexer.py big.asm     # lines per second, against parse_line
+"""
+
+from assembler_pass1 import AsmSrcKind, SyntaxError
+from assembler_pass2 import value_parse
+from instr_format import Instruction, OpCode, CondFlag, NAMED_REGS
+
+from itertools import islice
+from typing import Iterable, List, Optional
+
+import argparse
+import re
+import sys
+import time
+
+LINE_PAT = re.compile(r"""
+   # Optional label, as in every form
+   (?: (?P<label> [a-zA-Z]\w*): )?
+   \s*
+   (?:
+      # ASM_FULL_PAT
+      (?P<opcode>    [a-zA-Z]+)
+      (?: / (?P<predicate> [a-zA-Z]+) )?
+      \s+
+      (?P<target>    r[0-9]+),
+      (?P<src1>      r[0-9]+),
+      (?P<src2>      r[0-9]+)
+      (?: \[ (?P<offset>[-]?[0-9]+) \] )?
+   |
+      # ASM_DATA_PAT
+      (?P<data> DATA)
+      \s*
+      (?P<value> (0x[a-fA-F0-9]+) | ([0-9]+))?
+   |
+      # ASM_COMMENT_PAT: nothing but the comment
+   |
+      # ASM_SYMBOLIC_PAT
+      (?P<symbolic> STORE | LOAD | JUMP)
+      (?: / (?P<sym_predicate> [a-zA-Z]+) )?
+      \s+
+      (?: (?P<sym_target> r[0-9]+), )?
+      (?P<symbol> [a-zA-Z]\w*)
+   )
+   # Optional comment follows # or ;
+   (?: \s* (?P<comment>[\#;].*) )?
+   \s*
+   """, re.VERBOSE)
+_fullmatch = LINE_PAT.fullmatch
+
+OPCODES = {sys.intern(name): op for name, op in OpCode.__members__.items()}
+CONDITIONS = {sys.intern(name): cond for name, cond in CondFlag.__members__.items()}
+REGISTERS = {sys.intern(name): number for name, number in NAMED_REGS.items()}
+PC = 15
+
+SAMPLE = 1024      # Lines lex_lines() looks at before giving up its cache
+MIN_HITS = 0.25    # The share of them that must repeat for it to keep it
+TARGET = 5.0       # Lines per second, as a multiple of parse_line's
+
+FULL, DATA, COMMENT, SYMBOLIC = (AsmSrcKind.FULL, AsmSrcKind.DATA,
+                                 AsmSrcKind.COMMENT, AsmSrcKind.SYMBOLIC)
+
+# Where each kind of line keeps parse_line's fields among the
+# groups of LINE_PAT
+_FIELDS = {
+    FULL: {"label": 0, "opcode": 1, "predicate": 2, "target": 3, "src1": 4, "src2": 5,
+           "offset": 6, "comment": 15},
+    DATA: {"label": 0, "opcode": 7, "value": 8, "comment": 15},
+    COMMENT: {"label": 0, "comment": 15},
+    SYMBOLIC: {"label": 0, "opcode": 11, "predicate": 12, "target": 13, "symbol": 14,
+               "comment": 15},
+}
+
+
+class Record(object):
+    """One line of assembly code: its kind, the line, and the
+    groups LINE_PAT matched in it.  Fields are read as from
+    parse_line's dict, e.g. record["symbol"], None where absent.
+    """
+    __slots__ = ("kind", "line", "groups")
+
+    def __init__(self, kind: AsmSrcKind, line: str, groups: tuple) -> None:
+        self.kind = kind
+        self.line = line
+        self.groups = groups
+
+    def __getitem__(self, key: str):
+        if key == "kind":
+            return self.kind
+        index = _FIELDS[self.kind].get(key)
+        return None if index is None else self.groups[index]
+
+    @property
+    def label(self) -> Optional[str]:
+        return self.groups[0]
+
+    @property
+    def symbol(self) -> Optional[str]:
+        return self.groups[14]
+
+    @property
+    def word(self) -> bool:
+        return self.kind is not COMMENT
+
+    def encode(self, offset: int = 0) -> int:
+        """The word for this line; a symbolic reference is encoded
+        relative to r15, offset words away.  Raises KeyError or
+        SyntaxError where assembler_pass2 would reject the line
+        pass 1 makes of it.
+        """
+        kind = self.kind
+        groups = self.groups
+        if kind is DATA:
+            if groups[8] is None:
+                raise SyntaxError("DATA needs a value")
+            return value_parse(groups[8])
+        if kind is FULL:
+            return Instruction(OPCODES[groups[1]], CONDITIONS[groups[2] or "ALWAYS"],
+                               REGISTERS[groups[3]], REGISTERS[groups[4]],
+                               REGISTERS[groups[5]], int(groups[6] or 0)).encode()
+        cond = CONDITIONS[groups[12] or "ALWAYS"]
+        if groups[11] == "JUMP":
+            return Instruction(OpCode.ADD, cond, PC, 0, PC, offset).encode()
+        if groups[13] is None:
+            raise SyntaxError("{} needs a register".format(groups[11]))
+        return Instruction(OPCODES[groups[11]], cond, REGISTERS[groups[13]],
+                           0, PC, offset).encode()
+
+
+def lex(line: str) -> Record:
+    """Scan one line of assembly code.  Raises SyntaxError if it
+    does not match assembly language syntax.
+    """
+    match = _fullmatch(line)
+    if match is None:
+        raise SyntaxError("Assembler syntax error in {}".format(line))
+    groups = match.groups()
+    if groups[1] is not None:
+        return Record(FULL, line, groups)
+    if groups[7] is not None:
+        return Record(DATA, line, groups)
+    if groups[11] is not None:
+        return Record(SYMBOLIC, line, groups)
+    return Record(COMMENT, line, groups)
+
+
+def lex_lines(lines: Iterable[str]) -> List[Record]:
+    """lex() each line.  Generated code repeats itself, so each
+    distinct line is scanned once and its Record shared (records
+    are not changed once made).  If few of the first SAMPLE lines
+    repeat, the rest are scanned without the cache, which would
+    only cost time and memory.  Raises SyntaxError at the first
+    bad line.
+    """
+    lines = iter(lines)
+    seen = {}
+    records = []
+    hits = 0
+    for line in islice(lines, SAMPLE):
+        record = seen.get(line)
+        if record is None:
+            record = lex(line)
+            seen[line] = record
+        else:
+            hits += 1
+        records.append(record)
+    if hits >= SAMPLE * MIN_HITS:
+        for line in lines:
+            record = seen.get(line)
+            if record is None:
+                record = lex(line)
+                seen[line] = record
+            records.append(record)
+    else:
+        records.extend(map(lex, lines))
+    return records
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Time the lexer against parse_line")
+    parser.add_argument("sources", nargs="+", help="Assembly code files")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Lines per second for each way of scanning the sources"""
+    from assembler_pass1 import parse_line
+    args = cli()
+    lines = []
+    for path in args.sources:
+        with open(path) as f:
+            lines.extend(line.rstrip("\n") for line in f)
+    rates = {}
+    for name, scan in [("parse_line", lambda: [parse_line(line) for line in lines]),
+                       ("lex", lambda: [lex(line) for line in lines]),
+                       ("lex_lines", lambda: lex_lines(lines))]:
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            scan()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rates[name] = len(lines) / best
+    for name, rate in rates.items():
+        speedup = rate / rates["parse_line"]
+        verdict = ""
+        if name != "parse_line":
+            verdict = "  target {:.1f}x {}".format(TARGET, "met" if speedup >= TARGET else "missed")
+        print("{:10} {:10.0f} lines/s  {:5.1f}x{}".format(name, rate, speedup, verdict))
+    print("{} lines, {} distinct; lex is the per-line speed, lex_lines "
+          "also reuses repeated lines".format(len(lines), len(set(lines))))
+
+
+if __name__ == "__main__":
+    main()
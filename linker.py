@@ -0,0 +1,340 @@
+"""
+Relocatable object modules and a linker for the Duck Machine.
+
+An assembly file can be assembled by itself into an object
+module, which another program can use without re-assembling it.
+Two directives, which pass 1 does not otherwise accept, name what
+a module shares:
+
+    EXPORT fact, ten       labels other modules may use
+    IMPORT print           labels defined by other modules
+
+A module is assembled as if loaded at address 0.  Its own
+references are relative to r15, so they hold wherever it is
+loaded, except for the words of its literal pools that hold an
+address (see assembler_pass1.relocatable).  Each of those is a
+relocation: the linker adds the module's base address, or, for
+an imported symbol, fills in the symbol's address.  References
+to imported symbols therefore always go through a pool.
+
+The linker
+
+* finds the module exporting each imported symbol through an
+  index of all exports,
+* keeps only the modules the first one (the program) needs,
+* lets imports of constants (exported DATA words that no module
+  stores to) share one word for each value, so a module that is
+  only needed for a constant another module also has is dropped,
+* places the program at 0 and the other modules after it,
+  keeping clear of the devices at assembler_pass1.RESERVED, and
+* emits an image in the .obj format, for MemoryMappedIO.load_program.
+
+Control may not run off the end of a module into the next.
+Every step is linear in the total size of the modules.
+
+    python3 linker.py -c programs/lib.asm           # writes programs/lib.dmo
+    python3 linker.py main.asm programs/lib.dmo -o main.obj
+
+Object module format (.dmo), one record per line:
+
+    module NAME
+    export SYMBOL OFFSET [VALUE]    (VALUE if it is a constant)
+    import SYMBOL USE[,USE...]      (LOAD, STORE and/or JUMP)
+    reloc OFFSET [SYMBOL]
+    words COUNT
+    followed by COUNT words, one per line
+"""
+
+from assembler_pass1 import parse_line, build_table, transform_lines, relocatable
+from assembler_pass1 import AsmSrcKind, RESERVED, SyntaxError
+from assembler_pass2 import assemble, SyntaxError as EncodingError
+from instr_format import Instruction, OpCode, CondFlag
+
+from typing import Dict, List, Optional, Sequence, TextIO, Tuple
+
+import argparse
+import os
+import re
+import sys
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+DIRECTIVE_PAT = re.compile(r"""
+   \s*
+   (?P<directive> EXPORT | IMPORT)
+   \s+
+   (?P<names> [a-zA-Z]\w* (\s*,\s*[a-zA-Z]\w*)* )
+   \s*
+   (\#.*)?
+   $
+   """, re.VERBOSE | re.IGNORECASE)
+
+
+class LinkError(Exception):
+    pass
+
+
+class Module(object):
+    """A relocatable object module.  exports maps each exported
+    label to its offset, constants the exported labels of DATA
+    words the module never stores to, to their values; imports
+    maps each imported symbol to how the module uses it.
+    """
+
+    def __init__(self, name: str, words: List[int], exports: Dict[str, int],
+                 imports: Dict[str, List[str]], relocations: List[tuple],
+                 constants: Dict[str, int] = None) -> None:
+        self.name = name
+        self.words = words
+        self.exports = exports
+        self.imports = imports
+        self.relocations = relocations   # (offset, symbol or None)
+        self.constants = constants or {}
+
+    def write(self, file: TextIO) -> None:
+        print("module {}".format(self.name), file=file)
+        for name, offset in self.exports.items():
+            if name in self.constants:
+                print("export {} {} {}".format(name, offset, self.constants[name]), file=file)
+            else:
+                print("export {} {}".format(name, offset), file=file)
+        for name, uses in self.imports.items():
+            print("import {} {}".format(name, ",".join(uses)).rstrip(), file=file)
+        for offset, symbol in self.relocations:
+            print("reloc {}".format(offset) if symbol is None
+                  else "reloc {} {}".format(offset, symbol), file=file)
+        print("words {}".format(len(self.words)), file=file)
+        for word in self.words:
+            print(word, file=file)
+
+
+def read_module(file: TextIO) -> Module:
+    """Parse an object module written by Module.write"""
+    name = None
+    exports, imports, constants, relocations = {}, {}, {}, []
+    file = iter(file)
+    for line in file:
+        fields = line.split()
+        if not fields:
+            continue
+        kind = fields[0]
+        try:
+            if kind == "module":
+                name = fields[1]
+            elif kind == "export":
+                exports[fields[1]] = int(fields[2])
+                if len(fields) > 3:
+                    constants[fields[1]] = int(fields[3])
+            elif kind == "import":
+                imports[fields[1]] = fields[2].split(",") if len(fields) > 2 else []
+            elif kind == "reloc":
+                relocations.append((int(fields[1]), fields[2] if len(fields) > 2 else None))
+            elif kind == "words":
+                count = int(fields[1])
+                words = [int(next(file)) for _ in range(count)]
+                return Module(name, words, exports, imports, relocations, constants)
+            else:
+                raise LinkError("Unknown record {}".format(kind))
+        except (IndexError, ValueError, StopIteration):
+            raise LinkError("Malformed object module record: {}".format(line.strip()))
+    raise LinkError("Object module {} has no words".format(name))
+
+
+def assemble_module(lines: Sequence[str], name: str) -> Module:
+    """Assemble source with EXPORT and IMPORT directives into an
+    object module
+    """
+    exported, imported = [], []
+    source = []
+    for line in lines:
+        match = DIRECTIVE_PAT.match(line)
+        if match:
+            names = [n.strip() for n in match.group("names").split(",")]
+            if match.group("directive").upper() == "EXPORT":
+                exported.extend(names)
+            else:
+                imported.extend(names)
+            source.append("# " + line.strip())   # Keep the line numbers
+        else:
+            source.append(line)
+    uses = {}
+    for line in source:
+        fields = parse_line(line)
+        if fields["kind"] == AsmSrcKind.SYMBOLIC and fields["symbol"] in imported:
+            uses.setdefault(fields["symbol"], set()).add(fields["opcode"])
+    laid_out, info = relocatable(source, set(imported))
+    table = build_table(laid_out)
+    try:
+        words = assemble(transform_lines(laid_out, table))
+    except (SyntaxError, EncodingError) as e:
+        raise LinkError("Errors assembling module {}: {}".format(name, e))
+    if len(words) != sum(1 for line in laid_out
+                         if parse_line(line)["kind"] != AsmSrcKind.COMMENT):
+        raise LinkError("Errors assembling module {}".format(name))
+    exports = {}
+    for label in exported:
+        if label not in table:
+            raise LinkError("Module {} exports undefined label {}".format(name, label))
+        exports[label] = table[label]
+    constants = {label: value for label, value in info["constants"].items()
+                 if label in exports}
+    return Module(name, words, exports,
+                  {symbol: sorted(uses.get(symbol, ())) for symbol in imported},
+                  info["relocations"], constants)
+
+
+def link(modules: Sequence[Module], reserved: tuple = RESERVED) -> Tuple[List[int], dict]:
+    """Link modules into an image to load at 0.  The first module
+    is the program: it is placed at 0, or, if it does not fit
+    below the devices, after them, with a jump to it at 0.
+    Returns the image and a report.
+    """
+    if not modules:
+        raise LinkError("Nothing to link")
+    index = {}
+    for k, module in enumerate(modules):
+        for name in module.exports:
+            if name in index:
+                raise LinkError("{} is exported by both {} and {}".format(
+                    name, modules[index[name]].name, module.name))
+            index[name] = k
+    # Symbols some module writes to or jumps to are not constants
+    pinned = set()
+    for module in modules:
+        for name, uses in module.imports.items():
+            if any(use != "LOAD" for use in uses):
+                pinned.add(name)
+
+    def shared(name: str) -> Optional[int]:
+        """The value of an importable constant, or None"""
+        constants = modules[index[name]].constants
+        return constants[name] if name in constants and name not in pinned else None
+
+    keep = len(modules) * [False]
+    copies = {}        # Value -> (module, label) of the word that holds it
+    wanted = []        # Values imported as constants
+    work = []
+
+    def need(k: int) -> None:
+        if not keep[k]:
+            keep[k] = True
+            work.append(k)
+            for label, value in modules[k].constants.items():
+                if label not in pinned:
+                    copies.setdefault(value, (k, label))
+
+    need(0)
+    next_wanted = 0
+    while work:
+        while work:
+            module = modules[work.pop()]
+            for name in module.imports:
+                if name not in index:
+                    raise LinkError("Undefined symbol {} (imported by {})".format(
+                        name, module.name))
+                value = shared(name)
+                if value is None:
+                    need(index[name])
+                else:
+                    wanted.append(name)
+        # A constant no kept module holds keeps its own module
+        while next_wanted < len(wanted) and not work:
+            name = wanted[next_wanted]
+            next_wanted += 1
+            if shared(name) not in copies:
+                need(index[name])
+
+    # Layout
+    low, high = reserved
+    kept = [k for k in range(len(modules)) if keep[k]]
+    base = {}
+    below, above = 0, high
+    if len(modules[0].words) > low:
+        below = 2       # Room for a jump to the program
+        base[0] = above
+        above += len(modules[0].words)
+    for k in kept:
+        size = len(modules[k].words)
+        if k in base:
+            continue
+        if below + size <= low:
+            base[k] = below
+            below += size
+        else:
+            base[k] = above
+            above += size
+    image = (above if above > high else below) * [0]
+    if base[0] != 0:
+        image[0:2] = [Instruction(OpCode.LOAD, CondFlag.ALWAYS, 15, 0, 0, 1).encode(), base[0]]
+    for k in kept:
+        image[base[k]:base[k] + len(modules[k].words)] = modules[k].words
+
+    def address(name: str) -> int:
+        value = shared(name)
+        k, label = copies[value] if value is not None else (index[name], name)
+        return base[k] + modules[k].exports[label]
+
+    merged = set()
+    for k in kept:
+        module = modules[k]
+        for offset, symbol in module.relocations:
+            if symbol is None:
+                image[base[k] + offset] += base[k]
+            else:
+                image[base[k] + offset] = address(symbol)
+                value = shared(symbol)
+                if value is not None and copies[value] != (index[symbol], symbol):
+                    merged.add(symbol)
+    report = {"modules": [modules[k].name for k in kept],
+              "dropped": [m.name for k, m in enumerate(modules) if not keep[k]],
+              "merged": sorted(merged), "words": len(image)}
+    return image, report
+
+
+def load_module(path: str) -> Module:
+    """An object module, or a source file assembled as one"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path) as f:
+        if path.endswith(".asm"):
+            return assemble_module(f.readlines(), name)
+        return read_module(f)
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine Linker")
+    parser.add_argument("modules", nargs="+",
+                        help="Object modules (.dmo) or sources (.asm); the first is the program")
+    parser.add_argument("-c", "--compile", action="store_true",
+                        help="Only assemble each .asm source to a .dmo module beside it")
+    parser.add_argument("-o", "--output", type=argparse.FileType('w'), default=sys.stdout,
+                        help="Object code output")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Assemble modules or link a program"""
+    args = cli()
+    try:
+        if args.compile:
+            for path in args.modules:
+                module = load_module(path)
+                with open(os.path.splitext(path)[0] + ".dmo", "w") as f:
+                    module.write(f)
+            return
+        image, report = link([load_module(path) for path in args.modules])
+    except (LinkError, SyntaxError) as e:
+        log.error(e)
+        sys.exit(1)
+    log.info("Linked {} modules into {} words; dropped {}; {} constants shared".format(
+        len(report["modules"]), report["words"], len(report["dropped"]), len(report["merged"])))
+    for word in image:
+        print(word, file=args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,11 @@ is an array of 32-bit integers.
 
 from mvc import MVCEvent, MVCListenable
 
-from typing import Callable
+from typing import Callable, List, Sequence, Tuple
 
+import array
+import bisect
+import mmap
 import logging
 
 logging.basicConfig()
@@ -15,6 +18,33 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
 
+# Words in binary memory images are signed 32-bit integers
+WORD_BYTES = 4
+WORD_MIN = -(1 << 31)
+WORD_MAX = (1 << 31) - 1
+WORD_MASK = (1 << 32) - 1
+
+
+def to_word(value: int) -> int:
+    """Wrap an integer to a signed 32-bit word"""
+    if value < WORD_MIN or value > WORD_MAX:
+        value = ((value - WORD_MIN) & WORD_MASK) + WORD_MIN
+    return value
+
+
+def to_word_array(words: Sequence[int]) -> Sequence[int]:
+    """The words as a buffer of signed 32-bit C ints, wrapped as
+    necessary.  Buffers that already hold C ints are used as is.
+    """
+    if ((isinstance(words, array.array) and words.typecode == "i") or
+            (isinstance(words, memoryview) and words.format == "i")):
+        return words
+    try:
+        return array.array("i", words)
+    except OverflowError:
+        return array.array("i", map(to_word, words))
+
+
 class SegFault(Exception):
     """Segmentation fault is actually an operating-system 
     level fault, not a hardware fault, but it's what you 
@@ -46,6 +76,16 @@ class MemoryWrite(MemoryEvent):
         self.value = value
 
 
+class MemoryImageLoaded(MemoryEvent):
+    """A block of words starting at addr has been written at once"""
+
+    def __init__(self, subject: "Memory", addr: int, words: Sequence[int]):
+        self.subject = subject
+        self.addr = addr
+        self.words = words
+        self.value = len(words)
+
+
 class Memory(MVCListenable):
     """Just an array of integers.  Other values are 
     encoded as integers. 
@@ -60,6 +100,14 @@ class Memory(MVCListenable):
         if index < 0 or index >= self.capacity:
             raise SegFault("Memory address {} out of bounds".format(index))
 
+    def _check_block_bounds(self, base: int, count: int) -> int:
+        """Check a block of count words at base; returns its end"""
+        end = base + count
+        if base < 0 or count < 0 or end > self.capacity:
+            raise SegFault("Block of {} words at address {} exceeds memory capacity {}"
+                           .format(count, base, self.capacity))
+        return end
+
     def get(self, index: int) -> int:
         """Fetch a word from memory"""
         log.debug("Fetching word at memory address {}".format(index))
@@ -74,6 +122,237 @@ class Memory(MVCListenable):
         self._mem[index] = value
         self.notify_all(MemoryWrite(self, index, value))
 
+    def load_image(self, words: Sequence[int], base: int = 0) -> None:
+        """Store a whole block of words starting at base, with
+        one bounds check and a single MemoryImageLoaded event
+        instead of one MemoryWrite per word.
+        """
+        end = self._check_block_bounds(base, len(words))
+        self._mem[base:end] = words
+        self.notify_all(MemoryImageLoaded(self, base, words))
+
+    def read_block(self, base: int, count: int) -> Sequence[int]:
+        """Fetch count words starting at base in one operation.
+        Like load_image, this is for bulk transfers and does not
+        announce a MemoryRead for each word.
+        """
+        end = self._check_block_bounds(base, count)
+        return self._mem[base:end]
+
+
+class MappedMemory(Memory):
+    """Memory whose words live in a binary image file that is
+    mapped into the address space of the simulator with mmap.
+    Nothing is read until it is used, so even a very large image
+    "loads" instantly, and pages that are never touched never
+    occupy RAM.
+
+    The image is a sequence of signed 32-bit words in native
+    byte order; capacity is the number of words in the file.
+    With shared=False (the default) the mapping is private
+    (copy-on-write) and the image file is never modified; use
+    save() to keep the final memory state.  With shared=True,
+    stores write through to the file and flush() persists them.
+    """
+
+    def __init__(self, path: str, shared: bool = False) -> None:
+        super().__init__(0)
+        self.path = path
+        self.shared = shared
+        access = mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY
+        with open(path, "r+b" if shared else "rb") as f:
+            # mmap keeps its own duplicate of the file descriptor
+            self._map = mmap.mmap(f.fileno(), 0, access=access)
+        self._mem = memoryview(self._map).cast("i")
+        self.capacity = len(self._mem)
+
+    @classmethod
+    def create(cls, path: str, capacity: int) -> "MappedMemory":
+        """Create a zero-filled image of capacity words and map it
+        shared.  The file is created sparse, so untouched pages take
+        no disk space either.
+        """
+        with open(path, "wb") as f:
+            f.truncate(capacity * WORD_BYTES)
+        return cls(path, shared=True)
+
+    def put(self, index: int, value: int) -> None:
+        """Store a word into memory, wrapped to 32 bits"""
+        super().put(index, to_word(value))
+
+    def load_image(self, words: Sequence[int], base: int = 0) -> None:
+        """Store a block of words, wrapped to 32 bits"""
+        super().load_image(to_word_array(words), base)
+
+    def read_block(self, base: int, count: int) -> Sequence[int]:
+        """Fetch a copy of count words, so no view of the mapping
+        outlives close()
+        """
+        return array.array("i", super().read_block(base, count).tobytes())
+
+    def flush(self) -> None:
+        """Write modified pages back to the image file (shared only)"""
+        if not self.shared:
+            raise ValueError("Private mapping of {} cannot be flushed; use save()"
+                             .format(self.path))
+        self._map.flush()
+
+    def save(self, path: str) -> None:
+        """Write the current memory state to a new image file"""
+        with open(path, "wb") as f:
+            f.write(self._map)
+
+    def close(self) -> None:
+        """Release the mapping; memory may not be used afterward"""
+        self._mem.release()
+        self._map.close()
+
+
+class SparseMemory(Memory):
+    """A very large memory of which only the touched parts exist.
+    The address space is divided into pages of page_size words
+    (a power of two).  A page is allocated, as an array of signed
+    32-bit words, the first time it is written; reading a page that
+    was never written returns zero without allocating it.
+
+    Bounds checks, logging, and events are the same as for the
+    dense Memory, but because pages are arrays of C ints, stored
+    values are wrapped to 32 bits like those of a MappedMemory.
+    """
+
+    def __init__(self, capacity: int = 1 << 24, page_size: int = 4096) -> None:
+        super().__init__(0)
+        if page_size <= 0 or page_size & (page_size - 1):
+            raise ValueError("Page size {} is not a power of two".format(page_size))
+        self.capacity = capacity
+        self.page_size = page_size
+        self._page_shift = page_size.bit_length() - 1
+        self._offset_mask = page_size - 1
+        self._pages = ((capacity + page_size - 1) // page_size) * [None]
+        self.resident_pages = 0
+
+    def _new_page(self, page_num: int) -> array.array:
+        page = array.array("i", bytes(WORD_BYTES * self.page_size))
+        self._pages[page_num] = page
+        self.resident_pages += 1
+        return page
+
+    def get(self, index: int) -> int:
+        """Fetch a word from memory; untouched pages read as zero"""
+        log.debug("Fetching word at memory address {}".format(index))
+        self._check_bounds(index)
+        page = self._pages[index >> self._page_shift]
+        value = 0 if page is None else page[index & self._offset_mask]
+        self.notify_all(MemoryRead(self, index, value))
+        return value
+
+    def put(self, index: int, value: int) -> None:
+        """Store a word into memory, wrapped to 32 bits"""
+        self._check_bounds(index)
+        log.debug("Storing value {} at memory address {}".format(value, index))
+        value = to_word(value)
+        page = self._pages[index >> self._page_shift]
+        if page is None:
+            page = self._new_page(index >> self._page_shift)
+        page[index & self._offset_mask] = value
+        self.notify_all(MemoryWrite(self, index, value))
+
+    def load_image(self, words: Sequence[int], base: int = 0) -> None:
+        """Store a block of words, one page-sized slice at a time"""
+        end = self._check_block_bounds(base, len(words))
+        addr = base
+        while addr < end:
+            page_num = addr >> self._page_shift
+            page = self._pages[page_num]
+            if page is None:
+                page = self._new_page(page_num)
+            offset = addr & self._offset_mask
+            run = min(self.page_size - offset, end - addr)
+            piece = to_word_array(words[addr - base:addr - base + run])
+            if isinstance(piece, memoryview):
+                piece = array.array("i", piece.tobytes())
+            page[offset:offset + run] = piece
+            addr += run
+        self.notify_all(MemoryImageLoaded(self, base, words))
+
+    def read_block(self, base: int, count: int) -> Sequence[int]:
+        """Fetch count words, with zeros for untouched pages"""
+        end = self._check_block_bounds(base, count)
+        block = array.array("i")
+        addr = base
+        while addr < end:
+            page = self._pages[addr >> self._page_shift]
+            offset = addr & self._offset_mask
+            run = min(self.page_size - offset, end - addr)
+            if page is None:
+                block.frombytes(bytes(WORD_BYTES * run))
+            else:
+                block.extend(page[offset:offset + run])
+            addr += run
+        return block
+
+    def touched_pages(self) -> Sequence[int]:
+        """Page numbers of the pages that have been written"""
+        return [num for num, page in enumerate(self._pages) if page is not None]
+
+    def stats(self) -> dict:
+        """Page usage, for sizing page pools"""
+        total = len(self._pages)
+        return {"page_size": self.page_size,
+                "pages": total,
+                "resident_pages": self.resident_pages,
+                "resident_bytes": self.resident_pages * self.page_size * WORD_BYTES,
+                "resident_fraction": self.resident_pages / total if total else 0.0}
+
+
+class Device(object):
+    """Abstract base class for devices on the memory bus.
+    A device is attached to a window of consecutive addresses;
+    it sees reads and writes as offsets within that window.
+    Override read and write; override read_block and write_block
+    too if the device can move many words more cheaply than
+    one at a time.
+    """
+    # True for devices that change memory behind the CPU's back (DMA)
+    writes_memory = False
+
+    def read(self, offset: int) -> int:
+        raise NotImplementedError("The read method should be overridden in {}".format(self.__class__))
+
+    def write(self, offset: int, value: int) -> None:
+        raise NotImplementedError("The write method should be overridden in {}".format(self.__class__))
+
+    def read_block(self, offset: int, count: int) -> List[int]:
+        return [self.read(offset + i) for i in range(count)]
+
+    def write_block(self, offset: int, words: Sequence[int]) -> None:
+        for i, word in enumerate(words):
+            self.write(offset + i, word)
+
+
+class HookDevice(Device):
+    """A single address with hook functions, as registered by
+    map_address_in and map_address_out.  If only one direction
+    has a hook, the other goes to ordinary memory.
+    """
+
+    def __init__(self, memory: "MemoryMappedIO", addr: int) -> None:
+        self.memory = memory
+        self.addr = addr
+        self.read_hook = None
+        self.write_hook = None
+
+    def read(self, offset: int) -> int:
+        if self.read_hook is None:
+            return super(MemoryMappedIO, self.memory).get(self.addr)
+        return self.read_hook(self.addr)
+
+    def write(self, offset: int, value: int) -> None:
+        if self.write_hook is None:
+            super(MemoryMappedIO, self.memory).put(self.addr, value)
+        else:
+            self.write_hook(self.addr, value)
+
 
 class MemoryMappedIO(Memory):
     """Use a few otherwise unused addresses for input/output. 
@@ -81,34 +360,198 @@ class MemoryMappedIO(Memory):
     device commands by interpreting some memory addresses as 
     as commands. This is not done in the CPU, but by connecting 
     to the bus (wires) between CPU and memory. 
+
+    Devices are attached to windows (ranges) of addresses.
+    Every address outside io_base .. io_end - 1, the span from
+    the lowest device window to the end of the highest, is plain
+    memory, so most loads, stores, and instruction fetches cost
+    only one range test; addresses inside the span are looked up
+    among the windows by binary search.  Windows may lie beyond
+    the capacity of the memory.
     """
 
-    def __init__(self, capacity: int = 1024) -> None:
-        super().__init__(capacity)
-        self.hooks_read = {}
-        self.hooks_write = {}
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.io_base = 0
+        self.io_end = 0
+        self._window_bases = []   # Sorted, parallel to _windows
+        self._windows = []        # (base, end, device)
+
+    def attach(self, device: Device, base: int, size: int = 1) -> None:
+        """Attach device to addresses base .. base + size - 1"""
+        end = base + size
+        if size < 1 or base < 0:
+            raise ValueError("Bad device window {}..{}".format(base, end - 1))
+        i = bisect.bisect(self._window_bases, base)
+        if ((i > 0 and self._windows[i - 1][1] > base) or
+                (i < len(self._windows) and self._windows[i][0] < end)):
+            raise ValueError("Device window {}..{} overlaps another device"
+                             .format(base, end - 1))
+        self._window_bases.insert(i, base)
+        self._windows.insert(i, (base, end, device))
+        self._set_io_span()
+
+    def _set_io_span(self) -> None:
+        if self._windows:
+            self.io_base = self._windows[0][0]
+            self.io_end = max(end for base, end, device in self._windows)
+        else:
+            self.io_base = self.io_end = 0
+
+    def detach(self, device: Device) -> None:
+        """Remove device from the bus"""
+        keep = [window for window in self._windows if window[2] is not device]
+        self._windows = keep
+        self._window_bases = [base for base, end, dev in keep]
+        self._set_io_span()
+
+    def device_at(self, index: int) -> Tuple[Device, int]:
+        """The device whose window includes index, and its base
+        address, or (None, None) for plain memory.
+        """
+        i = bisect.bisect(self._window_bases, index) - 1
+        if i >= 0:
+            base, end, device = self._windows[i]
+            if index < end:
+                return device, base
+        return None, None
+
+    def devices(self) -> List[Device]:
+        """Every attached device, in address order"""
+        return [device for base, end, device in self._windows]
 
     def map_address_in(self, addr: int,
                        hook: Callable[[int], int]) -> None:
         """Memory reads of this address will call the hook function"""
-        self.hooks_read[addr] = hook
+        self._hook_device(addr).read_hook = hook
 
     def map_address_out(self, addr: int,
                         hook: Callable[[int, int], None]) -> None:
         """Memory writes of this address will call the hook function"""
-        self.hooks_write[addr] = hook
+        self._hook_device(addr).write_hook = hook
+
+    def _hook_device(self, addr: int) -> HookDevice:
+        device, base = self.device_at(addr)
+        if isinstance(device, HookDevice):
+            return device
+        device = HookDevice(self, addr)
+        self.attach(device, addr)
+        return device
 
     def get(self, index: int) -> int:
-        """Hook OR Fetch a word from memory"""
-        if index in self.hooks_read:
-            hook = self.hooks_read[index]
-            return hook(index)
-        return super().get(index)
+        """Device read OR Fetch a word from memory"""
+        if not self.io_base <= index < self.io_end:
+            return super().get(index)
+        device, base = self.device_at(index)
+        if device is None:
+            return super().get(index)
+        return device.read(index - base)
 
     def put(self, index: int, value: int) -> None:
-        """Hook OR Store a word into memory"""
-        if index in self.hooks_write:
-            hook = self.hooks_write[index]
-            hook(index, value)
+        """Device write OR Store a word into memory"""
+        if not self.io_base <= index < self.io_end:
+            super().put(index, value)
             return
-        super().put(index, value)
+        device, base = self.device_at(index)
+        if device is None:
+            super().put(index, value)
+        else:
+            device.write(index - base, value)
+
+    def _segments(self, base: int, count: int) -> List[Tuple[int, int, Device, int]]:
+        """Split a block into (start, end, device, window base)
+        pieces, with device None for plain memory.  Every piece is
+        checked before the block is split, so a transfer that would
+        fail changes nothing.
+        """
+        end = base + count
+        pieces = []
+        addr = base
+        for win_base, win_end, device in self._windows + [(end, end, None)]:
+            if win_end <= addr:
+                continue
+            ram_end = min(win_base, end)
+            if addr < ram_end:
+                self._check_block_bounds(addr, ram_end - addr)
+                pieces.append((addr, ram_end, None, None))
+                addr = ram_end
+            if device is None or addr >= end:
+                break
+            dev_end = min(win_end, end)
+            pieces.append((addr, dev_end, device, win_base))
+            addr = dev_end
+        return pieces
+
+    def overlaps_device(self, base: int, count: int) -> bool:
+        """Does any device window include part of this block?"""
+        # Windows do not overlap, so the last one starting before
+        # the end of the block also ends last among those
+        i = bisect.bisect_left(self._window_bases, base + count) - 1
+        return count > 0 and i >= 0 and self._windows[i][1] > base
+
+    def load_image(self, words: Sequence[int], base: int = 0) -> None:
+        """Store a block of words; parts that fall in device
+        windows go to the devices' write_block.
+        """
+        if base + len(words) <= self.io_base or base >= self.io_end:
+            super().load_image(words, base)
+            return
+        for start, end, device, win_base in self._segments(base, len(words)):
+            piece = words[start - base:end - base]
+            if device is None:
+                super().load_image(piece, start)
+            else:
+                device.write_block(start - win_base, piece)
+
+    def read_block(self, base: int, count: int) -> Sequence[int]:
+        """Fetch a block of words; parts that fall in device
+        windows come from the devices' read_block.
+        """
+        if base + count <= self.io_base or base >= self.io_end:
+            return super().read_block(base, count)
+        block = []
+        for start, end, device, win_base in self._segments(base, count):
+            if device is None:
+                block.extend(super().read_block(start, end - start))
+            else:
+                block.extend(device.read_block(start - win_base, end - start))
+        return block
+
+    def load_program(self, words: Sequence[int], base: int = 0) -> None:
+        """Like load_image, but words that fall in device windows
+        are skipped: a program large enough to reach the devices
+        is assembled around them (see assembler_pass1.RESERVED),
+        and the hole it leaves is not meant for the devices.
+        """
+        if base + len(words) <= self.io_base or base >= self.io_end:
+            super().load_image(words, base)
+            return
+        for start, end, device, win_base in self._segments(base, len(words)):
+            if device is None:
+                super().load_image(words[start - base:end - base], start)
+
+    def load_ram_image(self, words: Sequence[int], base: int = 0) -> None:
+        """Like load_image, but only for plain memory: a block that
+        overlaps a device window is refused with SegFault.
+        """
+        if self.overlaps_device(base, len(words)):
+            raise SegFault("Block of {} words at address {} overlaps a device"
+                           .format(len(words), base))
+        super().load_image(words, base)
+
+    def read_ram_block(self, base: int, count: int) -> Sequence[int]:
+        """Like read_block, but only for plain memory"""
+        if self.overlaps_device(base, count):
+            raise SegFault("Block of {} words at address {} overlaps a device"
+                           .format(count, base))
+        return super().read_block(base, count)
+
+
+class MappedMemoryIO(MemoryMappedIO, MappedMemory):
+    """A memory-mapped image with memory-mapped input/output"""
+    pass
+
+
+class SparseMemoryIO(MemoryMappedIO, SparseMemory):
+    """A sparse paged memory with memory-mapped input/output"""
+    pass
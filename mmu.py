@@ -0,0 +1,247 @@
+"""
+Virtual memory for the Duck Machine.
+
+The Duck Machine itself has no virtual memory (see
+docs/duck_machine.md).  An MMU can be placed between the CPU and
+memory: CPU(MMU(memory)).  Until a program turns translation on,
+the MMU passes addresses straight through at no cost.  With
+translation on, a virtual address is split into a page number and
+an offset, and the page number is translated through a page table
+held in guest memory:
+
+    entry = memory[PTBR + page]
+    frame = entry >> PTE_SHIFT, flags PTE_VALID and PTE_WRITABLE
+
+Translations are cached in a TLB, so the common case is one
+dictionary lookup.  A missing or invalid entry, or a write to a
+read-only page, is a page fault.  A fault goes first to the host
+callback, if any, which may fix the page table and ask for a
+retry; otherwise to the guest handler, if one is set, as a CPU
+trap; otherwise it is a PageFault error.
+
+The MMU registers are a device on the physical bus, so a program
+that turns translation on must map their page to reach them.
+"""
+
+from memory import Memory, Device, SegFault
+from cpu import CPU, Trap
+from cache import REPLACEMENT_POLICIES
+
+from typing import Callable, Optional
+
+import collections
+import random
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# Page table entry flags; the frame number is above them
+PTE_VALID = 1
+PTE_WRITABLE = 2
+PTE_SHIFT = 2
+
+# MMU registers, as offsets within its window
+MMU_PTBR = 0          # Physical address of the page table
+MMU_CONTROL = 1       # 1 translates addresses, 0 does not
+MMU_HANDLER = 2       # Virtual address of the page fault handler, 0 for none
+MMU_FLUSH = 3         # Write anything to empty the TLB
+MMU_FAULT_ADDR = 4    # Virtual address of the last fault
+MMU_FAULT_PC = 5      # Address of the instruction that faulted
+MMU_FAULT_WRITE = 6   # 1 if the last fault was a write
+MMU_RETURN = 7        # Write anything to retry the faulted instruction
+MMU_REGISTERS = 8
+
+
+class PageFault(SegFault):
+    """A page fault with nowhere to go"""
+
+    def __init__(self, addr: int, write: bool, message: str = "") -> None:
+        super().__init__(message or "Page fault {} address {}".format(
+            "writing" if write else "reading", addr))
+        self.addr = addr
+        self.write = write
+
+
+class TLB(object):
+    """Translation lookaside buffer: page number -> (frame base
+    address, writable), in sets of dictionaries.  Hits cost a
+    dictionary lookup, plus a reordering for LRU replacement.
+    """
+
+    def __init__(self, entries: int = 16, ways: int = 4, policy: str = "lru") -> None:
+        if policy not in REPLACEMENT_POLICIES:
+            raise ValueError("Unknown replacement policy {}".format(policy))
+        if entries % ways:
+            raise ValueError("TLB entries {} is not a multiple of {} ways".format(entries, ways))
+        self.entries = entries
+        self.ways = ways
+        self.policy = policy
+        self.n_sets = entries // ways
+        self.sets = [collections.OrderedDict() for i in range(self.n_sets)]
+        self._random = random.Random(0)   # Repeatable runs
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, page: int) -> Optional[tuple]:
+        entries = self.sets[page % self.n_sets]
+        translation = entries.get(page)
+        if translation is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == "lru":
+            entries.move_to_end(page)
+        return translation
+
+    def insert(self, page: int, translation: tuple) -> None:
+        entries = self.sets[page % self.n_sets]
+        if page not in entries and len(entries) >= self.ways:
+            if self.policy == "random":
+                del entries[self._random.choice(list(entries))]
+            else:
+                # Oldest first: least recently used, or first in
+                entries.popitem(last=False)
+        entries[page] = translation
+
+    def flush(self) -> None:
+        for entries in self.sets:
+            entries.clear()
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class MMU(object):
+    """Translates CPU addresses to physical memory addresses.
+    on_fault(mmu, addr, write) is the host callback for page
+    faults; it returns True if it has fixed the page table.
+    """
+
+    def __init__(self, memory: Memory, page_size: int = 256, pages: int = 1024,
+                 tlb: TLB = None,
+                 on_fault: Callable[["MMU", int, bool], bool] = None) -> None:
+        if page_size <= 0 or page_size & (page_size - 1):
+            raise ValueError("Page size {} is not a power of two".format(page_size))
+        self.memory = memory
+        self.page_size = page_size
+        self._shift = page_size.bit_length() - 1
+        self._mask = page_size - 1
+        self.pages = pages
+        self.tlb = tlb if tlb is not None else TLB()
+        self.on_fault = on_fault
+        self.cpu = None        # Set by MMUControl, for guest fault handlers
+        self.ptbr = 0
+        self.handler = 0
+        self.fault_addr = 0
+        self.fault_write = False
+        self.in_handler = False
+        self.walks = 0
+        self.faults = 0
+        self.enable(False)
+
+    def enable(self, on: bool) -> None:
+        """Turn translation on or off.  Off, get and put are the
+        physical memory's own methods.
+        """
+        self.enabled = on
+        self.tlb.flush()
+        if on:
+            self.get = self._translated_get
+            self.put = self._translated_put
+        else:
+            self.get = self.memory.get
+            self.put = self.memory.put
+
+    def _walk(self, page: int, write: bool, addr: int) -> tuple:
+        """Read the page table entry for page into the TLB"""
+        while True:
+            if 0 <= page < self.pages:
+                self.walks += 1
+                entry = self.memory.get(self.ptbr + page)
+                if entry & PTE_VALID and (entry & PTE_WRITABLE or not write):
+                    translation = ((entry >> PTE_SHIFT) << self._shift,
+                                   bool(entry & PTE_WRITABLE))
+                    self.tlb.insert(page, translation)
+                    return translation
+            self.faults += 1
+            if not (self.on_fault and self.on_fault(self, addr, write)):
+                self._deliver(addr, write)
+
+    def _deliver(self, addr: int, write: bool) -> None:
+        """Raise a trap to the guest handler, or a PageFault"""
+        if self.handler and self.cpu is not None and not self.in_handler:
+            self.fault_addr = addr
+            self.fault_write = write
+            self.in_handler = True
+            raise Trap(self.handler, "Page fault at {}".format(addr))
+        raise PageFault(addr, write)
+
+    def translate(self, addr: int, write: bool = False) -> int:
+        """Physical address for virtual address addr"""
+        page = addr >> self._shift
+        translation = self.tlb.lookup(page)
+        if translation is None or (write and not translation[1]):
+            translation = self._walk(page, write, addr)
+        return translation[0] | (addr & self._mask)
+
+    def _translated_get(self, addr: int) -> int:
+        return self.memory.get(self.translate(addr))
+
+    def _translated_put(self, addr: int, value: int) -> None:
+        self.memory.put(self.translate(addr, True), value)
+
+    def resume(self) -> None:
+        """Retry the faulted instruction (guest handler finished)"""
+        self.in_handler = False
+        self.cpu.resume()
+
+    def stats(self) -> dict:
+        return {"tlb_hits": self.tlb.hits, "tlb_misses": self.tlb.misses,
+                "tlb_hit_rate": self.tlb.hit_rate(),
+                "page_walks": self.walks, "page_faults": self.faults}
+
+
+class MMUControl(Device):
+    """The MMU registers.  Setting the page table base or turning
+    translation on or off empties the TLB.
+    """
+
+    def __init__(self, mmu: MMU, cpu: CPU) -> None:
+        self.mmu = mmu
+        self.cpu = cpu
+        mmu.cpu = cpu
+
+    def read(self, offset: int) -> int:
+        mmu = self.mmu
+        if offset == MMU_PTBR:
+            return mmu.ptbr
+        elif offset == MMU_CONTROL:
+            return int(mmu.enabled)
+        elif offset == MMU_HANDLER:
+            return mmu.handler
+        elif offset == MMU_FAULT_ADDR:
+            return mmu.fault_addr
+        elif offset == MMU_FAULT_PC:
+            return self.cpu.trap_pc
+        elif offset == MMU_FAULT_WRITE:
+            return int(mmu.fault_write)
+        return 0
+
+    def write(self, offset: int, value: int) -> None:
+        mmu = self.mmu
+        if offset == MMU_PTBR:
+            mmu.ptbr = value
+            mmu.tlb.flush()
+        elif offset == MMU_CONTROL:
+            mmu.enable(bool(value))
+        elif offset == MMU_HANDLER:
+            mmu.handler = value
+        elif offset == MMU_FLUSH:
+            mmu.tlb.flush()
+        elif offset == MMU_RETURN:
+            mmu.resume()
+        else:
+            log.warning("Ignoring write of {} to MMU register {}".format(value, offset))
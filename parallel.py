@@ -0,0 +1,249 @@
+"""
+Assemble one very large source on several processors.
+
+The source file is cut into chunks at line ends, one per worker
+process.  Each worker reads and scans its own chunk, and reports
+its size in words, the labels it defines (at offsets within the
+chunk) and the symbols it uses but does not define.  The first
+chunk also leaves the hole for the devices, if it reaches them.
+The parent adds up the sizes to find where each chunk starts,
+makes the global symbol table, and sends each worker the addresses
+of the symbols it needs.  The workers then encode their chunks at
+the same time, and the parent writes their text out in order.
+
+Relaxation (assembler_pass1.relax) is the one part of assembly
+that needs the whole program.  The chunks are laid out as written,
+with the hole where relaxation would put it.  If that layout is
+not what relaxation gives, the whole file is assembled serially
+instead.  That happens when a reference is out of reach, or the
+hole is not in the first chunk.  It also happens when anything is
+wrong with the source, so errors are reported exactly as Assembly
+reports them.  Either way, the output is the same, byte for byte,
+as `python3 assembler.py`.
+
+    python3 assembler.py big.asm big.obj --jobs 8
+"""
+
+from assembler import Assembly, hole_site
+from assembler_pass1 import MIN_OFFSET, MAX_OFFSET, RESERVED, SyntaxError
+from instr_format import Instruction, OpCode, CondFlag
+from lexer import lex_lines, FULL
+
+from multiprocessing import Pipe, Process
+from typing import List, Optional, TextIO
+
+import os
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PC = 15
+MIN_CHUNK = 1 << 20     # Bytes; smaller sources are not worth the processes
+
+
+def split(path: str, count: int) -> List[tuple]:
+    """(start, end) byte ranges of about count chunks of a file,
+    each ending at a line end
+    """
+    size = os.path.getsize(path)
+    step = max(1, size // count)
+    ranges = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            end = min(size, start + step)
+            if end < size:
+                f.seek(end)
+                rest = f.readline()
+                end += len(rest)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_lines(path: str, start: int, end: int) -> List[str]:
+    """Lines of a byte range, as readlines() in text mode gives them"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode()
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+class _Chunk(object):
+    """A worker's chunk: its records, with the hole if it has it"""
+
+    def __init__(self, lines: List[str], first: bool, reserved: Optional[tuple]) -> None:
+        self.records = lex_lines(lines)
+        self.hole = None        # (index, words)
+        self.size = sum(1 for record in self.records if record.word)
+        if first and reserved is not None and self.size > reserved[0]:
+            low, high = reserved
+            site = hole_site(self.records, 0, True, low)
+            if site is None:
+                raise SyntaxError("No room for the hole")
+            i, jump = site
+            addr = sum(1 for record in self.records[:i] if record.word)
+            words = [0] * (high - addr)
+            if jump:
+                words[0] = Instruction(OpCode.ADD, CondFlag.ALWAYS, PC, 0, PC,
+                                       high - addr).encode()
+            self.hole = (i, words)
+            self.size += len(words)
+        self.labels = {}
+        addr = 0
+        for k, record in enumerate(self.records):
+            if self.hole is not None and k == self.hole[0]:
+                addr += len(self.hole[1])
+            if record.label:
+                if record.label in self.labels:
+                    raise SyntaxError("Duplicate label {}".format(record.label))
+                self.labels[record.label] = addr
+            if record.word:
+                addr += 1
+        self.needs = set(record.symbol for record in self.records
+                         if record.symbol is not None and record.symbol not in self.labels)
+        self.r15 = any(record.kind is FULL and "r15" in (record["src1"], record["src2"])
+                       for record in self.records)
+
+    def encode(self, base: int, table: dict) -> str:
+        """The chunk's object code, loaded at base; table has the
+        addresses of the symbols it needs.  Raises SyntaxError if
+        a reference is out of reach.
+        """
+        out = []
+        addr = base
+        for k, record in enumerate(self.records):
+            if self.hole is not None and k == self.hole[0]:
+                out.extend(self.hole[1])
+                addr += len(self.hole[1])
+            if not record.word:
+                continue
+            symbol = record.symbol
+            if symbol is None:
+                out.append(record.encode())
+            else:
+                target = base + self.labels[symbol] if symbol in self.labels else table[symbol]
+                if not MIN_OFFSET <= target - addr <= MAX_OFFSET:
+                    raise SyntaxError("{} is out of reach".format(symbol))
+                out.append(record.encode(target - addr))
+            addr += 1
+        return "".join("{}\n".format(word) for word in out)
+
+
+def _work(path: str, start: int, end: int, first: bool, reserved: Optional[tuple],
+          conn) -> None:
+    """A worker: scan a chunk, report on it, and encode it when
+    told where it goes.  Any failure is reported as None.
+    """
+    try:
+        chunk = _Chunk(read_lines(path, start, end), first, reserved)
+        conn.send((chunk.size, chunk.labels, chunk.needs, chunk.r15, chunk.hole is not None))
+    except (SyntaxError, KeyError, UnicodeDecodeError):
+        conn.send(None)
+        return
+    orders = conn.recv()
+    if orders is None:
+        return
+    base, table = orders
+    try:
+        conn.send(chunk.encode(base, table))
+    except (SyntaxError, KeyError):
+        conn.send(None)
+
+
+def assemble_parallel(path: str, out: TextIO, jobs: int = None,
+                      reserved: tuple = RESERVED) -> int:
+    """Assemble a source file on jobs processors, writing object
+    code to out as assembler.py would.  Returns the number of
+    words.  Raises AssemblyError, before writing anything, if the
+    program has errors.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    ranges = split(path, jobs) if os.path.getsize(path) >= MIN_CHUNK else []
+    words = None
+    if len(ranges) > 1:
+        words = _in_parallel(path, ranges, reserved)
+    if words is None:
+        return _serially(path, out, reserved)
+    count = 0
+    for text, size in words:
+        out.write(text)
+        count += size
+    return count
+
+
+def _in_parallel(path: str, ranges: List[tuple], reserved: Optional[tuple]) -> Optional[list]:
+    """[(text, words)] for each chunk, or None if the program must
+    be assembled serially
+    """
+    workers = []
+    for k, (start, end) in enumerate(ranges):
+        parent, child = Pipe()
+        process = Process(target=_work, args=(path, start, end, k == 0, reserved, child))
+        process.start()
+        workers.append((process, parent))
+    try:
+        reports = [conn.recv() for _, conn in workers]
+        orders = _plan(reports, reserved)
+        if orders is None:
+            return None
+        for (_, conn), order in zip(workers, orders):
+            conn.send(order)
+        results = [conn.recv() for _, conn in workers]
+        if any(text is None for text in results):
+            return None
+        return [(text, report[0]) for text, report in zip(results, reports)]
+    except EOFError:
+        log.warning("A worker died; assembling {} serially".format(path))
+        return None
+    finally:
+        for process, conn in workers:
+            if process.is_alive():
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+            process.join()
+
+
+def _plan(reports: List[tuple], reserved: Optional[tuple]) -> Optional[List[tuple]]:
+    """(base, symbol table) for each chunk, from the sizes and
+    labels of all of them; None if the layout is not relaxation's
+    """
+    if any(report is None for report in reports):
+        return None
+    bases = []
+    total = 0
+    for size, labels, needs, r15, hole in reports:
+        bases.append(total)
+        total += size
+    has_hole = reports[0][4]
+    if reserved is not None and total > reserved[0] and not has_hole:
+        return None     # The hole would be in a later chunk
+    if has_hole and any(report[3] for report in reports):
+        return None     # Relaxation refuses code addressed relative to r15
+    table = {}
+    for base, (size, labels, needs, r15, hole) in zip(bases, reports):
+        for label, offset in labels.items():
+            if label in table:
+                return None
+            table[label] = base + offset
+    orders = []
+    for base, (size, labels, needs, r15, hole) in zip(bases, reports):
+        if any(symbol not in table for symbol in needs):
+            return None
+        orders.append((base, {symbol: table[symbol] for symbol in needs}))
+    return orders
+
+
+def _serially(path: str, out: TextIO, reserved: Optional[tuple]) -> int:
+    with open(path) as f:
+        words = Assembly(f.readlines(), reserved=reserved).words
+    out.write("".join("{}\n".format(word) for word in words))
+    return len(words)
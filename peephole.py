@@ -0,0 +1,470 @@
+"""
+Peephole optimizer for Duck Machine assembly code.
+
+Runs on symbolic assembly, after assembler_pass1 has parsed it
+and before labels are resolved to PC-relative offsets, so a
+rewrite may delete instructions without patching any offsets.
+The rewrites are
+
+* reuse: a LOAD of a variable a register already holds (from a
+  LOAD or STORE earlier in the same straight-line code) is
+  deleted, or becomes a register copy;
+* constants: a LOAD of a DATA word that is never stored to and
+  fits in the displacement becomes ADD rX,r0,r0[value];
+* jumps to the next instruction are deleted;
+* instructions control cannot reach (e.g. after HALT) are deleted;
+* identical read-only DATA words are merged, and DATA words
+  nothing refers to are dropped.
+
+Every Duck Machine instruction sets the condition code, so an
+instruction is only deleted or changed if the next instruction
+executed is unpredicated, and overwrites the condition code
+before anything can test it.
+
+A program that addresses its own image directly (r15 or an
+absolute address in a fully resolved instruction, a computed
+address, or a jump through memory) could depend on where each
+word is, so for such programs only same-size rewrites are made.
+
+    python3 peephole.py programs/*.asm --write-dir optimized
+"""
+
+from assembler_pass1 import parse_line, AsmSrcKind
+from assembler_pass1 import resolve, MIN_OFFSET, MAX_OFFSET
+from assembler_pass2 import assemble, value_parse
+from memory import MemoryMappedIO
+from devices import ConsoleIn, ConsoleOut
+from cpu import CPU
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import argparse
+import collections
+import io
+import os
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+MAX_ROUNDS = 10            # Rewrites enable more rewrites; stop after this many rounds
+MAX_STEPS = 10000000       # Give up measuring a program that runs this long
+
+RULES = ["reuse", "constant", "jump", "unreachable", "merge", "data"]
+
+
+class Item(object):
+    """One source line.  text is what we will write out;
+    names are the labels that name this word (for lines that
+    hold a word), including labels on lines before it.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.fields = parse_line(text)
+        self.dead = False
+        self.names = []
+
+    @property
+    def word(self) -> bool:
+        return self.fields["kind"] != AsmSrcKind.COMMENT
+
+    @property
+    def instruction(self) -> bool:
+        return self.fields["kind"] in (AsmSrcKind.FULL, AsmSrcKind.SYMBOLIC)
+
+    @property
+    def always(self) -> bool:
+        return self.fields["predicate"] in (None, "ALWAYS")
+
+    def rewrite(self, text: str) -> None:
+        label = self.fields["label"]
+        comment = self.fields["comment"]
+        self.text = "{}{}{}".format("{}: ".format(label) if label else "   ", text,
+                                    "  " + comment if comment else "")
+        self.fields = parse_line(self.text)
+
+
+class Source(object):
+    """An assembly program being optimized"""
+
+    def __init__(self, lines: Sequence[str]) -> None:
+        self.items = [Item(line.rstrip("\n")) for line in lines]
+        self.counts = collections.Counter()
+        self.layout()
+
+    def layout(self) -> None:
+        """Recompute the live words, the labels naming them, and
+        what refers to what
+        """
+        self.words = []
+        self.address = {}     # Label -> index in self.words
+        pending = []
+        for item in self.items:
+            label = item.fields["label"]
+            if label:
+                pending.append(label)
+            if item.word and not item.dead:
+                item.names = pending
+                for name in pending:
+                    self.address[name] = len(self.words)
+                self.words.append(item)
+                pending = []
+        self.refs = collections.Counter()
+        self.stored = set()   # Words stored to, by any of their names
+        for item in self.words:
+            fields = item.fields
+            if fields["kind"] == AsmSrcKind.SYMBOLIC:
+                self.refs[fields["symbol"]] += 1
+                if fields["opcode"] == "STORE":
+                    self.stored.add(self.word_of(fields["symbol"]))
+        self.movable = self._movable()
+
+    def word_of(self, symbol: str):
+        """The word symbol names, so that labels of one word are
+        one variable; symbol itself if it names none
+        """
+        return self.address.get(symbol, symbol)
+
+    def _movable(self) -> bool:
+        """Can words move without changing what the program does?"""
+        for item in self.words:
+            fields = item.fields
+            kind = fields["kind"]
+            if kind == AsmSrcKind.FULL:
+                if "r15" in (fields["target"], fields["src1"], fields["src2"]):
+                    return False
+                if fields["opcode"] in ("LOAD", "STORE"):
+                    if fields["src1"] != "r0" or fields["src2"] != "r0":
+                        return False
+                    if int(fields["offset"] or 0) < len(self.words):
+                        return False
+            elif kind == AsmSrcKind.SYMBOLIC:
+                if fields["opcode"] != "JUMP" and fields["target"] in (None, "r15"):
+                    return False
+                target = self.address.get(fields["symbol"])
+                if target is None:
+                    return False
+                if fields["opcode"] != "JUMP" and self.words[target].instruction:
+                    return False
+        return True
+
+    def next_sets_flags(self, index: int) -> bool:
+        """Is the word after words[index] an unpredicated
+        instruction, so the condition code words[index] leaves
+        is never tested?
+        """
+        for item in self.words[index + 1:]:
+            if not item.dead:
+                return item.instruction and item.always
+        return False
+
+    def constants(self) -> Dict[str, int]:
+        """Labels of DATA words never stored to, and their values"""
+        values = {}
+        for item in self.words:
+            if item.fields["kind"] == AsmSrcKind.DATA and item.fields["value"]:
+                if item.names and self.word_of(item.names[0]) not in self.stored:
+                    for name in item.names:
+                        values[name] = value_parse(item.fields["value"])
+        return values
+
+    def delete(self, item: Item, rule: str) -> None:
+        item.dead = True
+        self.counts[rule] += 1
+
+    def lines(self) -> List[str]:
+        """The optimized program.  Labels on deleted lines are kept,
+        on lines of their own, if anything still refers to them.
+        """
+        out = []
+        for item in self.items:
+            if not item.dead:
+                out.append(item.text)
+            elif item.fields["label"] and self.refs[item.fields["label"]]:
+                out.append("{}:".format(item.fields["label"]))
+        return out
+
+
+def _reuse(source: Source) -> bool:
+    """Forward pass over straight-line code, tracking which
+    variable each register holds
+    """
+    changed = False
+    constants = source.constants() if source.movable else {}
+    holds = {}   # Register -> variable, as the word it names
+    for index, item in enumerate(source.words):
+        if item.dead:
+            continue
+        if item.names:
+            holds.clear()
+        fields = item.fields
+        kind = fields["kind"]
+        op = fields["opcode"]
+        if kind == AsmSrcKind.SYMBOLIC:
+            symbol = fields["symbol"]
+            variable = source.word_of(symbol)
+            reg = fields["target"]
+            if op == "JUMP":
+                if item.always:
+                    holds.clear()
+                continue
+            if op == "STORE":
+                for held in [r for r, var in holds.items() if var == variable]:
+                    del holds[held]
+                if item.always and reg != "r0":
+                    holds[reg] = variable
+                continue
+            # LOAD
+            holder = next((r for r, var in holds.items() if var == variable), None)
+            if item.always and reg != "r15" and source.next_sets_flags(index):
+                if holder == reg and source.movable:
+                    source.delete(item, "reuse")
+                    changed = True
+                    continue
+                if holder is not None and holder != reg:
+                    item.rewrite("ADD  {},{},r0".format(reg, holder))
+                    source.counts["reuse"] += 1
+                    changed = True
+                elif symbol in constants and MIN_OFFSET <= constants[symbol] <= MAX_OFFSET:
+                    item.rewrite("ADD  {},r0,r0[{}]".format(reg, constants[symbol]))
+                    source.counts["constant"] += 1
+                    changed = True
+                    holds.pop(reg, None)
+                    continue
+            holds.pop(reg, None)
+            if item.always:
+                holds[reg] = variable
+        elif kind == AsmSrcKind.FULL:
+            if op == "STORE":
+                if (fields["src1"], fields["src2"]) != ("r0", "r0") or \
+                        int(fields["offset"] or 0) < len(source.words):
+                    holds.clear()
+            elif op == "HALT" or fields["target"] == "r15":
+                holds.clear()
+            else:
+                holds.pop(fields["target"], None)
+        else:
+            holds.clear()
+    return changed
+
+
+def _jumps(source: Source) -> bool:
+    """Delete jumps to the next word"""
+    changed = False
+    for index, item in enumerate(source.words):
+        if item.dead or item.fields["kind"] != AsmSrcKind.SYMBOLIC or \
+                item.fields["opcode"] != "JUMP":
+            continue
+        following = next((i for i in range(index + 1, len(source.words))
+                          if not source.words[i].dead), len(source.words))
+        if source.address.get(item.fields["symbol"]) == following and \
+                source.next_sets_flags(index):
+            source.delete(item, "jump")
+            changed = True
+    return changed
+
+
+def _reachable(source: Source) -> Optional[List[bool]]:
+    """Which words control can reach from the first, or None if
+    control may run into a DATA word
+    """
+    words = source.words
+    reached = len(words) * [False]
+    work = [0] if words else []
+    while work:
+        index = work.pop()
+        if index >= len(words) or reached[index]:
+            continue
+        item = words[index]
+        if not item.instruction:
+            return None
+        reached[index] = True
+        fields = item.fields
+        if fields["kind"] == AsmSrcKind.SYMBOLIC and fields["opcode"] == "JUMP":
+            work.append(source.address[fields["symbol"]])
+            if item.always:
+                continue
+        elif fields["opcode"] == "HALT" and item.always:
+            continue
+        work.append(index + 1)
+    return reached
+
+
+def _unreachable(source: Source) -> bool:
+    """Delete instructions control cannot reach"""
+    reached = _reachable(source)
+    if reached is None:
+        return False
+    changed = False
+    live_refs = collections.Counter(
+        item.fields["symbol"] for item, r in zip(source.words, reached)
+        if r and item.fields["kind"] == AsmSrcKind.SYMBOLIC)
+    for item, r in zip(source.words, reached):
+        if item.instruction and not r and not any(live_refs[n] for n in item.names):
+            source.delete(item, "unreachable")
+            changed = True
+    return changed
+
+
+def _data(source: Source) -> bool:
+    """Merge identical read-only DATA words, and drop DATA words
+    nothing refers to.  Only if control never runs into DATA.
+    """
+    if _reachable(source) is None:
+        return False
+    changed = False
+    constants = source.constants()
+    first = {}      # Value -> label of the first read-only word holding it
+    renames = {}
+    for item in source.words:
+        if item.fields["kind"] != AsmSrcKind.DATA or not item.names:
+            continue
+        readonly = [name for name in item.names if name in constants]
+        if len(readonly) < len(item.names):
+            continue
+        value = constants[item.names[0]]
+        if value in first:
+            for name in item.names:
+                renames[name] = first[value]
+        else:
+            first[value] = item.names[0]
+    for item in source.words:
+        fields = item.fields
+        if fields["kind"] == AsmSrcKind.SYMBOLIC and fields["symbol"] in renames:
+            item.rewrite("{}{} {}{}".format(
+                fields["opcode"], "/" + fields["predicate"] if fields["predicate"] else "",
+                fields["target"] + "," if fields["target"] else "",
+                renames[fields["symbol"]]))
+            source.counts["merge"] += 1
+            changed = True
+    if renames:
+        source.layout()
+    for item in source.words:
+        if item.fields["kind"] == AsmSrcKind.DATA and \
+                not any(source.refs[name] for name in item.names):
+            source.delete(item, "data")
+            changed = True
+    return changed
+
+
+def optimize(lines: Sequence[str]) -> Tuple[List[str], dict]:
+    """Optimize an assembly program.  Returns the new program and
+    a report of its size before and after, and how often each
+    rewrite was applied.
+    """
+    source = Source(lines)
+    before = _size(source)
+    for round in range(MAX_ROUNDS):
+        changed = _reuse(source)
+        source.layout()
+        if source.movable:
+            changed |= _jumps(source)
+            source.layout()
+            changed |= _unreachable(source)
+            source.layout()
+            changed |= _data(source)
+            source.layout()
+        if not changed:
+            break
+    after = _size(source)
+    report = {"words_before": before[0], "words_after": after[0],
+              "instructions_before": before[1], "instructions_after": after[1],
+              "movable": source.movable}
+    for rule in RULES:
+        report[rule] = source.counts[rule]
+    return source.lines(), report
+
+
+def _size(source: Source) -> Tuple[int, int]:
+    return len(source.words), sum(1 for item in source.words if item.instruction)
+
+
+def run_program(lines: Sequence[str], inputs: Sequence[int] = (),
+                capacity: int = 4096) -> dict:
+    """Assemble and run a program, with console input from inputs
+    (then zeros).  Returns its step, load and store counts and its
+    output.
+    """
+    return run_words(assemble(resolve(lines)), inputs, capacity)
+
+
+def run_words(words: Sequence[int], inputs: Sequence[int] = (),
+              capacity: int = 4096) -> dict:
+    """Run object code as run_program does"""
+    mem = MemoryMappedIO(capacity)
+    mem.attach(ConsoleIn(list(inputs), eof_value=0), 510)
+    output = io.BytesIO()
+    console = ConsoleOut(output)
+    mem.attach(console, 511)
+    cpu = CPU(mem)
+    mem.load_program(words)
+    while not cpu.halted and cpu.step_count < MAX_STEPS:
+        cpu.cycle()
+    console.flush()
+    return {"steps": cpu.step_count, "loads": cpu.loads, "stores": cpu.stores,
+            "halted": cpu.halted, "output": output.getvalue()}
+
+
+def measure(lines: Sequence[str], optimized: Sequence[str],
+            inputs: Sequence[int] = ()) -> dict:
+    """Executed-step savings of an optimized program, checking
+    that it prints the same as the original
+    """
+    old = run_program(lines, inputs)
+    new = run_program(optimized, inputs)
+    if old["halted"] and new["output"] != old["output"]:
+        raise AssertionError("Optimized program prints {!r}, not {!r}"
+                             .format(new["output"], old["output"]))
+    return {"steps_before": old["steps"], "steps_after": new["steps"],
+            "memory_before": old["loads"] + old["stores"],
+            "memory_after": new["loads"] + new["stores"]}
+
+
+def format_report(name: str, report: dict) -> str:
+    text = "{}: {} -> {} words, {} -> {} instructions".format(
+        name, report["words_before"], report["words_after"],
+        report["instructions_before"], report["instructions_after"])
+    if "steps_before" in report:
+        text += ", {} -> {} steps, {} -> {} memory accesses".format(
+            report["steps_before"], report["steps_after"],
+            report["memory_before"], report["memory_after"])
+    applied = ["{} {}".format(report[rule], rule) for rule in RULES if report[rule]]
+    if applied:
+        text += " ({})".format(", ".join(applied))
+    if not report["movable"]:
+        text += " [addresses its own image: same-size rewrites only]"
+    return text
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine peephole optimizer")
+    parser.add_argument("sources", nargs="+", help="Assembly (.asm) files")
+    parser.add_argument("--write-dir", help="Write optimized programs to this directory")
+    parser.add_argument("--input", type=int, nargs="*", default=[],
+                        help="Console input when measuring executed steps")
+    parser.add_argument("--no-run", action="store_true",
+                        help="Only count instructions; do not run the programs")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    for path in args.sources:
+        with open(path) as f:
+            lines = f.readlines()
+        optimized, report = optimize(lines)
+        if not args.no_run:
+            report.update(measure(lines, optimized, args.input))
+        print(format_report(path, report))
+        if args.write_dir:
+            os.makedirs(args.write_dir, exist_ok=True)
+            with open(os.path.join(args.write_dir, os.path.basename(path)), "w") as f:
+                for line in optimized:
+                    print(line, file=f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Pipeline timing model for the Duck Machine.
+
+Like the cache model (cache.py), this watches a running CPU and
+estimates how a pipelined implementation would have performed,
+without changing what the program computes.  The pipeline is the
+classic five stages (fetch, decode, execute, memory, write-back)
+with full forwarding, so only these cost extra cycles:
+
+* Load-use hazards: an instruction that reads the register a LOAD
+  just before it loaded stalls one cycle.
+* Branches: any instruction that writes r15.  Fetch follows the
+  branch predictor; a wrong guess is discovered when the branch
+  executes and the younger instructions are squashed.  A LOAD
+  into r15 resolves a stage later.
+* Predicated instructions whose condition fails still occupy a
+  pipeline slot; they are counted separately as skipped slots.
+"""
+
+from mvc import MVCListener
+from cpu import CPU, CPUStep
+from instr_format import Instruction, OpCode, CondFlag
+
+from typing import Dict
+
+import array
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PC = 15
+STAGES = 5
+BRANCH_PENALTY = 2   # Resolved in execute: fetch and decode squashed
+LOAD_BRANCH_PENALTY = 3   # Resolved in memory
+LOAD_USE_STALL = 1
+
+
+class Predictor(object):
+    """Guesses whether a branch (a write to r15) is taken.
+    Subclasses override predict and update.
+    """
+    name = "predictor"
+
+    def predict(self, pc: int, instr: Instruction) -> bool:
+        raise NotImplementedError("Predictor subclasses must implement predict")
+
+    def update(self, pc: int, instr: Instruction, taken: bool) -> None:
+        pass
+
+
+class StaticPredictor(Predictor):
+    """Unconditional branches are taken; conditional branches are
+    taken if they jump backward (loops), otherwise not taken.
+    """
+    name = "static"
+
+    def predict(self, pc: int, instr: Instruction) -> bool:
+        if instr.cond is CondFlag.ALWAYS:
+            return True
+        return instr.offset < 0 and PC in (instr.reg_src1, instr.reg_src2)
+
+
+class TwoBitPredictor(Predictor):
+    """A table of 2-bit saturating counters indexed by address"""
+    name = "2bit"
+
+    def __init__(self, entries: int = 1024) -> None:
+        self.entries = entries
+        self.counters = bytearray([1]) * entries   # Weakly not taken
+
+    def _index(self, pc: int) -> int:
+        return pc % self.entries
+
+    def predict(self, pc: int, instr: Instruction) -> bool:
+        return self.counters[self._index(pc)] >= 2
+
+    def update(self, pc: int, instr: Instruction, taken: bool) -> None:
+        i = self._index(pc)
+        if taken:
+            if self.counters[i] < 3:
+                self.counters[i] += 1
+        elif self.counters[i] > 0:
+            self.counters[i] -= 1
+
+
+class GsharePredictor(TwoBitPredictor):
+    """2-bit counters indexed by address xor global branch history"""
+    name = "gshare"
+
+    def __init__(self, entries: int = 1024, history_bits: int = 10) -> None:
+        super().__init__(entries)
+        self.history = 0
+        self.history_mask = (1 << history_bits) - 1
+
+    def _index(self, pc: int) -> int:
+        return (pc ^ self.history) % self.entries
+
+    def update(self, pc: int, instr: Instruction, taken: bool) -> None:
+        super().update(pc, instr, taken)
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+
+PREDICTORS = {cls.name: cls for cls in [StaticPredictor, TwoBitPredictor, GsharePredictor]}
+
+
+def make_predictor(name: str) -> Predictor:
+    if name not in PREDICTORS:
+        raise ValueError("Unknown branch predictor {}; choose from {}"
+                         .format(name, ", ".join(sorted(PREDICTORS))))
+    return PREDICTORS[name]()
+
+
+# Per-address counts, kept in parallel arrays indexed by slot
+INSTRUCTIONS, LOAD_STALLS, BRANCH_CYCLES, SKIPPED = range(4)
+
+
+class PipelineModel(MVCListener):
+    """Listens to a CPU and charges cycles for each executed
+    instruction.  Decoded hazard information is cached by
+    instruction word, so each step costs a few dictionary lookups.
+    """
+
+    def __init__(self, cpu: CPU, predictor: Predictor = None) -> None:
+        self.cpu = cpu
+        self.predictor = predictor if predictor is not None else StaticPredictor()
+        self.instructions = 0
+        self.load_stalls = 0
+        self.branch_cycles = 0
+        self.skipped = 0
+        self.branches = 0
+        self.taken = 0
+        self.correct = 0
+        self._loaded = None   # Register loaded by the previous instruction
+        self._info = {}       # Instruction word -> (reads, loads, branch)
+        self._slots = {}      # Address -> index into the count arrays
+        self._counts = [array.array("q") for i in range(4)]
+        cpu.register_listener(self)
+
+    def _decode(self, instr: Instruction) -> tuple:
+        reads = {instr.reg_src1, instr.reg_src2} - {0, PC}
+        if instr.op is OpCode.STORE:
+            reads.add(instr.reg_target)
+        writes_target = instr.op is not OpCode.STORE and instr.op is not OpCode.HALT
+        loads = instr.reg_target if instr.op is OpCode.LOAD and instr.reg_target else None
+        branch = writes_target and instr.reg_target == PC
+        return frozenset(reads), loads, branch
+
+    def _slot(self, addr: int) -> int:
+        slot = self._slots.get(addr)
+        if slot is None:
+            slot = len(self._slots)
+            self._slots[addr] = slot
+            for counts in self._counts:
+                counts.append(0)
+        return slot
+
+    def notify(self, event: CPUStep) -> None:
+        if not isinstance(event, CPUStep):
+            return
+        instr = event.instr
+        info = self._info.get(event.instr_word)
+        if info is None:
+            info = self._decode(instr)
+            self._info[event.instr_word] = info
+        reads, loads, branch = info
+        slot = self._slot(event.pc_addr)
+        counts = self._counts
+        self.instructions += 1
+        counts[INSTRUCTIONS][slot] += 1
+        if self._loaded is not None and self._loaded in reads:
+            self.load_stalls += LOAD_USE_STALL
+            counts[LOAD_STALLS][slot] += LOAD_USE_STALL
+        executes = self.cpu.will_execute(instr)
+        if not executes:
+            self.skipped += 1
+            counts[SKIPPED][slot] += 1
+        self._loaded = loads if executes else None
+        if branch:
+            self.branches += 1
+            self.taken += executes
+            guess = self.predictor.predict(event.pc_addr, instr)
+            self.predictor.update(event.pc_addr, instr, executes)
+            if guess == executes:
+                self.correct += 1
+            else:
+                penalty = LOAD_BRANCH_PENALTY if loads else BRANCH_PENALTY
+                self.branch_cycles += penalty
+                counts[BRANCH_CYCLES][slot] += penalty
+
+    @property
+    def cycles(self) -> int:
+        """Pipeline fill, one cycle per instruction, and stalls"""
+        if not self.instructions:
+            return 0
+        return STAGES - 1 + self.instructions + self.load_stalls + self.branch_cycles
+
+    def accuracy(self) -> float:
+        return self.correct / self.branches if self.branches else 1.0
+
+    def by_address(self) -> Dict[int, Dict[str, float]]:
+        """Cycle breakdown for each instruction address executed"""
+        table = {}
+        instrs, stalls, branch, skipped = self._counts
+        for addr, slot in self._slots.items():
+            cycles = instrs[slot] + stalls[slot] + branch[slot]
+            table[addr] = {"count": instrs[slot], "cycles": cycles,
+                           "load_stalls": stalls[slot], "branch_cycles": branch[slot],
+                           "skipped": skipped[slot], "cpi": cycles / instrs[slot]}
+        return table
+
+    def report(self, top: int = 10) -> str:
+        cpi = self.cycles / self.instructions if self.instructions else 0.0
+        lines = ["Instructions {}, estimated cycles {}, CPI {:.2f}".format(
+            self.instructions, self.cycles, cpi)]
+        if self.instructions:
+            for label, value in [("base", self.instructions + STAGES - 1),
+                                 ("load-use stalls", self.load_stalls),
+                                 ("branch mispredictions", self.branch_cycles)]:
+                lines.append("  {:22} {:>10} cycles  {:6.3f} CPI".format(
+                    label, value, value / self.instructions))
+            lines.append("  {:22} {:>10} slots".format("skipped (predicated)", self.skipped))
+        lines.append("Predictor {}: {} branches, {} taken, accuracy {:.2%}".format(
+            self.predictor.name, self.branches, self.taken, self.accuracy()))
+        table = self.by_address()
+        hottest = sorted(table, key=lambda addr: table[addr]["cycles"], reverse=True)[:top]
+        if hottest:
+            lines.append("{:>8} {:>10} {:>10} {:>8} {:>8} {:>8} {:>6}".format(
+                "addr", "count", "cycles", "stalls", "branch", "skipped", "CPI"))
+        for addr in hottest:
+            row = table[addr]
+            lines.append("{:>8} {:>10} {:>10} {:>8} {:>8} {:>8} {:6.2f}".format(
+                addr, row["count"], row["cycles"], row["load_stalls"],
+                row["branch_cycles"], row["skipped"], row["cpi"]))
+        return "\n".join(lines)
@@ -0,0 +1,358 @@
+"""
+Register promotion for Duck Machine assembly code.
+
+Generated code keeps every variable in a DATA word and reloads it
+around each operation.  This pass gives variables registers:
+
+    LOAD  r1,x   becomes   ADD  r1,rX,r0
+    STORE r1,x   becomes   ADD  rX,r1,r0
+
+where rX is the register chosen for x (the copy is dropped when
+it is rX itself).  If x's initial value may be read, it is loaded
+into rX once on entry; if x is ever stored, rX is stored back to
+x before each HALT, so memory ends as it would have.
+
+Which registers can hold which variables comes from liveness:
+the variable's (computed here, over the instructions that read
+and write it) and the registers' (from cfg.py).  A register can
+hold a variable if neither is live where the other is written,
+so registers the program uses for scratch elsewhere are reused,
+and variables whose lifetimes do not overlap share a register.
+Variables are placed in order of their accesses, weighted by
+loop nesting, so loop variables get registers first.
+
+Only programs whose words may move (see peephole.py) are
+changed: there, every variable is reached only by symbolic
+LOAD and STORE.
+
+    python3 promote.py programs/*.asm --write-dir promoted
+"""
+
+from peephole import Source, Item, RULES, measure, format_report
+from assembler_pass1 import AsmSrcKind, parse_line, fill_defaults
+from instr_format import instruction_from_dict
+from cfg import Program, build_cfg, defines
+
+from typing import Dict, List, Sequence, Tuple
+
+import argparse
+import os
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+LOOP_WEIGHT = 10      # An access in a loop counts as this many outside it
+
+
+def _successors(source: Source, index: int) -> List[int]:
+    """Word indexes control may go to after words[index]"""
+    item = source.words[index]
+    fields = item.fields
+    if not item.instruction:
+        return []
+    if fields["kind"] == AsmSrcKind.SYMBOLIC and fields["opcode"] == "JUMP":
+        target = source.address[fields["symbol"]]
+        return [target] if item.always else [target, index + 1]
+    if fields["opcode"] == "HALT" and item.always:
+        return []
+    return [index + 1]
+
+
+def _program(source: Source) -> Program:
+    """The words as instructions, for register liveness and loops.
+    Symbolic instructions become what they resolve to; their
+    offsets may be too big to encode, but need not be encoded.
+    """
+    code = []
+    for index, item in enumerate(source.words):
+        fields = item.fields
+        if fields["kind"] == AsmSrcKind.DATA:
+            code.append(None)
+            continue
+        fields = dict(fields)
+        if fields["kind"] == AsmSrcKind.SYMBOLIC:
+            offset = source.address[fields["symbol"]] - index
+            if fields["opcode"] == "JUMP":
+                fields.update(opcode="ADD", target="r15")
+            fields.update(src1="r0", src2="r15", offset=str(offset))
+        fill_defaults(fields)
+        code.append(instruction_from_dict(fields))
+    return Program(code)
+
+
+class Promotion(object):
+    """Variables, their accesses and liveness, and the registers
+    chosen for them
+    """
+
+    def __init__(self, source: Source) -> None:
+        self.source = source
+        words = source.words
+        self.n = len(words)
+        self.succs = [_successors(source, i) for i in range(self.n)]
+        self.cfg = build_cfg(_program(source))
+        self.variables = self._candidates()
+        self.bit = {v: 1 << i for i, v in enumerate(self.variables)}
+        self.dirty = 0
+        for v in self.variables:
+            if source.word_of(v) in source.stored:
+                self.dirty |= self.bit[v]
+        self._variable_liveness()
+
+    def _candidates(self) -> List[str]:
+        """Variables we can promote: DATA words reached only by
+        symbolic LOAD and STORE with an unpredicated instruction
+        after them, in a program with nowhere else to go
+        """
+        source = self.source
+        for succs in self.succs:
+            if any(s == self.n or not source.words[s].instruction for s in succs):
+                return []    # Control may run off the end, or into DATA
+        first = source.words[0] if source.words else None
+        entry_ok = first is not None and first.instruction and first.always
+        predicated_halt = any(item.fields["opcode"] == "HALT" and not item.always
+                              for item in source.words if item.instruction)
+        ok = {}
+        for item in source.words:
+            if item.fields["kind"] == AsmSrcKind.DATA and len(item.names) == 1:
+                ok[item.names[0]] = True
+        for index, item in enumerate(source.words):
+            fields = item.fields
+            if fields["kind"] != AsmSrcKind.SYMBOLIC or fields["symbol"] not in ok:
+                continue
+            if fields["opcode"] == "JUMP" or not source.next_sets_flags(index):
+                ok[fields["symbol"]] = False
+            elif fields["opcode"] == "STORE" and predicated_halt:
+                ok[fields["symbol"]] = False
+        self.entry_ok = entry_ok
+        return [v for v, good in ok.items() if good and source.refs[v]]
+
+    def _variable_liveness(self) -> None:
+        """live_out[i]: variables whose value after words[i] may be
+        read.  A HALT reads every variable that is ever stored,
+        since memory must end up right.
+        """
+        use = self.n * [0]
+        kill = self.n * [0]
+        self.defs = self.n * [0]
+        for i, item in enumerate(self.source.words):
+            fields = item.fields
+            if fields["kind"] == AsmSrcKind.SYMBOLIC and fields["symbol"] in self.bit:
+                bit = self.bit[fields["symbol"]]
+                if fields["opcode"] == "LOAD":
+                    use[i] = bit
+                else:
+                    self.defs[i] = bit
+                    if item.always:
+                        kill[i] = bit
+            elif fields["opcode"] == "HALT":
+                use[i] = self.dirty
+        preds = [[] for i in range(self.n)]
+        for i, succs in enumerate(self.succs):
+            for s in succs:
+                preds[s].append(i)
+        live_in = self.n * [0]
+        live_out = self.n * [0]
+        work = list(range(self.n))
+        queued = set(work)
+        while work:
+            i = work.pop()
+            queued.discard(i)
+            out = 0
+            for s in self.succs[i]:
+                out |= live_in[s]
+            live_out[i] = out
+            new = use[i] | (out & ~kill[i])
+            if new != live_in[i]:
+                live_in[i] = new
+                for p in preds[i]:
+                    if p not in queued:
+                        queued.add(p)
+                        work.append(p)
+        self.live_in = live_in
+        self.live_out = live_out
+        self.at_entry = live_in[0] if self.n else 0
+
+    def weights(self) -> Dict[str, int]:
+        """Accesses to each variable, weighted by loop depth"""
+        depth = self.n * [0]
+        for loop in self.cfg.loops():
+            for b in loop.blocks:
+                block = self.cfg.blocks[b]
+                for pc in range(block.start, block.end):
+                    depth[pc] += 1
+        weights = dict.fromkeys(self.variables, 0)
+        for i, item in enumerate(self.source.words):
+            symbol = item.fields.get("symbol")
+            if symbol in weights:
+                weights[symbol] += LOOP_WEIGHT ** depth[i]
+        return weights
+
+    def _bitsets(self) -> None:
+        """Sets of instruction positions, as ints, for the checks in
+        _conflicts and _interfere
+        """
+        cfg = self.cfg
+        code = cfg.program.code
+        self.live_at = {v: 0 for v in self.variables}      # v live after
+        self.written = {v: 0 for v in self.variables}      # v stored
+        self.reg_written = [0] * 16
+        self.reg_live = [0] * 16
+        self.copies = {}                                   # (v, reg) -> positions
+        variables = self.variables
+        for i, item in enumerate(self.source.words):
+            at = 1 << i
+            live = self.live_out[i]
+            while live:
+                low = live & -live
+                self.live_at[variables[low.bit_length() - 1]] |= at
+                live ^= low
+            if self.defs[i]:
+                self.written[variables[self.defs[i].bit_length() - 1]] |= at
+            if code[i] is None:
+                continue
+            written, live = defines(code[i]), cfg.live_after(i)
+            for reg in range(1, 15):
+                if written >> reg & 1:
+                    self.reg_written[reg] |= at
+                if live >> reg & 1:
+                    self.reg_live[reg] |= at
+            symbol = item.fields.get("symbol")
+            if symbol in self.bit and item.fields["target"]:
+                key = (symbol, int(item.fields["target"][1:]))
+                self.copies[key] = self.copies.get(key, 0) | at
+        self.entry_live = cfg.liveness()[0][cfg.block_containing(0)]
+
+    def _conflicts(self, v: str, reg: int) -> bool:
+        """Would keeping v in register reg change what the program
+        does?  A copy between v and reg itself is no conflict.
+        """
+        if self.at_entry & self.bit[v]:
+            if not self.entry_ok or self.entry_live >> reg & 1:
+                return True
+        others = ~self.copies.get((v, reg), 0)
+        return bool((self.reg_written[reg] & self.live_at[v] & others) or
+                    (self.written[v] & self.reg_live[reg] & others))
+
+    def _interfere(self, v: str, w: str) -> bool:
+        """Is either of v and w live where the other is written?"""
+        if self.at_entry & self.bit[v] and self.at_entry & self.bit[w]:
+            return True
+        return bool((self.written[v] & self.live_at[w]) or
+                    (self.written[w] & self.live_at[v]))
+
+    def allocate(self) -> Dict[str, str]:
+        """Choose registers, busiest variables first"""
+        self._bitsets()
+        weights = self.weights()
+        chosen = {}
+        holding = {reg: [] for reg in range(1, 15)}   # Register -> variables in it
+        halts = sum(1 for item in self.source.words if item.fields["opcode"] == "HALT")
+        for v in sorted(self.variables, key=lambda v: -weights[v]):
+            # Loading on entry and storing at each HALT must cost less than it saves
+            cost = (1 if self.at_entry & self.bit[v] else 0) + \
+                (halts if self.dirty & self.bit[v] else 0)
+            if weights[v] <= cost:
+                continue
+            for reg in range(1, 15):
+                if self._conflicts(v, reg) or \
+                        any(self._interfere(v, w) for w in holding[reg]):
+                    continue
+                chosen[v] = "r{}".format(reg)
+                holding[reg].append(v)
+                break
+        return chosen
+
+
+def promote(lines: Sequence[str]) -> Tuple[List[str], dict]:
+    """Keep variables in registers.  Returns the new program and a
+    report like peephole.optimize's, with the register chosen for
+    each variable.
+    """
+    source = Source(lines)
+    before = (len(source.words), sum(1 for item in source.words if item.instruction))
+    chosen = {}
+    if source.movable and source.words:
+        promotion = Promotion(source)
+        chosen = promotion.allocate()
+        _rewrite(source, promotion, chosen)
+        source.layout()
+    report = {"words_before": before[0], "words_after": len(source.words),
+              "instructions_before": before[1],
+              "instructions_after": sum(1 for item in source.words if item.instruction),
+              "movable": source.movable, "registers": chosen}
+    report.update(dict.fromkeys(RULES, 0))
+    return source.lines(), report
+
+
+def _rewrite(source: Source, promotion: Promotion, chosen: Dict[str, str]) -> None:
+    for item in source.words:
+        fields = item.fields
+        if fields["kind"] != AsmSrcKind.SYMBOLIC or fields["symbol"] not in chosen:
+            continue
+        reg = chosen[fields["symbol"]]
+        if fields["target"] == reg:
+            item.dead = True
+            continue
+        predicate = "/" + fields["predicate"] if fields["predicate"] else ""
+        if fields["opcode"] == "LOAD":
+            item.rewrite("ADD{}  {},{},r0".format(predicate, fields["target"], reg))
+        else:
+            item.rewrite("ADD{}  {},{},r0".format(predicate, reg, fields["target"]))
+    spills = ["   STORE {},{}".format(reg, v) for v, reg in sorted(chosen.items())
+              if promotion.dirty & promotion.bit[v]]
+    if spills:
+        for item in [item for item in source.words if item.fields["opcode"] == "HALT"]:
+            _insert_before(source, item, spills)
+    prologue = ["   LOAD {},{}".format(reg, v) for v, reg in sorted(chosen.items())
+                if promotion.at_entry & promotion.bit[v]]
+    if prologue:
+        source.items[0:0] = [Item(text) for text in prologue]
+
+
+def _insert_before(source: Source, item: Item, lines: List[str]) -> None:
+    """Insert lines before item, moving its label to them"""
+    index = source.items.index(item)
+    new = [Item(text) for text in lines]
+    label = item.fields["label"]
+    if label:
+        item.text = "   " + item.text.split(":", 1)[1].lstrip()
+        item.fields = parse_line(item.text)
+        new.insert(0, Item("{}:".format(label)))
+    source.items[index:index] = new
+
+
+def cli() -> object:
+    """Get arguments from command line"""
+    parser = argparse.ArgumentParser(description="Duck Machine register promotion")
+    parser.add_argument("sources", nargs="+", help="Assembly (.asm) files")
+    parser.add_argument("--write-dir", help="Write promoted programs to this directory")
+    parser.add_argument("--input", type=int, nargs="*", default=[],
+                        help="Console input when measuring executed steps")
+    parser.add_argument("--no-run", action="store_true",
+                        help="Only count instructions; do not run the programs")
+    return parser.parse_args()
+
+
+def main():
+    args = cli()
+    for path in args.sources:
+        with open(path) as f:
+            lines = f.readlines()
+        promoted, report = promote(lines)
+        if not args.no_run:
+            report.update(measure(lines, promoted, args.input))
+        print(format_report(path, report))
+        print("   " + ", ".join("{} in {}".format(v, r)
+                                for v, r in sorted(report["registers"].items())))
+        if args.write_dir:
+            os.makedirs(args.write_dir, exist_ok=True)
+            with open(os.path.join(args.write_dir, os.path.basename(path)), "w") as f:
+                for line in promoted:
+                    print(line, file=f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Tests for the in-process assembler pipeline.
+"""
+
+from assembler import Assembly, AssemblyError, assemble_source, assemble_stream
+from assembler_pass1 import resolve
+from assembler_pass2 import assemble
+from peephole import run_words
+
+import io
+import os
+import subprocess
+import sys
+import tracemalloc
+import unittest
+
+PROGRAMS = ["fact", "count10", "max", "sample", "first", "second"]
+
+
+def straight_line(count: int) -> list:
+    """A program longer than a displacement reaches"""
+    lines = ["   LOAD r1,seven"] + count * ["   ADD r2,r2,r0[1]"]
+    lines += ["   STORE r2,r0,r0[511]", "   STORE r1,x", "   LOAD r3,x",
+              "   STORE r3,r0,r0[511]", "   HALT r0,r0,r0", "x: DATA 0", "seven: DATA 7"]
+    return lines
+
+
+class TestAssembly(unittest.TestCase):
+
+    def test_same_as_the_two_passes(self):
+        for name in PROGRAMS:
+            with open("programs/{}.asm".format(name)) as f:
+                lines = f.readlines()
+            assembly = Assembly(lines)
+            self.assertEqual(assembly.dasm(), resolve(lines), name)
+            self.assertEqual(assembly.words, assemble(resolve(lines)), name)
+
+    def test_shipped_object_code(self):
+        with open("programs/fact.asm") as f:
+            words = assemble_source(f.readlines())
+        with open("programs/fact.obj") as f:
+            self.assertEqual(words, [int(word) for word in f.read().split()])
+
+    def test_far_references(self):
+        lines = straight_line(1200)
+        self.assertEqual(assemble_source(lines), assemble(resolve(lines)))
+        self.assertEqual(run_words(assemble_source(lines))["output"], b"1200\n7\n")
+
+    def test_optional_passes(self):
+        with open("programs/count10.asm") as f:
+            lines = f.readlines()
+        plain = run_words(assemble_source(lines))
+        optimized = run_words(assemble_source(lines, optimize=True, promote=True))
+        self.assertEqual(optimized["output"], plain["output"])
+        self.assertLessEqual(optimized["steps"], plain["steps"])
+
+    def test_errors_are_collected(self):
+        with self.assertRaises(AssemblyError) as context:
+            Assembly(["   FOO r1", "   LOAD r1,x", "   JUMP nowhere", "   ADD/ZP r1,r2,r3",
+                      "   DATA", "x: DATA 1"])
+        self.assertEqual(len(context.exception.errors), 1)
+        with self.assertRaises(AssemblyError) as context:
+            Assembly(["   LOAD x", "   JUMP nowhere", "   ADD/ZP r1,r2,r3", "   DATA",
+                      "   LOAD r1,x", "x: DATA 1"])
+        self.assertEqual(len(context.exception.errors), 4)
+
+    def test_rejects_what_the_passes_reject(self):
+        for lines in [["   JUMP nowhere"], ["   LOAD x", "x: DATA 1"], ["   DATA"],
+                      ["   ADD/ZP r1,r2,r3"], ["a: DATA 1", "a: DATA 2"]]:
+            with self.assertRaises(AssemblyError, msg=lines):
+                Assembly(lines)
+
+
+def looping(count: int):
+    """A long program, line by line, with no reference out of reach"""
+    yield "   ADD r1,r0,r0[3]"
+    for k in range(count):
+        yield "loop{}: ADD r2,r2,r0[1]".format(k)
+        yield "   SUB r1,r1,r0[1]"
+        yield "   JUMP/P loop{}".format(k)
+        yield "   JUMP/ALWAYS next{}".format(k)
+        yield "next{}: ADD r1,r0,r0[3]".format(k)
+    yield "   STORE r2,r0,r0[511]"
+    yield "   HALT r0,r0,r0"
+
+
+class TestStream(unittest.TestCase):
+
+    def stream(self, lines) -> list:
+        out = io.StringIO()
+        count = assemble_stream(lines, out)
+        words = [int(word) for word in out.getvalue().split()]
+        self.assertEqual(len(words), count)
+        return words
+
+    def test_same_as_assembly(self):
+        for name in PROGRAMS:
+            with open("programs/{}.asm".format(name)) as f:
+                lines = f.readlines()
+            self.assertEqual(self.stream(lines), Assembly(lines).words, name)
+        lines = list(looping(400))
+        words = self.stream(lines)
+        self.assertEqual(words, Assembly(lines).words)
+        self.assertEqual(run_words(words, capacity=len(words))["output"], b"1200\n")
+
+    def test_errors_write_nothing(self):
+        for lines in [straight_line(600), ["   JUMP nowhere"], ["   DATA"],
+                      ["a: DATA 1", "a: DATA 2"]]:
+            out = io.StringIO()
+            with self.assertRaises(AssemblyError, msg=lines[:2]):
+                assemble_stream(lines, out)
+            self.assertEqual(out.getvalue(), "")
+
+    def test_memory_follows_labels_not_lines(self):
+        # Each block of the source has two labels; the same number
+        # of labels in ten times the lines takes about the same memory
+        def peak(lines) -> int:
+            with open(os.devnull, "w") as out:
+                tracemalloc.start()
+                assemble_stream(lines, out)
+                size = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            return size
+
+        def padded(count: int, padding: int):
+            for line in looping(count):
+                yield line
+                if line.startswith("next"):
+                    for _ in range(padding):
+                        yield "   ADD r3,r3,r0[1]"
+
+        short = peak(padded(1000, 0))
+        long = peak(padded(1000, 50))
+        self.assertLess(long, 2 * short)
+
+    def test_pipeline(self):
+        source = "\n".join(looping(50)) + "\n"
+        result = subprocess.run([sys.executable, "assembler.py", "--stream"], input=source,
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertEqual([int(word) for word in result.stdout.split()],
+                         Assembly(source.splitlines()).words)
+
+
+if __name__ == "__main__":
+    unittest.main()
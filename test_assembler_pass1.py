@@ -0,0 +1,104 @@
+"""
+Tests for label resolution in assembler pass 1.
+"""
+
+from assembler_pass1 import build_table, transform_lines, resolve_line, parse_line
+from assembler_pass1 import SyntaxError, relax, resolve, RESERVED
+from assembler_pass2 import assemble
+from peephole import run_program
+
+import contextlib
+import io
+import unittest
+
+
+class TestResolve(unittest.TestCase):
+
+    def test_table_counts_words_only(self):
+        lines = ["# heading", "start:", "   LOAD r1,x", "loop: JUMP loop", "x: DATA 3"]
+        self.assertEqual(build_table(lines), {"start": 0, "loop": 1, "x": 2})
+
+    def test_duplicate_label(self):
+        with self.assertRaises(SyntaxError):
+            build_table(["a: DATA 1", "a: DATA 2"])
+
+    def test_resolved_offsets_are_pc_relative(self):
+        lines = ["top:  LOAD r1,x", "      JUMP/Z top", "      HALT r0,r0,r0", "x:    DATA 7"]
+        resolved = transform_lines(lines, build_table(lines))
+        self.assertEqual(resolved[0], "top: LOAD r1,r0,r15[3] # Access variable 'x'")
+        self.assertEqual(resolved[1], "   ADD/Z r15,r0,r15[-1] # Jump to top")
+        self.assertEqual(resolved[2:], lines[2:])
+
+    def test_far_label_is_an_error(self):
+        fields = parse_line("JUMP far")
+        with self.assertRaises(SyntaxError):
+            resolve_line(fields, {"far": 600}, 0)
+
+    def test_programs_match_shipped_object_code(self):
+        for name in ["fact", "count10", "max", "sample"]:
+            with open("programs/{}.asm".format(name)) as f:
+                lines = f.readlines()
+            with open("programs/{}.obj".format(name)) as f:
+                expected = [int(word) for word in f.read().split()]
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                words = assemble(transform_lines(lines, build_table(lines)))
+            self.assertEqual(words, expected, name)
+            self.assertEqual(output.getvalue(), "")
+
+
+class TestRelax(unittest.TestCase):
+
+    def test_near_programs_unchanged(self):
+        for name in ["fact", "count10", "max", "sample"]:
+            with open("programs/{}.asm".format(name)) as f:
+                lines = [line.rstrip("\n") for line in f]
+            self.assertEqual(relax(lines), lines, name)
+
+    def test_absolute_form_for_low_addresses(self):
+        lines = ["x: DATA 5", "   ADD r1,r1,r0[1]"] + 600 * ["   ADD r2,r2,r0[1]"]
+        lines += ["   LOAD r3,x", "   JUMP/P x", "   HALT r0,r0,r0"]
+        out = relax(lines, reserved=(2000, 2032))
+        self.assertIn("   LOAD r3,r0,r0[0]  # LOAD x", out)
+        self.assertIn("   ADD/P r15,r0,r0[0]  # JUMP x", out)
+        self.assertEqual(len(out), len(lines))
+
+    def test_straight_line_code_crosses_the_devices(self):
+        lines = ["   LOAD r1,seven"] + 1200 * ["   ADD r2,r2,r0[1]"]
+        lines += ["   STORE r2,r0,r0[511]", "   STORE r1,x", "   LOAD r3,x",
+                  "   STORE r3,r0,r0[511]", "   HALT r0,r0,r0", "x: DATA 0", "seven: DATA 7"]
+        words = assemble(resolve(lines))
+        self.assertGreater(len(words), 1200)
+        self.assertEqual(words[RESERVED[0]:RESERVED[1]], (RESERVED[1] - RESERVED[0]) * [0])
+        self.assertEqual(run_program(lines)["output"], b"1200\n7\n")
+
+    def test_far_jumps_loads_and_stores(self):
+        lines = ["   LOAD r1,seven", "   STORE r1,x", "   JUMP far",
+                 "back: ADD r5,r5,r0[1]"]
+        lines += 900 * ["   ADD r2,r2,r0[1]"]
+        lines += ["far: LOAD r3,x", "   ADD r3,r3,r0[1]", "   STORE r3,x",
+                  "   LOAD r3,x", "   STORE r3,r0,r0[511]", "   SUB r0,r5,r0[2]",
+                  "   JUMP/Z done", "   JUMP back"]
+        lines += 700 * ["   ADD r4,r4,r0[1]"]
+        lines += ["done: HALT r0,r0,r0", "x: DATA 0", "seven: DATA 7"]
+        out = relax(lines)
+        self.assertTrue(any(line.startswith("   LOAD r15,pool") for line in out))
+        self.assertTrue(any(line.startswith("   STORE r14,pool") for line in out))
+        self.assertTrue(any("# value 7" in line for line in out))
+        self.assertEqual(run_program(lines)["output"], b"8\n9\n10\n")
+
+    def test_predicated_far_load_is_an_error(self):
+        lines = ["   LOAD/Z r1,x"] + 600 * ["   ADD r2,r2,r0[1]"]
+        lines += ["   STORE r2,x", "   HALT r0,r0,r0", "x: DATA 0"]
+        with self.assertRaises(SyntaxError):
+            relax(lines)
+
+    def test_hand_written_pc_relative_code_cannot_move(self):
+        lines = ["   ADD r15,r0,r15[2]", "   JUMP far"] + 600 * ["   ADD r2,r2,r0[1]"]
+        lines += ["far: HALT r0,r0,r0"]
+        with self.assertRaises(SyntaxError):
+            relax(lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
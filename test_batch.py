@@ -0,0 +1,120 @@
+"""
+Tests for batch assembly.
+"""
+
+from batch import find_sources, assemble_batch, format_report
+from assembler import Assembly
+from assembler_pass1 import transform_lines, SyntaxError
+import assembler_pass2
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+BAD = ["   FOO r1", "   BAR r2", "   BAZ r3", "   QUX r4", "   QUUX r5", "   FUM r6",
+       "   FOE r7"]
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "more"))
+        self.sources = []
+        for name in ["fact", "count10", "max", "more/sample", "more/first"]:
+            path = os.path.join(self.directory, name + ".asm")
+            shutil.copy("programs/{}.asm".format(os.path.basename(name)), path)
+            self.sources.append(path)
+        self.bad = os.path.join(self.directory, "bad.asm")
+        with open(self.bad, "w") as f:
+            f.write("\n".join(BAD) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_find_sources(self):
+        found = find_sources([self.directory, os.path.join(self.directory, "*.asm")])
+        self.assertEqual(sorted(found), sorted(self.sources + [self.bad]))
+
+    def check_outputs(self):
+        for source in self.sources:
+            with open(source) as f:
+                words = Assembly(f.readlines()).words
+            with open(os.path.splitext(source)[0] + ".obj") as f:
+                self.assertEqual([int(word) for word in f.read().split()], words, source)
+
+    def test_batch_in_a_pool(self):
+        report = assemble_batch(find_sources([self.directory]), jobs=2)
+        self.assertEqual(sorted(report["assembled"]), sorted(self.sources))
+        # Too many errors for one file does not end the batch
+        self.assertEqual(list(report["failed"]), [self.bad])
+        self.assertGreater(len(report["failed"][self.bad]), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "bad.obj")))
+        self.check_outputs()
+        self.assertIn("5 assembled, 0 up to date, 1 failed", format_report(report))
+
+    def test_up_to_date_files_are_skipped(self):
+        assemble_batch(self.sources, jobs=1)
+        os.utime(self.sources[0], (0, 0))
+        report = assemble_batch(self.sources, jobs=1)
+        self.assertEqual(report["assembled"], [])
+        self.assertEqual(len(report["skipped"]), len(self.sources))
+        with open(self.sources[1], "a") as f:
+            f.write("# Changed\n")
+        os.utime(self.sources[1], (2 ** 31, 2 ** 31))
+        report = assemble_batch(self.sources, jobs=1)
+        self.assertEqual(report["assembled"], [self.sources[1]])
+        report = assemble_batch(self.sources, jobs=1, force=True)
+        self.assertEqual(len(report["assembled"]), len(self.sources))
+
+    def test_outdir(self):
+        outdir = os.path.join(self.directory, "out")
+        report = assemble_batch(self.sources[:2], jobs=1, outdir=outdir)
+        self.assertEqual(sorted(os.listdir(outdir)), ["count10.obj", "fact.obj"])
+        self.assertEqual(report["failed"], {})
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        with mock.patch("batch.os.replace", side_effect=OSError("disk full")):
+            report = assemble_batch(self.sources[:1], jobs=1)
+        self.assertEqual(report["failed"], {self.sources[0]: ["disk full"]})
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith(".tmp")],
+                         [])
+
+    def test_outdir_keeps_same_names_apart(self):
+        outdir = os.path.join(self.directory, "out")
+        sources = []
+        for student in ["ann", "bob"]:
+            os.mkdir(os.path.join(self.directory, student))
+            sources.append(os.path.join(self.directory, student, "p.asm"))
+        shutil.copy("programs/fact.asm", sources[0])
+        shutil.copy("programs/max.asm", sources[1])
+        pattern = os.path.join(self.directory, "*", "p.asm")
+        report = assemble_batch(find_sources([pattern]), jobs=2, outdir=outdir)
+        self.assertEqual(sorted(report["assembled"]), sources)
+        for source in sources:
+            with open(source) as f:
+                words = Assembly(f.readlines()).words
+            student = os.path.basename(os.path.dirname(source))
+            with open(os.path.join(outdir, student, "p.obj")) as f:
+                self.assertEqual([int(word) for word in f.read().split()], words)
+        report = assemble_batch(sources, jobs=1, outdir=outdir)
+        self.assertEqual(report["skipped"], sources)
+
+    def test_sources_sharing_an_object_file_fail(self):
+        other = os.path.join(self.directory, "fact.s")
+        shutil.copy(self.sources[0], other)
+        report = assemble_batch([self.sources[0], other], jobs=1)
+        self.assertEqual(report["assembled"], [self.sources[0]])
+        self.assertEqual(list(report["failed"]), [other])
+
+    def test_passes_raise_instead_of_exiting(self):
+        with self.assertRaises(SyntaxError):
+            transform_lines(["   JUMP nowhere{}".format(k) for k in range(10)], {})
+        with self.assertRaises(assembler_pass2.SyntaxError):
+            assembler_pass2.assemble(BAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
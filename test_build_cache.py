@@ -0,0 +1,93 @@
+"""
+Tests for the build cache.
+"""
+
+from build_cache import BuildCache, assemble_file, cache_for, CACHE_DIR
+from assembler import Assembly, AssemblyError
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "fact.asm")
+        shutil.copy("programs/fact.asm", self.source)
+        with open(self.source) as f:
+            self.words = Assembly(f.readlines()).words
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_second_run_skips_assembly(self):
+        cache = cache_for(self.source)
+        self.assertEqual(assemble_file(self.source, cache=cache), self.words)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([CACHE_DIR, "fact.asm"]))
+        with mock.patch("build_cache.Assembly") as assembly:
+            self.assertEqual(assemble_file(self.source, cache=cache), self.words)
+            assembly.assert_not_called()
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_source_and_options_are_in_the_key(self):
+        cache = cache_for(self.source)
+        assemble_file(self.source, cache=cache)
+        assemble_file(self.source, optimize=True, cache=cache)
+        with open(self.source, "a") as f:
+            f.write("# A change\n")
+        assemble_file(self.source, cache=cache)
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(len(cache.entries()), 3)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = cache_for(self.source)
+        assemble_file(self.source, cache=cache)
+        now = time.time()
+        for k, key in enumerate(["a", "b"]):
+            cache.put("fact", key, self.words)
+            os.utime(cache.path("fact", key), (now - 100 + k, now - 100 + k))
+        cache.limit = 2 * cache.entries()[0][1]
+        cache.get("fact", "a")      # Now the most recently used
+        cache.put("fact", "c", self.words)
+        remaining = sorted(os.path.basename(path) for _, _, path in cache.entries())
+        self.assertEqual(remaining, ["fact.a.obj", "fact.c.obj"])
+
+    def test_errors_are_not_cached(self):
+        with open(self.source, "w") as f:
+            f.write("   JUMP nowhere\n")
+        cache = cache_for(self.source)
+        with self.assertRaises(AssemblyError):
+            assemble_file(self.source, cache=cache)
+        self.assertEqual(cache.entries(), [])
+
+    def test_unwritable_cache(self):
+        blocker = os.path.join(self.directory, "blocker")
+        with open(blocker, "w"):
+            pass
+        cache = BuildCache(os.path.join(blocker, CACHE_DIR))
+        self.assertEqual(assemble_file(self.source, cache=cache), self.words)
+        self.assertEqual(assemble_file(self.source, cache=cache), self.words)
+        self.assertEqual(cache.hits, 0)
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        cache = cache_for(self.source)
+        with mock.patch("build_cache.os.replace", side_effect=OSError("disk full")):
+            self.assertEqual(assemble_file(self.source, cache=cache), self.words)
+        self.assertEqual(os.listdir(cache.directory), [])
+
+    def test_damaged_entry_is_a_miss(self):
+        cache = cache_for(self.source)
+        assemble_file(self.source, cache=cache)
+        with open(cache.entries()[0][2], "w") as f:
+            f.write("not a number\n")
+        self.assertEqual(assemble_file(self.source, cache=cache), self.words)
+        self.assertEqual(cache.hits, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
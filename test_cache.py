@@ -0,0 +1,106 @@
+"""
+Tests for the cache timing model.
+"""
+
+from cache import Cache, MainMemoryTiming, CacheModel, build_hierarchy, parse_cache_spec
+from memory import MemoryMappedIO
+from cpu import CPU
+from instr_format import instruction_from_string
+
+import unittest
+
+
+class TestCache(unittest.TestCase):
+
+    def test_hits_within_a_line(self):
+        memory = MainMemoryTiming(50)
+        cache = Cache("L1", 16, line_size=4, ways=1, latency=2, next_level=memory)
+        self.assertEqual(cache.access(5), 52)
+        self.assertEqual(cache.access(4), 2)
+        self.assertEqual(cache.access(7), 2)
+        self.assertEqual((cache.hits, cache.misses, memory.reads), (2, 1, 1))
+
+    def test_conflict_misses_direct_mapped(self):
+        cache = Cache("L1", 16, line_size=4, ways=1)
+        for addr in [0, 16, 0, 16]:
+            cache.access(addr)
+        self.assertEqual(cache.misses, 4)
+        two_way = Cache("L1", 16, line_size=4, ways=2)
+        for addr in [0, 16, 0, 16]:
+            two_way.access(addr)
+        self.assertEqual(two_way.misses, 2)
+
+    def test_lru_and_fifo_differ(self):
+        # One set of two ways: lines 0, 1, then reuse 0, then 2
+        results = {}
+        for policy in ["lru", "fifo"]:
+            cache = Cache("L1", 2, line_size=1, ways=2, policy=policy)
+            for addr in [0, 1, 0, 2, 0]:
+                cache.access(addr)
+            results[policy] = cache.misses
+        self.assertEqual(results, {"lru": 3, "fifo": 4})
+
+    def test_write_back_evicts_dirty_lines(self):
+        memory = MainMemoryTiming(10)
+        cache = Cache("L1", 4, line_size=4, ways=1, write="wb", next_level=memory)
+        cache.access(1, write=True)
+        cache.access(2, write=True)
+        self.assertEqual(memory.writes, 0)
+        cache.access(8)
+        self.assertEqual((memory.writes, cache.writebacks), (1, 1))
+
+    def test_write_through_writes_every_store(self):
+        memory = MainMemoryTiming(10)
+        cache = Cache("L1", 4, line_size=4, ways=1, write="wt", next_level=memory)
+        cache.access(1, write=True)       # Miss, not allocated
+        cache.access(1)
+        cache.access(1, write=True)
+        self.assertEqual((memory.writes, memory.reads, cache.hits), (2, 1, 1))
+
+    def test_bad_geometry(self):
+        self.assertRaises(ValueError, Cache, "L1", 10, 4, 2)
+        self.assertRaises(ValueError, Cache, "L1", 16, 4, 2, "plru")
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def test_parse_spec(self):
+        self.assertEqual(parse_cache_spec("L1D:1024:8:4:LRU:1:wb"),
+                         {"name": "L1D", "size": 1024, "line_size": 8, "ways": 4,
+                          "policy": "lru", "latency": 1, "write": "wb"})
+        self.assertRaises(ValueError, parse_cache_spec, "L1D")
+
+    def test_split_and_unified_levels(self):
+        icache, dcache, levels = build_hierarchy(
+            ["L1I:64:4:2", "L1D:64:4:2", "L2:1024:8:4:lru:10"], 100)
+        self.assertEqual([level.name for level in levels], ["L1I", "L1D", "L2", "memory"])
+        self.assertIs(icache.next_level, levels[2])
+        self.assertIs(dcache.next_level, levels[2])
+        icache, dcache, levels = build_hierarchy(["L1:64"])
+        self.assertIs(icache, dcache)
+
+    def test_model_follows_cpu(self):
+        mem = MemoryMappedIO(512)
+        written = []
+        mem.map_address_out(511, lambda addr, value: written.append(value))
+        mem.load_image([instruction_from_string(line).encode() for line in [
+            "ADD ALWAYS r1 r0 r0 100",
+            "STORE ALWAYS r1 r1 r0 0",
+            "LOAD ALWAYS r2 r1 r0 0",
+            "LOAD Z r3 r1 r0 0",             # Skipped: no data access
+            "STORE ALWAYS r2 r0 r0 511",     # Device: uncached
+            "HALT ALWAYS r0 r0 r0 0"]])
+        cpu = CPU(mem)
+        icache, dcache, levels = build_hierarchy(["L1I:16:4:1", "L1D:16:4:1"], 100)
+        model = CacheModel(cpu, icache, dcache, levels, uncached=(mem.io_base, mem.io_end))
+        cpu.run()
+        self.assertEqual(written, [100])
+        self.assertEqual(model.instructions, 6)
+        self.assertEqual((icache.hits + icache.misses), 6)
+        self.assertEqual((dcache.hits, dcache.misses), (1, 1))
+        self.assertEqual(model.uncached_accesses, 1)
+        self.assertIn("CPI", model.report())
+
+
+if __name__ == "__main__":
+    unittest.main()
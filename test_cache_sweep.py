@@ -0,0 +1,126 @@
+"""
+Tests for the single-pass cache sweep.
+"""
+
+from cache_sweep import ReuseDistances, miss_ratios, miss_ratio_curve, set_assoc_miss_ratio
+from cache_sweep import sweep, sweep_table
+from cache import Cache
+from instr_format import instruction_from_string
+
+from assembler import assemble_source
+from devices import ConsoleOut
+
+import io
+import random
+import unittest
+from unittest import mock
+
+
+def brute_force_distances(lines):
+    """Stack distances by scanning back through the trace"""
+    hist, cold = {}, 0
+    for t, line in enumerate(lines):
+        seen = set()
+        for earlier in reversed(lines[:t]):
+            if earlier == line:
+                hist[len(seen)] = hist.get(len(seen), 0) + 1
+                break
+            seen.add(earlier)
+        else:
+            cold += 1
+    return hist, cold
+
+
+class TestReuseDistances(unittest.TestCase):
+
+    def test_small_trace(self):
+        distances = ReuseDistances()
+        for line in [1, 2, 3, 1, 1, 3, 2]:
+            distances.access(line)
+        self.assertEqual(distances.cold, 3)
+        self.assertEqual(dict(distances.histogram), {2: 2, 0: 1, 1: 1})
+
+    def test_matches_brute_force_across_compaction(self):
+        rng = random.Random(7)
+        trace = [rng.randrange(40) for i in range(600)]
+        distances = ReuseDistances(capacity=64)   # Forces compactions
+        for line in trace:
+            distances.access(line)
+        hist, cold = brute_force_distances(trace)
+        self.assertEqual(dict(distances.histogram), hist)
+        self.assertEqual(distances.cold, cold)
+
+    def test_curve_matches_fully_associative_cache(self):
+        rng = random.Random(3)
+        trace = [rng.randrange(24) for i in range(500)]
+        distances = ReuseDistances()
+        for line in trace:
+            distances.access(line)
+        curve = dict(miss_ratio_curve(distances))
+        for lines in [1, 2, 4, 8, 16]:
+            cache = Cache("FA", lines, line_size=1, ways=lines)
+            for line in trace:
+                cache.access(line)
+            expected = cache.misses / len(trace)
+            self.assertAlmostEqual(miss_ratios(distances, [lines])[0], expected)
+            self.assertAlmostEqual(curve[lines], expected)
+            self.assertAlmostEqual(set_assoc_miss_ratio(distances, 1, lines), expected)
+
+    def test_set_assoc_approximation_is_sane(self):
+        distances = ReuseDistances()
+        for i in range(20):
+            for line in range(8):
+                distances.access(line)
+        # Eight lines cycling fit in 8 lines fully associative;
+        # random placement into sets can only do worse
+        full = miss_ratios(distances, [8])[0]
+        direct = set_assoc_miss_ratio(distances, 8, 1)
+        self.assertLess(full, direct)
+        self.assertLessEqual(direct, 1.0)
+
+
+class TestSweep(unittest.TestCase):
+
+    def test_sweep_program(self):
+        # Sum 3 + 2 + 1 in a loop, storing the total each time
+        words = [instruction_from_string(line).encode() for line in [
+            "ADD ALWAYS r1 r0 r0 3",
+            "ADD ALWAYS r2 r2 r1 0",
+            "STORE ALWAYS r2 r0 r0 100",
+            "SUB ALWAYS r1 r1 r0 1",
+            "ADD P r15 r0 r15 -3",
+            "HALT ALWAYS r0 r0 r0 0"]]
+        program = io.StringIO("\n".join(str(word) for word in words))
+        trace = sweep(program, line_size=2)
+        self.assertEqual(trace.instructions.accesses, 1 + 3 * 4 + 1)
+        self.assertEqual(trace.data.accesses, 3)
+        self.assertEqual(trace.data.cold, 1)
+        rows = sweep_table(trace, [2, 4, 8], [1, 2])
+        self.assertEqual(len(rows), 6)
+        instr_rows = [row for row in rows if row["stream"] == "instr"]
+        # The loop spans three 2-word lines, so 8 words holds it all
+        self.assertAlmostEqual(instr_rows[2]["full"], 3 / 14)
+        self.assertIsNone(instr_rows[0]["2-way"])
+
+    def test_program_around_the_devices(self):
+        # Longer than the memory below the devices, so assembled
+        # around them; the hole must not be written to the console
+        lines = ["   ADD r1,r0,r0[0]"] + 600 * ["   ADD r1,r1,r0[1]"]
+        lines += ["   STORE r1,r0,r0[511]", "   HALT r0,r0,r0"]
+        words = assemble_source(lines)
+        self.assertGreater(len(words), 512)
+        consoles = []
+
+        def console(*args, **kwargs):
+            consoles.append(ConsoleOut(*args, **kwargs))
+            return consoles[-1]
+
+        with mock.patch("cache_sweep.ConsoleOut", console):
+            trace = sweep(io.StringIO("\n".join(str(word) for word in words)))
+        consoles[0].flush()
+        self.assertEqual(consoles[0].sink.getvalue(), b"600\n")
+        self.assertEqual(trace.data.accesses, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Tests for control-flow graphs and dataflow analysis.
+"""
+
+from cfg import Program, build_cfg, to_dot, register_names, FLAGS
+from instr_format import instruction_from_string
+from assembler_pass2 import parse_line
+
+import contextlib
+import io
+import time
+import unittest
+
+
+def image(lines):
+    return [instruction_from_string(line).encode() if isinstance(line, str) else line
+            for line in lines]
+
+
+# Count r1 down from 10, adding into r2; print r2
+LOOP = image(["ADD ALWAYS r1 r0 r0 10",      # 0  block 0
+              "ADD ALWAYS r2 r0 r0 0",       # 1
+              "ADD ALWAYS r2 r2 r1 0",       # 2  block 1: loop body
+              "SUB ALWAYS r1 r1 r0 1",       # 3
+              "ADD P r15 r0 r15 -2",         # 4
+              "STORE ALWAYS r2 r0 r0 511",   # 5  block 2
+              "HALT ALWAYS r0 r0 r0 0",      # 6
+              42])                           # 7  data
+
+
+class TestBlocks(unittest.TestCase):
+
+    def test_blocks_and_edges(self):
+        graph = build_cfg(Program.from_image(LOOP))
+        self.assertEqual([(b.start, b.end) for b in graph.blocks], [(0, 2), (2, 5), (5, 7)])
+        self.assertEqual([b.succs for b in graph.blocks], [[1], [1, 2], []])
+        self.assertTrue(graph.blocks[2].exits)
+        self.assertIsNone(graph.program.code[7])
+
+    def test_computed_jump(self):
+        words = image(["LOAD ALWAYS r15 r0 r0 510",
+                       "HALT ALWAYS r0 r0 r0 0"])
+        graph = build_cfg(Program.from_image(words))
+        self.assertEqual(len(graph.blocks), 1)
+        self.assertTrue(graph.blocks[0].computed)
+        # Nothing is known about where it goes: every register is live
+        self.assertEqual(graph.liveness()[1][0] >> 1 & 1, 1)
+
+    def test_from_parsed_assembly(self):
+        source = ["start: ADD r1,r0,r0[3]",
+                  "loop:  SUB r1,r1,r0[1]",
+                  "       ADD/P r15,r0,r15[-1]",
+                  "       HALT r0,r0,r0",
+                  "# Data",
+                  "x:     DATA 7"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            parsed = [parse_line(line) for line in source]
+        program = Program.from_parsed(parsed)
+        self.assertEqual(program.labels, {0: "start", 1: "loop", 4: "x"})
+        graph = build_cfg(program)
+        self.assertEqual([(b.start, b.end) for b in graph.blocks], [(0, 1), (1, 3), (3, 4)])
+        self.assertIn("loop:", to_dot(graph))
+
+
+class TestAnalyses(unittest.TestCase):
+
+    def test_dominators_and_loops(self):
+        graph = build_cfg(Program.from_image(LOOP))
+        self.assertEqual(graph.dominators(), {0: 0, 1: 0, 2: 1})
+        self.assertTrue(graph.dominates(0, 2))
+        self.assertFalse(graph.dominates(2, 1))
+        loops = graph.loops()
+        self.assertEqual(len(loops), 1)
+        self.assertEqual((loops[0].header, loops[0].blocks), (1, {1}))
+        self.assertIn("style=dashed", to_dot(graph))
+
+    def test_liveness(self):
+        graph = build_cfg(Program.from_image(LOOP))
+        live_in, live_out = graph.liveness()
+        self.assertEqual(register_names(live_in[0]), [])
+        self.assertEqual(register_names(live_in[1]), ["r1", "r2"])
+        self.assertEqual(register_names(live_out[2]), [])
+        # The branch at 4 reads the flags SUB set
+        self.assertTrue(graph.live_after(3) >> FLAGS & 1)
+        self.assertFalse(graph.live_after(4) >> FLAGS & 1)
+
+    def test_predicated_definitions_do_not_kill(self):
+        words = image(["ADD ALWAYS r1 r0 r0 1",   # 0
+                       "SUB ALWAYS r0 r2 r0 0",   # 1
+                       "ADD Z r1 r0 r0 2",        # 2: may not happen
+                       "STORE ALWAYS r1 r0 r0 511",
+                       "HALT ALWAYS r0 r0 r0 0"])
+        graph = build_cfg(Program.from_image(words))
+        self.assertEqual(register_names(graph.live_after(1)), ["r1", "cc"])
+        definitions, reach_in, reach_out = graph.reaching_definitions()
+        reaching = {definitions[i] for i in range(len(definitions)) if reach_out[0] >> i & 1}
+        self.assertIn((0, 1), reaching)
+        self.assertIn((2, 1), reaching)
+
+    def test_reaching_definitions_around_loop(self):
+        graph = build_cfg(Program.from_image(LOOP))
+        definitions, reach_in, reach_out = graph.reaching_definitions()
+        into_loop = {definitions[i] for i in range(len(definitions)) if reach_in[1] >> i & 1}
+        self.assertIn((0, 1), into_loop)
+        self.assertIn((3, 1), into_loop)       # Around the back edge
+        self.assertNotIn((3, 1), {definitions[i] for i in range(len(definitions))
+                                  if reach_in[0] >> i & 1})
+
+    def test_large_image_is_fast(self):
+        body = ["ADD ALWAYS r1 r1 r0 1", "SUB ALWAYS r0 r1 r2 0", "ADD M r15 r0 r15 -2"]
+        words = image(body) * 30000 + image(["HALT ALWAYS r0 r0 r0 0"])
+        start = time.perf_counter()
+        graph = build_cfg(Program.from_image(words))
+        graph.loops()
+        graph.liveness()
+        self.assertEqual(len(graph.blocks), 30001)
+        self.assertLess(time.perf_counter() - start, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+"""
+Tests for breakpoints and watchpoints.
+"""
+
+from debugger import Debugger, BreakpointError, compile_condition
+from memory import MemoryMappedIO
+from cpu import CPU
+from instr_format import instruction_from_string, CondFlag
+
+import unittest
+
+# Count r1 down from 3, storing it at 100 each time
+LOOP = ["ADD ALWAYS r1 r0 r0 3",
+        "STORE ALWAYS r1 r0 r0 100",
+        "SUB ALWAYS r1 r1 r0 1",
+        "ADD P r15 r0 r15 -2",
+        "STORE ALWAYS r1 r0 r0 100",
+        "HALT ALWAYS r0 r0 r0 0"]
+
+
+def machine(lines=LOOP):
+    mem = MemoryMappedIO(512)
+    mem.load_image([instruction_from_string(line).encode() for line in lines])
+    return mem, CPU(mem)
+
+
+class TestConditions(unittest.TestCase):
+
+    def test_compiled_condition(self):
+        mem, cpu = machine()
+        cpu.registers[1].put(5)
+        cpu.cond_flag = CondFlag.P
+        check = compile_condition("r1 == 5 and not Z or pc > 100")
+        self.assertTrue(check(cpu.registers, cpu.cond_flag.value))
+        cpu.registers[1].put(4)
+        self.assertFalse(check(cpu.registers, cpu.cond_flag.value))
+
+    def test_rejects_other_code(self):
+        for text in ["__import__('os')", "r16 == 0", "r1.value", "x == 1", "'a'", "r1 =="]:
+            self.assertRaises(BreakpointError, compile_condition, text)
+
+
+class TestBreakpoints(unittest.TestCase):
+
+    def test_no_breakpoints_runs_to_halt(self):
+        mem, cpu = machine()
+        self.assertIsNone(Debugger(cpu).run(0))
+        self.assertTrue(cpu.halted)
+
+    def test_breakpoint_stops_each_time(self):
+        mem, cpu = machine()
+        debugger = Debugger(cpu)
+        debugger.add_breakpoint(2)
+        stops = []
+        stop = debugger.run(0)
+        while stop:
+            stops.append(cpu.registers[1].get())
+            stop = debugger.run()
+        self.assertEqual(stops, [3, 2, 1])
+        self.assertEqual(mem.get(100), 0)
+
+    def test_conditional_breakpoint(self):
+        mem, cpu = machine()
+        debugger = Debugger(cpu)
+        debugger.add_breakpoint(2, "r1 == 1")
+        stop = debugger.run(0)
+        self.assertEqual((stop.reason, stop.pc, cpu.registers[1].get()), ("breakpoint", 2, 1))
+        self.assertIsNone(debugger.run())
+
+
+class TestWatchpoints(unittest.TestCase):
+
+    def test_write_and_change(self):
+        mem, cpu = machine()
+        debugger = Debugger(cpu)
+        write = debugger.add_watchpoint(100, kind="write")
+        stop = debugger.run(0)
+        self.assertEqual((stop.pc, stop.addr, stop.new), (1, 100, 3))
+        debugger.remove_watchpoint(write)
+        self.assertIs(cpu.memory, mem)
+        debugger.add_watchpoint(90, 110, kind="change")
+        values = []
+        stop = debugger.run()
+        while stop:
+            values.append((stop.old, stop.new))
+            stop = debugger.run()
+        # The final STORE writes 0 over 0: no change
+        self.assertEqual(values, [(3, 2), (2, 1), (1, 0)])
+
+    def test_read_watchpoint_sees_fetches(self):
+        mem, cpu = machine()
+        debugger = Debugger(cpu)
+        debugger.add_watchpoint(5, kind="read")
+        stop = debugger.run(0)
+        self.assertEqual((stop.pc, stop.addr), (5, 5))
+
+    def test_overlapping_ranges(self):
+        mem, cpu = machine()
+        debugger = Debugger(cpu)
+        debugger.add_watchpoint(0, 200, kind="read")
+        debugger.add_watchpoint(100, 101, kind="write")
+        debugger.add_watchpoint(50, 150, kind="write")
+        watched = cpu.memory
+        watched.put(100, 1)
+        watched.put(120, 1)
+        watched.put(300, 1)
+        self.assertEqual([(str(w), addr) for w, addr, old, new in watched.hits],
+                         [("write watchpoint 100..100", 100), ("write watchpoint 50..149", 100),
+                          ("write watchpoint 50..149", 120)])
+
+    def test_bad_kind(self):
+        mem, cpu = machine()
+        self.assertRaises(ValueError, Debugger(cpu).add_watchpoint, 1, 2, "execute")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+"""
+Tests for the devices on the Duck Machine memory bus.
+"""
+
+from devices import ConsoleIn, ConsoleOut, BlockStorage, DMAController
+from devices import DMA_BLOCK, DMA_ADDR, DMA_LENGTH, DMA_CONTROL, DMA_REGISTERS
+from devices import DMA_TO_MEMORY, DMA_TO_STORAGE, DMA_DONE, DMA_ERROR
+from devices import PerfCounters, IntervalTimer, PERF_REGISTERS, TIMER_REGISTERS
+from devices import PERF_INSTRUCTIONS, PERF_LOADS, PERF_STORES, PERF_SKIPS, PERF_NANOS
+from devices import TIMER_PERIOD, TIMER_CONTROL, TIMER_EXPIRED, TIMER_REMAINING
+from devices import TIMER_PERIODIC, TIMER_ONE_SHOT, TIMER_STOPPED
+from memory import MemoryMappedIO, SparseMemoryIO
+from cpu import CPU
+from instr_format import instruction_from_string
+
+import array
+import io
+import os
+import tempfile
+import unittest
+
+
+class TestConsoleIn(unittest.TestCase):
+
+    def test_values_split_across_chunks(self):
+        text = b"12 -345\n6789 0 " * 50 + b"-42"
+        console = ConsoleIn(io.BytesIO(text), chunk_size=5)
+        values = [console.read(0) for i in range(201)]
+        self.assertEqual(values[:4], [12, -345, 6789, 0])
+        self.assertEqual(values[-1], -42)
+        self.assertEqual(console.values, 201)
+        self.assertEqual(console.bytes, len(text))
+
+    def test_binary_words_split_across_chunks(self):
+        words = array.array("i", [1, -2, 2 ** 31 - 1, -2 ** 31])
+        console = ConsoleIn(io.BytesIO(words.tobytes()), binary=True, chunk_size=3)
+        self.assertEqual(console.read_block(0, 4), words.tolist())
+
+    def test_end_of_input(self):
+        console = ConsoleIn([1, 2])
+        self.assertEqual(console.read_block(0, 2), [1, 2])
+        self.assertRaises(EOFError, console.read, 0)
+        console = ConsoleIn(io.BytesIO(b"7"), eof_value=-1)
+        self.assertEqual([console.read(0), console.read(0)], [7, -1])
+
+
+class TestConsoleOut(unittest.TestCase):
+
+    def test_buffered_until_block_full_or_flush(self):
+        sink = io.BytesIO()
+        console = ConsoleOut(sink, block_size=3)
+        console.write(0, 1)
+        console.write(0, 2)
+        self.assertEqual(sink.getvalue(), b"")
+        console.write(0, 3)
+        self.assertEqual(sink.getvalue(), b"1\n2\n3\n")
+        console.write_block(0, [4, 5])
+        console.flush()
+        self.assertEqual(sink.getvalue(), b"1\n2\n3\n4\n5\n")
+        self.assertEqual((console.values, console.bytes), (5, 10))
+
+    def test_binary_framing(self):
+        sink = io.BytesIO()
+        console = ConsoleOut(sink, binary=True)
+        console.write_block(0, [5, -6])
+        console.flush()
+        self.assertEqual(array.array("i", sink.getvalue()).tolist(), [5, -6])
+
+
+class TestDMA(unittest.TestCase):
+
+    DMA_BASE = 500
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, "disk.bin")
+        self.storage = BlockStorage.create(path, blocks=4, block_size=16)
+        self.storage.write_words(0, list(range(100, 164)))
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def machine(self, memory_class=MemoryMappedIO):
+        mem = memory_class(512)
+        self.dma = DMAController(self.storage, mem)
+        mem.attach(self.dma, self.DMA_BASE, DMA_REGISTERS)
+        return mem
+
+    def transfer(self, mem, command, block, addr, length):
+        mem.put(self.DMA_BASE + DMA_BLOCK, block)
+        mem.put(self.DMA_BASE + DMA_ADDR, addr)
+        mem.put(self.DMA_BASE + DMA_LENGTH, length)
+        mem.put(self.DMA_BASE + DMA_CONTROL, command)
+        return mem.get(self.DMA_BASE + DMA_CONTROL)
+
+    def test_storage_to_memory(self):
+        for memory_class in (MemoryMappedIO, SparseMemoryIO):
+            mem = self.machine(memory_class)
+            self.assertEqual(self.transfer(mem, DMA_TO_MEMORY, 1, 40, 20), DMA_DONE)
+            self.assertEqual(list(mem.read_block(40, 20)), list(range(116, 136)))
+            self.assertEqual(mem.get(60), 0)
+
+    def test_memory_to_storage(self):
+        mem = self.machine()
+        mem.load_image([7, 8, 9], 10)
+        self.assertEqual(self.transfer(mem, DMA_TO_STORAGE, 3, 10, 3), DMA_DONE)
+        self.assertEqual(self.storage.read_words(3, 4).tolist(), [7, 8, 9, 151])
+        self.assertEqual((self.dma.transfers, self.dma.words), (1, 3))
+
+    def test_transfer_over_device_window_refused(self):
+        mem = self.machine()
+        self.assertEqual(self.transfer(mem, DMA_TO_MEMORY, 0, 490, 30), DMA_ERROR)
+        self.assertEqual(list(mem.read_block(490, 10)), 10 * [0])
+        self.assertEqual(mem.get(self.DMA_BASE + DMA_ADDR), 490)
+        self.assertEqual(self.transfer(mem, DMA_TO_STORAGE, 0, 505, 6), DMA_DONE)
+        mem.map_address_in(510, lambda addr: 1 / 0)
+        self.assertEqual(self.transfer(mem, DMA_TO_STORAGE, 0, 505, 6), DMA_ERROR)
+
+    def test_out_of_bounds_and_unknown_command(self):
+        mem = self.machine()
+        self.assertEqual(self.transfer(mem, DMA_TO_MEMORY, 3, 0, 17), DMA_ERROR)
+        self.assertEqual(self.transfer(mem, 99, 0, 0, 1), DMA_ERROR)
+        self.assertEqual(mem.get(0), 0)
+
+
+def assemble(lines):
+    return [instruction_from_string(line).encode() for line in lines]
+
+
+class TestCountersAndTimer(unittest.TestCase):
+
+    PERF_BASE = 490
+    TIMER_BASE = 496
+
+    def setUp(self):
+        self.mem = MemoryMappedIO(512)
+        self.cpu = CPU(self.mem)
+        self.counters = PerfCounters(self.cpu)
+        self.timer = IntervalTimer(self.cpu)
+        self.mem.attach(self.counters, self.PERF_BASE, PERF_REGISTERS)
+        self.mem.attach(self.timer, self.TIMER_BASE, TIMER_REGISTERS)
+
+    def test_counters(self):
+        self.mem.load_image(assemble([
+            "ADD ALWAYS r1 r0 r0 5",
+            "STORE ALWAYS r1 r0 r0 100",
+            "LOAD ALWAYS r2 r0 r0 100",
+            "ADD Z r3 r0 r0 1",          # Skipped
+            "HALT ALWAYS r0 r0 r0 0"]))
+        self.cpu.run()
+        counters = [self.mem.get(self.PERF_BASE + i) for i in range(PERF_NANOS)]
+        self.assertEqual(counters[PERF_INSTRUCTIONS], 4)
+        self.assertEqual(counters[PERF_LOADS], 1)
+        self.assertEqual(counters[PERF_STORES], 1)
+        self.assertEqual(counters[PERF_SKIPS], 1)
+
+    def test_counters_are_words(self):
+        nanos = self.mem.get(self.PERF_BASE + PERF_NANOS)
+        self.assertTrue(0 <= nanos < 2 ** 31)
+        self.mem.put(self.PERF_BASE + PERF_STORES, -2 ** 31)
+        self.cpu.stores += 1
+        self.assertEqual(self.mem.get(self.PERF_BASE + PERF_STORES), -2 ** 31 + 1)
+        self.assertEqual(self.cpu.stores, 1)
+
+    def test_polling_periodic_timer(self):
+        self.mem.load_image(assemble([
+            "ADD ALWAYS r1 r0 r0 10",
+            "STORE ALWAYS r1 r0 r0 496",     # Period 10
+            "ADD ALWAYS r1 r0 r0 2",
+            "STORE ALWAYS r1 r0 r0 497",     # Start, periodic
+            "ADD ALWAYS r2 r2 r0 1",         # Count polls
+            "LOAD ALWAYS r3 r0 r0 498",
+            "SUB ALWAYS r0 r3 r0 3",
+            "ADD M r15 r0 r15 -3",           # Until 3 expirations
+            "HALT ALWAYS r0 r0 r0 0"]))
+        self.cpu.run()
+        self.assertEqual(self.timer.expired, 3)
+        # Started at step 3, so expirations at 13, 23, 33, and next 43
+        self.assertEqual(self.cpu.step_count, 37)
+        self.assertEqual(self.mem.get(self.TIMER_BASE + TIMER_REMAINING), 43 - 37)
+
+    def test_one_shot_timer(self):
+        self.mem.put(self.TIMER_BASE + TIMER_PERIOD, 3)
+        self.mem.put(self.TIMER_BASE + TIMER_CONTROL, TIMER_ONE_SHOT)
+        self.cpu.step_count = 3
+        self.cpu._fire_events()
+        self.assertEqual(self.timer.expired, 1)
+        self.assertEqual(self.timer.mode, TIMER_STOPPED)
+        self.assertEqual(self.cpu.next_event, float("inf"))
+
+    def test_restarts_do_not_grow_event_wheel(self):
+        self.mem.put(self.TIMER_BASE + TIMER_PERIOD, 1000)
+        for i in range(1000):
+            self.mem.put(self.TIMER_BASE + TIMER_CONTROL, TIMER_PERIODIC)
+        self.assertLessEqual(len(self.cpu._events), 2)
+        self.mem.put(self.TIMER_BASE + TIMER_CONTROL, TIMER_STOPPED)
+        self.assertEqual(self.cpu.next_event, float("inf"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Tests for incremental re-assembly.
+"""
+
+from incremental import Session
+from assembler import Assembly, AssemblyError
+from test_assembler import looping
+
+import random
+import time
+import unittest
+
+# Lines for random edits: none refers to a label, so most edits
+# keep the program valid
+EDITS = ["   ADD r2,r2,r0[1]", "   SUB r1,r1,r0[1]", "# comment", "x{}: ADD r3,r3,r0[2]",
+         "y{}:", "   HALT r0,r0,r0", "   DATA 5", "   LOAD r1,x{}", "   FOO r1"]
+
+
+class TestSession(unittest.TestCase):
+
+    def check_edits(self, lines: list, count: int, seed: int) -> int:
+        """Random edits agree with Assembly; returns how many were
+        made incrementally
+        """
+        rng = random.Random(seed)
+        session = Session(lines)
+        incremental = 0
+        for _ in range(count):
+            start = rng.randrange(len(lines))
+            stop = min(len(lines), start + rng.choice([0, 1, 1, 2]))
+            new = [rng.choice(EDITS).format(rng.randrange(100))
+                   for _ in range(rng.choice([0, 1, 1, 2]))]
+            edited = lines[:start] + new + lines[stop:]
+            try:
+                expected = Assembly(edited).words
+            except AssemblyError:
+                with self.assertRaises(AssemblyError):
+                    session.edit(start, stop, new)
+                self.assertEqual(session.lines, lines)
+                continue
+            session.edit(start, stop, new)
+            lines = edited
+            self.assertEqual(session.words, expected, (start, stop, new))
+            incremental += session.incremental
+        self.assertEqual(session.words, Assembly(lines).words)
+        return incremental
+
+    def test_small_program(self):
+        self.assertGreater(self.check_edits(list(looping(60)), 200, 1), 100)
+
+    def test_program_with_a_hole(self):
+        # 2000 words, so every edit has the hole to keep clear of
+        self.assertGreater(self.check_edits(list(looping(400)), 120, 2), 20)
+
+    def test_far_references_assemble_again(self):
+        lines = ["   JUMP end"] + 600 * ["   ADD r2,r2,r0[1]"] + ["end: HALT r0,r0,r0"]
+        session = Session(lines)
+        session.edit(5, 6, ["   ADD r2,r2,r0[3]"])
+        self.assertFalse(session.incremental)
+        self.assertEqual(session.words, Assembly(session.lines).words)
+
+    def test_labels_move(self):
+        lines = ["   JUMP over", "   ADD r1,r0,r0[1]", "over: STORE r1,r0,r0[511]",
+                 "   HALT r0,r0,r0"]
+        session = Session(lines)
+        session.edit(1, 1, ["   ADD r2,r0,r0[1]", "   ADD r3,r0,r0[1]"])
+        self.assertTrue(session.incremental)
+        self.assertEqual(session.labels["over"], 4)
+        self.assertEqual(session.words, Assembly(session.lines).words)
+
+    def test_update_finds_the_change(self):
+        lines = list(looping(100))
+        session = Session(lines)
+        edited = list(lines)
+        edited[202] = "   SUB r1,r1,r0[2]"
+        session.update(edited)
+        self.assertTrue(session.incremental)
+        self.assertEqual(session.lines, edited)
+        self.assertEqual(session.words, Assembly(edited).words)
+
+    def test_one_line_edit_is_cheap(self):
+        lines = list(looping(4000))
+        start = time.perf_counter()
+        session = Session(lines)
+        full = time.perf_counter() - start
+        start = time.perf_counter()
+        session.edit(10002, 10003, ["   SUB r1,r1,r0[2]"])
+        session.edit(15002, 15003, ["   SUB r1,r1,r0[1]", "   ADD r2,r2,r0[1]"])
+        self.assertLess(time.perf_counter() - start, full / 10)
+        self.assertTrue(session.incremental)
+        self.assertEqual(session.words, Assembly(session.lines).words)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Tests for the single-scan lexer: it must agree with
+assembler_pass1.parse_line on every line.
+"""
+
+from lexer import lex, lex_lines, SAMPLE
+from assembler_pass1 import parse_line, SyntaxError
+
+import glob
+import random
+import unittest
+
+PIECES = ["ADD", "add", "LOAD", "STORE", "JUMP", "DATA", "HALT", "x", "r1", "r15", "r01",
+          ",", " ", "\t", ":", "/", "Z", "ZP", "ALWAYS", "[", "]", "-", "5", "0x1F", "0x",
+          "#", ";", "lbl:", "a_b", "\n", "r2,r3", "r1,", "9a"]
+
+LINES = ["loop: ADD/Z r1,r2,r3[-5] # c", "x: DATA 0x1f", "  JUMP/P loop ; hi",
+         "LOAD r1,x", "  STORE r3,y#z", "lbl:", "", "DATA", "DATA5", "   HALT r0,r0,r0",
+         "  lbl: HALT r0,r0,r0", "JUMP r1", "LOAD r1,r2", "DATA r1,r2,r3", "DATA 0x",
+         "   ADD r1,r2,r3 junk"]
+
+
+def same(test: unittest.TestCase, line: str) -> None:
+    try:
+        fields = parse_line(line)
+    except SyntaxError:
+        with test.assertRaises(SyntaxError, msg=repr(line)):
+            lex(line)
+        return
+    record = lex(line)
+    for key, value in fields.items():
+        test.assertEqual(record[key], value, "{!r}: {}".format(line, key))
+
+
+class TestLexer(unittest.TestCase):
+
+    def test_shipped_programs(self):
+        for path in glob.glob("programs/*.asm"):
+            with open(path) as f:
+                for line in f:
+                    same(self, line)
+
+    def test_edge_cases(self):
+        for line in LINES:
+            same(self, line)
+
+    def test_random_lines(self):
+        rng = random.Random(45)
+        for _ in range(20000):
+            same(self, "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 8))))
+        for _ in range(20000):
+            chars = list(rng.choice(LINES))
+            for _ in range(rng.randint(1, 3)):
+                chars.insert(rng.randint(0, len(chars)), rng.choice(PIECES))
+            same(self, "".join(chars))
+
+    def test_repeated_lines_share_records(self):
+        records = lex_lines(["   HALT r0,r0,r0", "x: DATA 1", "   HALT r0,r0,r0"])
+        self.assertIs(records[0], records[2])
+        with self.assertRaises(SyntaxError):
+            lex_lines(["   HALT r0,r0,r0", "   what"])
+
+    def test_cache_is_dropped_when_lines_do_not_repeat(self):
+        distinct = ["   ADD r{},r0,r0[{}]".format(k % 16, k // 16) for k in range(SAMPLE)]
+        lines = distinct + distinct
+        records = lex_lines(lines)
+        self.assertEqual([(r.kind, r.line, r.groups) for r in records],
+                         [(r.kind, r.line, r.groups) for r in map(lex, lines)])
+        # Too few repeats in the sample: later lines are scanned afresh
+        self.assertIsNot(records[SAMPLE], records[0])
+        records = lex_lines(["   HALT r0,r0,r0"] * SAMPLE + lines)
+        self.assertIs(records[-1], records[-1 - SAMPLE])
+        with self.assertRaises(SyntaxError):
+            lex_lines(distinct + ["   what"])
+
+
+if __name__ == "__main__":
+    unittest.main()
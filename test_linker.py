@@ -0,0 +1,130 @@
+"""
+Tests for relocatable object modules and the linker.
+"""
+
+from linker import Module, LinkError, assemble_module, read_module, link
+from assembler_pass1 import RESERVED
+from peephole import run_words
+
+import io
+import time
+import unittest
+
+MAIN = ["   IMPORT show, ten", "   LOAD r1,ten", "   ADD r1,r1,r0[5]", "   JUMP show"]
+SHOW = ["   EXPORT show, eleven", "show: STORE r1,r0,r0[511]", "   LOAD r2,eleven",
+        "   STORE r2,r0,r0[511]", "   HALT r0,r0,r0", "eleven: DATA 11"]
+TEN = ["   EXPORT ten", "ten: DATA 10"]
+
+
+class TestModules(unittest.TestCase):
+
+    def test_imports_go_through_relocated_pools(self):
+        module = assemble_module(MAIN, "main")
+        self.assertEqual(module.imports, {"show": ["JUMP"], "ten": ["LOAD"]})
+        self.assertEqual(module.relocations, [(4, "ten"), (5, "show")])
+        self.assertEqual(module.words[4:], [0, 0])
+
+    def test_exported_constants(self):
+        module = assemble_module(SHOW, "show")
+        self.assertEqual(module.exports, {"show": 0, "eleven": 4})
+        self.assertEqual(module.constants, {"eleven": 11})
+
+    def test_write_and_read(self):
+        module = assemble_module(MAIN, "main")
+        text = io.StringIO()
+        module.write(text)
+        copy = read_module(io.StringIO(text.getvalue()))
+        for field in ["name", "words", "exports", "imports", "relocations", "constants"]:
+            self.assertEqual(getattr(copy, field), getattr(module, field), field)
+
+    def test_malformed_module(self):
+        with self.assertRaises(LinkError):
+            read_module(io.StringIO("module m\nwords 3\n1\n2\n"))
+
+    def test_export_of_undefined_label(self):
+        with self.assertRaises(LinkError):
+            assemble_module(["   EXPORT nothing", "   HALT r0,r0,r0"], "m")
+
+
+class TestLink(unittest.TestCase):
+
+    def test_link_and_run(self):
+        modules = [assemble_module(MAIN, "main"), assemble_module(SHOW, "show"),
+                   assemble_module(TEN, "ten"),
+                   assemble_module(["   EXPORT junk", "junk: HALT r0,r0,r0"], "junk")]
+        image, report = link(modules)
+        self.assertEqual(report["modules"], ["main", "show", "ten"])
+        self.assertEqual(report["dropped"], ["junk"])
+        self.assertEqual(run_words(image)["output"], b"15\n11\n")
+
+    def test_equal_constants_share_a_word(self):
+        main = ["   IMPORT ten, alsoTen, show", "   LOAD r1,ten", "   LOAD r3,alsoTen",
+                "   ADD r1,r1,r3", "   JUMP show"]
+        modules = [assemble_module(main, "main"), assemble_module(SHOW, "show"),
+                   assemble_module(TEN, "ten"),
+                   assemble_module(["   EXPORT alsoTen", "alsoTen: DATA 10"], "alsoTen")]
+        image, report = link(modules)
+        self.assertEqual(report["dropped"], ["alsoTen"])
+        self.assertEqual(report["merged"], ["alsoTen"])
+        self.assertEqual(run_words(image)["output"], b"20\n11\n")
+
+    def test_stored_data_is_not_shared(self):
+        main = ["   IMPORT ten, alsoTen", "   LOAD r1,ten", "   ADD r1,r1,r0[1]",
+                "   STORE r1,alsoTen", "   LOAD r2,ten", "   STORE r2,r0,r0[511]",
+                "   HALT r0,r0,r0"]
+        modules = [assemble_module(main, "main"), assemble_module(TEN, "ten"),
+                   assemble_module(["   EXPORT alsoTen", "alsoTen: DATA 10"], "alsoTen")]
+        image, report = link(modules)
+        self.assertEqual(report["dropped"], [])
+        self.assertEqual(run_words(image)["output"], b"10\n")
+
+    def test_undefined_and_duplicate_symbols(self):
+        with self.assertRaises(LinkError):
+            link([assemble_module(MAIN, "main"), assemble_module(SHOW, "show")])
+        with self.assertRaises(LinkError):
+            link([assemble_module(MAIN, "main"), assemble_module(SHOW, "show"),
+                  assemble_module(TEN, "ten"), assemble_module(TEN, "again")])
+
+    def test_modules_keep_clear_of_the_devices(self):
+        big = ["   EXPORT big", "big: ADD r2,r2,r0[1]"] + 300 * ["   ADD r2,r2,r0[1]"]
+        big += ["   JUMP show"]
+        main = ["   IMPORT big, show", "   ADD r1,r0,r0[7]"] + 300 * ["   ADD r3,r3,r0[1]"]
+        main += ["   JUMP big"]
+        image, report = link([assemble_module(main, "main"),
+                              assemble_module(big + ["   IMPORT show"], "big"),
+                              assemble_module(SHOW, "show")])
+        low, high = RESERVED
+        self.assertEqual(image[low:high], (high - low) * [0])
+        self.assertEqual(run_words(image)["output"], b"7\n11\n")
+
+    def test_large_program_is_reached_by_a_jump(self):
+        main = ["   IMPORT show", "   ADD r1,r0,r0[3]"] + 600 * ["   ADD r3,r3,r0[1]"]
+        main += ["   JUMP show"]
+        image, report = link([assemble_module(main, "main"), assemble_module(SHOW, "show")])
+        self.assertEqual(image[1], RESERVED[1])
+        self.assertEqual(run_words(image)["output"], b"3\n11\n")
+
+    def test_many_modules(self):
+        # Each adds one and jumps to the next
+        step = assemble_module(["   EXPORT here", "   IMPORT next",
+                                "here: ADD r1,r1,r0[1]", "   JUMP next"], "step")
+        count = 5000
+        modules = [assemble_module(["   IMPORT f0", "   JUMP f0"], "main")]
+        for k in range(count):
+            modules.append(Module("f{}".format(k), step.words, {"f{}".format(k): 0},
+                                  {"f{}".format(k + 1): ["JUMP"]},
+                                  [(offset, "f{}".format(k + 1))
+                                   for offset, symbol in step.relocations]))
+        modules.append(assemble_module(["   EXPORT f{}".format(count),
+                                        "f{}: STORE r1,r0,r0[511]".format(count),
+                                        "   HALT r0,r0,r0"], "last"))
+        start = time.perf_counter()
+        image, report = link(modules)
+        self.assertLess(time.perf_counter() - start, 2.0)
+        self.assertEqual(len(report["modules"]), count + 2)
+        result = run_words(image, capacity=len(image))
+        self.assertEqual(result["output"], "{}\n".format(count).encode())
+
+
+if __name__ == "__main__":
+    unittest.main()
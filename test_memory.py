@@ -0,0 +1,254 @@
+"""
+Tests for the Duck Machine memory variants.
+"""
+
+from memory import Memory, MappedMemory, SparseMemory, SegFault, MemoryWrite, MemoryImageLoaded
+from memory import Device, MemoryMappedIO, SparseMemoryIO
+from mvc import MVCListener
+
+import os
+import tempfile
+import unittest
+
+
+class Recorder(MVCListener):
+    """Keep every event announced by a memory"""
+
+    def __init__(self):
+        self.events = []
+
+    def notify(self, event):
+        self.events.append(event)
+
+
+class TestMappedMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "image.bin")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_create_and_bounds(self):
+        mem = MappedMemory.create(self.path, 64)
+        self.assertEqual(mem.capacity, 64)
+        self.assertEqual(mem.get(63), 0)
+        self.assertRaises(SegFault, mem.get, 64)
+        self.assertRaises(SegFault, mem.put, -1, 3)
+        mem.close()
+
+    def test_shared_flush_persists(self):
+        mem = MappedMemory.create(self.path, 16)
+        mem.put(5, -7)
+        mem.flush()
+        mem.close()
+        again = MappedMemory(self.path)
+        self.assertEqual(again.get(5), -7)
+        again.close()
+
+    def test_private_mapping_leaves_file_alone(self):
+        MappedMemory.create(self.path, 16).close()
+        mem = MappedMemory(self.path)
+        mem.put(2, 42)
+        self.assertRaises(ValueError, mem.flush)
+        saved = os.path.join(self.dir.name, "saved.bin")
+        mem.save(saved)
+        mem.close()
+        self.assertEqual(MappedMemory(self.path).get(2), 0)
+        self.assertEqual(MappedMemory(saved).get(2), 42)
+
+    def test_words_wrap_to_32_bits(self):
+        mem = MappedMemory.create(self.path, 16)
+        mem.put(0, 2 ** 31)
+        mem.load_image([2 ** 32 + 1, -1], 1)
+        self.assertEqual(list(mem.read_block(0, 3)), [-2 ** 31, 1, -1])
+        mem.close()
+
+    def test_read_block_outlives_close(self):
+        mem = MappedMemory.create(self.path, 16)
+        mem.load_image([1, 2, 3], 4)
+        block = mem.read_block(4, 3)
+        mem.close()
+        self.assertEqual(list(block), [1, 2, 3])
+
+    def test_events(self):
+        mem = MappedMemory.create(self.path, 16)
+        recorder = Recorder()
+        mem.register_listener(recorder)
+        mem.put(3, 9)
+        mem.load_image([1, 2], 0)
+        self.assertIsInstance(recorder.events[0], MemoryWrite)
+        self.assertIsInstance(recorder.events[1], MemoryImageLoaded)
+        mem.close()
+
+
+class TestSparseMemory(unittest.TestCase):
+
+    def test_untouched_pages_read_zero_without_allocating(self):
+        mem = SparseMemory(1 << 24, page_size=256)
+        self.assertEqual(mem.get((1 << 24) - 1), 0)
+        self.assertEqual(mem.resident_pages, 0)
+
+    def test_pages_allocated_on_write(self):
+        mem = SparseMemory(1 << 24, page_size=256)
+        mem.put(1000, 7)
+        mem.put(1001, 8)
+        mem.put(5000000, -3)
+        self.assertEqual(mem.get(1000), 7)
+        self.assertEqual(mem.get(5000000), -3)
+        self.assertEqual(mem.touched_pages(), [3, 5000000 // 256])
+        stats = mem.stats()
+        self.assertEqual(stats["resident_pages"], 2)
+        self.assertEqual(stats["resident_bytes"], 2 * 256 * 4)
+
+    def test_bounds(self):
+        mem = SparseMemory(1024, page_size=256)
+        self.assertRaises(SegFault, mem.get, 1024)
+        self.assertRaises(SegFault, mem.put, -1, 0)
+        self.assertRaises(SegFault, mem.load_image, [1, 2], 1023)
+
+    def test_blocks_cross_pages(self):
+        mem = SparseMemory(4096, page_size=256)
+        mem.load_image(list(range(600)), 200)
+        self.assertEqual(mem.get(799), 599)
+        self.assertEqual(mem.resident_pages, 4)
+        block = mem.read_block(100, 1000)
+        self.assertEqual(list(block[:100]), 100 * [0])
+        self.assertEqual(list(block[100:700]), list(range(600)))
+        self.assertEqual(list(block[700:]), 300 * [0])
+
+    def test_page_size_must_be_power_of_two(self):
+        self.assertRaises(ValueError, SparseMemory, 1024, 100)
+
+    def test_events_match_dense_memory(self):
+        dense, sparse = Memory(64), SparseMemory(64, page_size=16)
+        recorders = Recorder(), Recorder()
+        for mem, recorder in zip((dense, sparse), recorders):
+            mem.register_listener(recorder)
+            mem.put(3, 9)
+            mem.get(3)
+            mem.get(40)
+        self.assertEqual([(type(e), e.addr, e.value) for e in recorders[0].events],
+                         [(type(e), e.addr, e.value) for e in recorders[1].events])
+
+
+class Registers(Device):
+    """A device that just remembers what is written to it"""
+
+    def __init__(self, size):
+        self.cells = size * [0]
+
+    def read(self, offset):
+        return self.cells[offset]
+
+    def write(self, offset, value):
+        self.cells[offset] = value
+
+
+class TestDeviceBus(unittest.TestCase):
+
+    def test_window_dispatch_by_offset(self):
+        mem = MemoryMappedIO(512)
+        device = Registers(4)
+        mem.attach(device, 500, 4)
+        mem.put(502, 17)
+        self.assertEqual(device.cells, [0, 0, 17, 0])
+        self.assertEqual(mem.get(502), 17)
+        mem.put(499, 3)
+        mem.put(504, 4)
+        self.assertEqual(device.cells, [0, 0, 17, 0])
+        self.assertEqual((mem.get(499), mem.get(504)), (3, 4))
+
+    def test_fast_path_span(self):
+        mem = SparseMemoryIO(1 << 20)
+        mem.attach(Registers(5), 490, 5)
+        mem.attach(Registers(2), 510, 2)
+        self.assertEqual((mem.io_base, mem.io_end), (490, 512))
+        mem.detach(mem.device_at(510)[0])
+        self.assertEqual((mem.io_base, mem.io_end), (490, 495))
+
+    def test_overlapping_windows_rejected(self):
+        mem = MemoryMappedIO(512)
+        mem.attach(Registers(4), 500, 4)
+        self.assertRaises(ValueError, mem.attach, Registers(2), 503, 2)
+        self.assertRaises(ValueError, mem.attach, Registers(8), 496, 8)
+
+    def test_window_beyond_capacity(self):
+        mem = MemoryMappedIO(512)
+        mem.attach(Registers(2), 1000, 2)
+        mem.put(1001, 5)
+        self.assertEqual(mem.get(1001), 5)
+        self.assertRaises(SegFault, mem.get, 999)
+
+    def test_address_hooks(self):
+        mem = MemoryMappedIO(512)
+        written = []
+        mem.map_address_in(510, lambda addr: 42)
+        mem.map_address_out(511, lambda addr, value: written.append(value))
+        mem.put(510, 8)      # No output hook: ordinary memory
+        mem.put(511, 9)
+        self.assertEqual(mem.get(510), 42)
+        self.assertEqual(mem.get(511), 0)
+        self.assertEqual(written, [9])
+
+    def test_block_transfers_reach_devices(self):
+        mem = MemoryMappedIO(512)
+        device = Registers(4)
+        mem.attach(device, 100, 4)
+        mem.load_image(list(range(10)), 98)
+        self.assertEqual(device.cells, [2, 3, 4, 5])
+        self.assertEqual(list(mem.read_block(98, 10)), list(range(10)))
+
+
+class TestBusBlockBounds(unittest.TestCase):
+
+    def test_failed_block_changes_nothing(self):
+        mem = MemoryMappedIO(512)
+        written = []
+        mem.map_address_out(511, lambda addr, value: written.append(value))
+        self.assertRaises(SegFault, mem.load_image, list(range(1, 201)), 400)
+        self.assertEqual(written, [])
+        self.assertEqual(list(mem.read_block(400, 110)), 110 * [0])
+        self.assertRaises(SegFault, mem.read_block, 400, 200)
+
+    def test_ram_only_transfers(self):
+        mem = MemoryMappedIO(512)
+        mem.attach(Registers(4), 500, 4)
+        self.assertTrue(mem.overlaps_device(490, 11))
+        self.assertFalse(mem.overlaps_device(490, 10))
+        self.assertFalse(mem.overlaps_device(504, 8))
+        self.assertRaises(SegFault, mem.load_ram_image, [1, 2, 3], 498)
+        self.assertRaises(SegFault, mem.read_ram_block, 503, 1)
+        mem.load_ram_image([1, 2, 3], 497)
+        self.assertEqual(list(mem.read_ram_block(497, 3)), [1, 2, 3])
+
+
+class TestLoadImage(unittest.TestCase):
+
+    def test_one_event_for_whole_image(self):
+        mem = Memory(32)
+        recorder = Recorder()
+        mem.register_listener(recorder)
+        mem.load_image([5, 6, 7], 10)
+        self.assertEqual([mem.get(i) for i in range(10, 13)], [5, 6, 7])
+        self.assertEqual(len([e for e in recorder.events
+                              if isinstance(e, MemoryImageLoaded)]), 1)
+
+    def test_too_big_image_changes_nothing(self):
+        mem = Memory(8)
+        self.assertRaises(SegFault, mem.load_image, list(range(1, 10)), 0)
+        self.assertEqual(list(mem.read_block(0, 8)), 8 * [0])
+
+    def test_program_skips_device_windows(self):
+        mem = MemoryMappedIO(64)
+        regs = Registers(4)
+        mem.attach(regs, 40, 4)
+        mem.load_program(list(range(1, 51)))
+        self.assertEqual(regs.cells, 4 * [0])
+        self.assertEqual(list(mem.read_ram_block(0, 40)), list(range(1, 41)))
+        self.assertEqual(list(mem.read_ram_block(44, 6)), list(range(45, 51)))
+
+
+if __name__ == "__main__":
+    unittest.main()
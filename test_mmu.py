@@ -0,0 +1,138 @@
+"""
+Tests for the MMU and TLB.
+"""
+
+from mmu import MMU, MMUControl, TLB, PageFault, PTE_VALID, PTE_WRITABLE, PTE_SHIFT
+from mmu import MMU_REGISTERS
+from memory import Memory, MemoryMappedIO
+from cpu import CPU
+from instr_format import instruction_from_string
+
+import unittest
+
+MMU_BASE = 480
+PAGE = 256
+TABLE = 1024   # Physical address of the page table (frame 4)
+
+
+def pte(frame, writable=True):
+    return (frame << PTE_SHIFT) | PTE_VALID | (PTE_WRITABLE if writable else 0)
+
+
+class TestTLB(unittest.TestCase):
+
+    def test_lru_replacement(self):
+        tlb = TLB(entries=2, ways=2)
+        tlb.insert(1, "a")
+        tlb.insert(2, "b")
+        tlb.lookup(1)
+        tlb.insert(3, "c")      # Evicts 2, least recently used
+        self.assertEqual((tlb.lookup(1), tlb.lookup(2), tlb.lookup(3)), ("a", None, "c"))
+
+    def test_fifo_replacement(self):
+        tlb = TLB(entries=2, ways=2, policy="fifo")
+        tlb.insert(1, "a")
+        tlb.insert(2, "b")
+        tlb.lookup(1)
+        tlb.insert(3, "c")      # Evicts 1, first in
+        self.assertIsNone(tlb.lookup(1))
+
+    def test_bad_geometry(self):
+        self.assertRaises(ValueError, TLB, 6, 4)
+        self.assertRaises(ValueError, TLB, 4, 4, "plru")
+
+
+class TestTranslation(unittest.TestCase):
+
+    def setUp(self):
+        self.mem = Memory(2048)
+        self.mmu = MMU(self.mem, page_size=PAGE, pages=8)
+        self.mmu.ptbr = TABLE
+
+    def test_off_is_physical(self):
+        self.assertEqual(self.mmu.get, self.mem.get)
+        self.mmu.put(700, 5)
+        self.assertEqual(self.mem.get(700), 5)
+
+    def test_pages_map_to_frames(self):
+        self.mem.put(TABLE + 2, pte(5))
+        self.mmu.enable(True)
+        self.mmu.put(2 * PAGE + 10, 42)
+        self.assertEqual(self.mem.get(5 * PAGE + 10), 42)
+        self.assertEqual(self.mmu.get(2 * PAGE + 10), 42)
+        self.assertEqual(self.mmu.stats()["page_walks"], 1)
+        self.assertEqual(self.mmu.tlb.hits, 1)
+
+    def test_faults_without_handler(self):
+        self.mem.put(TABLE + 1, pte(3, writable=False))
+        self.mmu.enable(True)
+        self.assertEqual(self.mmu.get(PAGE), 0)
+        self.assertRaises(PageFault, self.mmu.put, PAGE, 1)
+        self.assertRaises(PageFault, self.mmu.get, 0)          # Invalid entry
+        self.assertRaises(PageFault, self.mmu.get, 8 * PAGE)   # Beyond the table
+        self.assertEqual(self.mmu.faults, 3)
+
+    def test_host_callback_pages_on_demand(self):
+        def demand(mmu, addr, write):
+            page = addr // PAGE
+            self.mem.put(TABLE + page, pte(page + 1))
+            return True
+        self.mmu.on_fault = demand
+        self.mmu.enable(True)
+        self.mmu.put(3 * PAGE + 1, 9)
+        self.assertEqual(self.mem.get(4 * PAGE + 1), 9)
+        self.assertEqual(self.mmu.faults, 1)
+
+
+class TestGuestHandler(unittest.TestCase):
+
+    def test_handler_maps_page_and_retries(self):
+        mem = MemoryMappedIO(2048)
+        mmu = MMU(mem, page_size=PAGE, pages=8)
+        cpu = CPU(mmu)
+        mem.attach(MMUControl(mmu, cpu), MMU_BASE, MMU_REGISTERS)
+        program = [
+            "ADD ALWAYS r2 r0 r0 300",
+            "LOAD ALWAYS r1 r2 r2 100",     # Virtual 700, page 2: not mapped
+            "ADD ALWAYS r3 r1 r0 0",
+            "HALT ALWAYS r0 r0 r0 0"]
+        handler = [
+            "LOAD ALWAYS r7 r0 r0 484",     # Faulting address
+            "ADD ALWAYS r5 r0 r0 {}".format(pte(5)),
+            "ADD ALWAYS r6 r0 r0 385",
+            "STORE ALWAYS r5 r6 r6 0",      # Page table entry 2, via page 3
+            "STORE ALWAYS r0 r0 r0 487"]    # Retry
+        words = [instruction_from_string(line).encode() for line in program]
+        mem.load_image(words, 0)
+        mem.load_image([instruction_from_string(line).encode() for line in handler], 20)
+        # Identity map pages 0 and 1 (code, MMU registers); page 3 is the table
+        mem.load_image([pte(0), pte(1), 0, pte(4)], TABLE)
+        mem.put(5 * PAGE + 700 - 2 * PAGE, 99)
+        mmu.ptbr = TABLE
+        mmu.handler = 20
+        mmu.enable(True)
+        cpu.run()
+        self.assertEqual(cpu.registers[3].get(), 99)
+        self.assertEqual(cpu.registers[7].get(), 700)
+        self.assertEqual((cpu.trap_pc, mmu.faults), (1, 1))
+        self.assertFalse(mmu.in_handler)
+        self.assertEqual(cpu.loads, 2)   # The faulted LOAD counts once
+
+    def test_fault_in_handler_is_an_error(self):
+        mem = MemoryMappedIO(2048)
+        mmu = MMU(mem, page_size=PAGE, pages=8)
+        cpu = CPU(mmu)
+        mem.attach(MMUControl(mmu, cpu), MMU_BASE, MMU_REGISTERS)
+        mem.load_image([instruction_from_string("LOAD ALWAYS r1 r0 r0 300").encode()], 0)
+        mem.load_image([pte(0)], TABLE)
+        mmu.ptbr = TABLE
+        mmu.handler = 2 * PAGE     # Itself unmapped
+        mmu.enable(True)
+        with self.assertRaises(PageFault) as fault:
+            cpu.run()
+        self.assertEqual(fault.exception.addr, 2 * PAGE)
+        self.assertEqual(cpu.trap_pc, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
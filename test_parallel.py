@@ -0,0 +1,89 @@
+"""
+Tests for parallel assembly of one source.
+"""
+
+from assembler import Assembly, AssemblyError
+from test_assembler import PROGRAMS, looping, straight_line
+import parallel
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "big.asm")
+        # Small files are worth splitting here, to test the splitting
+        patch = mock.patch("parallel.MIN_CHUNK", 0)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, lines):
+        with open(self.path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def same_as_serial(self, lines, jobs: int = 4) -> bool:
+        """Parallel output is serial output; True if the work was
+        really shared out
+        """
+        self.write(lines)
+        out = io.StringIO()
+        count = parallel.assemble_parallel(self.path, out, jobs)
+        words = Assembly(lines).words
+        self.assertEqual(out.getvalue(), "".join("{}\n".format(word) for word in words))
+        self.assertEqual(count, len(words))
+        ranges = parallel.split(self.path, jobs)
+        return parallel._in_parallel(self.path, ranges, parallel.RESERVED) is not None
+
+    def test_split_at_line_ends(self):
+        self.write(list(looping(100)))
+        ranges = parallel.split(self.path, 7)
+        lines = []
+        for start, end in ranges:
+            lines.extend(parallel.read_lines(self.path, start, end))
+        self.assertEqual(lines, list(looping(100)))
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+
+    def test_large_program(self):
+        self.assertTrue(self.same_as_serial(list(looping(1000))))
+
+    def test_labels_named_before_the_hole(self):
+        lines = ["   ADD r1,r0,r0[1]"] * 478 + ["   JUMP over", "over:", "# here", "next:",
+                                                 "   ADD r2,r0,r0[1]"] + list(looping(200))
+        self.assertTrue(self.same_as_serial(lines, 2))
+
+    def test_shipped_programs(self):
+        for name in PROGRAMS:
+            with open("programs/{}.asm".format(name)) as f:
+                lines = f.read().splitlines()
+            self.same_as_serial(lines, 3)
+
+    def test_far_references_are_assembled_serially(self):
+        self.assertFalse(self.same_as_serial(straight_line(1200)))
+
+    def test_hole_beyond_the_first_chunk(self):
+        # Only comments in the first chunk
+        self.assertFalse(self.same_as_serial(300 * ["# nothing"] + list(looping(300)), 8))
+
+    def test_errors(self):
+        for lines in [list(looping(300)) + ["loop5: DATA 1"],
+                      list(looping(300)) + ["   JUMP nowhere"],
+                      ["   FOO r1"] + list(looping(300))]:
+            self.write(lines)
+            out = io.StringIO()
+            with self.assertRaises(AssemblyError):
+                parallel.assemble_parallel(self.path, out, 4)
+            self.assertEqual(out.getvalue(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
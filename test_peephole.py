@@ -0,0 +1,122 @@
+"""
+Tests for the peephole optimizer.
+"""
+
+from peephole import optimize, measure, run_program
+
+import unittest
+
+
+def instructions(lines):
+    return [line.split("#")[0].split(":")[-1].split() for line in lines
+            if line.split("#")[0].split(":")[-1].strip()]
+
+
+class TestRewrites(unittest.TestCase):
+
+    def test_store_then_load_is_dropped(self):
+        lines = ["   LOAD r1,x", "   ADD r1,r1,r0[1]", "   STORE r1,x", "   LOAD r1,x",
+                 "   STORE r1,r0,r0[511]", "   HALT r0,r0,r0", "x: DATA 4"]
+        optimized, report = optimize(lines)
+        self.assertEqual(report["reuse"], 1)
+        self.assertEqual(instructions(optimized),
+                         [["LOAD", "r1,x"], ["ADD", "r1,r1,r0[1]"], ["STORE", "r1,x"],
+                          ["STORE", "r1,r0,r0[511]"], ["HALT", "r0,r0,r0"], ["DATA", "4"]])
+        self.assertEqual(run_program(optimized)["output"], b"5\n")
+
+    def test_load_into_other_register_is_a_copy(self):
+        lines = ["   LOAD r1,x", "   LOAD r2,x", "   MUL r1,r1,r2", "   STORE r1,x",
+                 "   STORE r1,r0,r0[511]", "   HALT r0,r0,r0", "x: DATA 6"]
+        optimized, report = optimize(lines)
+        self.assertIn(["ADD", "r2,r1,r0"], instructions(optimized))
+        self.assertEqual(measure(lines, optimized)["memory_after"], 3)
+
+    def test_flags_tested_next_block_rewrite(self):
+        # JUMP/Z tests the flags the second LOAD sets
+        lines = ["   LOAD r1,x", "   LOAD r1,x", "   JUMP/P done", "   STORE r1,r0,r0[511]",
+                 "done: HALT r0,r0,r0", "x: DATA 6"]
+        optimized, report = optimize(lines)
+        self.assertEqual(report["reuse"], 0)
+        self.assertEqual(run_program(optimized)["output"], b"")
+
+    def test_labels_end_straight_line_code(self):
+        lines = ["   LOAD r1,x", "top: LOAD r1,x", "   SUB r1,r1,r0[1]", "   STORE r1,x",
+                 "   SUB r0,r1,r0", "   JUMP/P top", "   HALT r0,r0,r0", "x: DATA 3"]
+        optimized, report = optimize(lines)
+        self.assertEqual(report["reuse"], 0)
+
+    def test_constants(self):
+        lines = ["   LOAD r1,five", "   LOAD r2,big", "   ADD r1,r1,r2", "   STORE r1,r0,r0[511]",
+                 "   HALT r0,r0,r0", "five: DATA 5", "big: DATA 4000"]
+        optimized, report = optimize(lines)
+        self.assertEqual(report["constant"], 1)
+        self.assertEqual(report["data"], 1)
+        self.assertEqual(instructions(optimized)[0], ["ADD", "r1,r0,r0[5]"])
+        self.assertNotIn("five: DATA 5", optimized)
+        self.assertEqual(run_program(optimized)["output"], b"4005\n")
+
+    def test_stored_data_is_not_a_constant(self):
+        lines = ["   LOAD r1,x", "   ADD r1,r1,r0[1]", "   STORE r1,x", "   HALT r0,r0,r0",
+                 "x: DATA 5"]
+        optimized, report = optimize(lines)
+        self.assertEqual(report["constant"], 0)
+        self.assertIn("x: DATA 5", optimized)
+
+    def test_aliases_are_one_variable(self):
+        # a and b name the same word, so storing to a changes b
+        lines = ["   LOAD r1,b", "   STORE r1,r0,r0[511]", "   ADD r2,r0,r0[7]", "   STORE r2,a",
+                 "   LOAD r1,b", "   STORE r1,r0,r0[511]", "   HALT r0,r0,r0", "a:", "b: DATA 3"]
+        self.assertEqual(run_program(lines)["output"], b"3\n7\n")
+        optimized, report = optimize(lines)
+        self.assertEqual(report["constant"], 0)
+        self.assertEqual(run_program(optimized)["output"], b"3\n7\n")
+        # Nor does a register still hold b after a STORE to a
+        lines[2:4] = ["   LOAD r2,a", "   ADD r2,r2,r0[4]", "   STORE r2,a"]
+        optimized, report = optimize(lines)
+        self.assertEqual(run_program(optimized)["output"], b"3\n7\n")
+
+    def test_merge_identical_constants(self):
+        lines = ["   LOAD r1,a", "   LOAD r2,b", "   ADD r1,r1,r2", "   STORE r1,r0,r0[511]",
+                 "   HALT r0,r0,r0", "a: DATA 1000", "b: DATA 1000"]
+        optimized, report = optimize(lines)
+        self.assertEqual(report["merge"], 1)
+        self.assertEqual(report["words_after"], 6)
+        self.assertEqual(run_program(optimized)["output"], b"2000\n")
+
+    def test_jump_to_next_and_unreachable(self):
+        lines = ["   ADD r1,r0,r0[1]", "   JUMP next", "next:", "   STORE r1,r0,r0[511]",
+                 "   HALT r0,r0,r0", "   ADD r1,r0,r0[2]", "   STORE r1,r0,r0[511]",
+                 "# The end"]
+        optimized, report = optimize(lines)
+        self.assertEqual((report["jump"], report["unreachable"]), (1, 2))
+        self.assertEqual(optimized, ["   ADD r1,r0,r0[1]", "next:", "   STORE r1,r0,r0[511]",
+                                     "   HALT r0,r0,r0", "# The end"])
+
+    def test_program_addressing_its_image_keeps_its_layout(self):
+        lines = ["   LOAD r1,x", "   LOAD r1,x", "   ADD/Z r15,r0,r15[2]", "   JUMP next",
+                 "next: HALT r0,r0,r0", "x: DATA 3"]
+        optimized, report = optimize(lines)
+        self.assertFalse(report["movable"])
+        self.assertEqual(report["words_after"], report["words_before"])
+
+    def test_running_into_data_keeps_data(self):
+        lines = ["   ADD r1,r0,r0[1]", "x: DATA 0"]
+        optimized, report = optimize(lines)
+        self.assertEqual(optimized, lines)
+
+
+class TestPrograms(unittest.TestCase):
+
+    def test_fact(self):
+        with open("programs/fact.asm") as f:
+            lines = f.readlines()
+        optimized, report = optimize(lines)
+        self.assertLess(report["words_after"], report["words_before"])
+        savings = measure(lines, optimized)
+        self.assertLess(savings["steps_after"], savings["steps_before"])
+        self.assertLess(savings["memory_after"], savings["memory_before"])
+        self.assertEqual(run_program(optimized)["output"], b"120\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
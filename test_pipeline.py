@@ -0,0 +1,97 @@
+"""
+Tests for the pipeline and branch predictor model.
+"""
+
+from pipeline import PipelineModel, StaticPredictor, TwoBitPredictor, GsharePredictor
+from pipeline import make_predictor, STAGES, BRANCH_PENALTY
+from memory import MemoryMappedIO
+from cpu import CPU
+from instr_format import instruction_from_string
+
+import unittest
+
+
+def run(lines, predictor=None):
+    mem = MemoryMappedIO(512)
+    mem.load_image([instruction_from_string(line).encode() for line in lines])
+    cpu = CPU(mem)
+    model = PipelineModel(cpu, predictor)
+    cpu.run()
+    return model
+
+
+# Count r1 down from 10; the loop branch is taken 9 times
+LOOP = ["ADD ALWAYS r1 r0 r0 10",
+        "SUB ALWAYS r1 r1 r0 1",
+        "ADD P r15 r0 r15 -1",
+        "HALT ALWAYS r0 r0 r0 0"]
+
+
+class TestHazards(unittest.TestCase):
+
+    def test_straight_line(self):
+        model = run(["ADD ALWAYS r1 r0 r0 1",
+                     "ADD ALWAYS r2 r1 r1 0",
+                     "HALT ALWAYS r0 r0 r0 0"])
+        self.assertEqual(model.instructions, 3)
+        self.assertEqual(model.cycles, STAGES - 1 + 3)
+
+    def test_load_use_stall(self):
+        model = run(["LOAD ALWAYS r1 r0 r0 100",
+                     "ADD ALWAYS r2 r1 r0 0",      # Uses r1 at once: stall
+                     "LOAD ALWAYS r3 r0 r0 100",
+                     "ADD ALWAYS r4 r0 r0 0",
+                     "ADD ALWAYS r5 r3 r0 0",      # One instruction later: no stall
+                     "HALT ALWAYS r0 r0 r0 0"])
+        self.assertEqual(model.load_stalls, 1)
+        self.assertEqual(model.by_address()[1]["load_stalls"], 1)
+
+    def test_skipped_load_does_not_stall(self):
+        model = run(["LOAD NEVER r1 r0 r0 100",
+                     "ADD ALWAYS r2 r1 r0 0",
+                     "HALT ALWAYS r0 r0 r0 0"])
+        self.assertEqual(model.load_stalls, 0)
+        self.assertEqual(model.skipped, 1)
+
+
+class TestPredictors(unittest.TestCase):
+
+    def test_static_predicts_backward_taken(self):
+        model = run(LOOP, StaticPredictor())
+        self.assertEqual((model.branches, model.taken), (10, 9))
+        self.assertEqual(model.correct, 9)
+        self.assertEqual(model.branch_cycles, BRANCH_PENALTY)
+        self.assertEqual(model.by_address()[2]["branch_cycles"], BRANCH_PENALTY)
+
+    def test_two_bit_warms_up(self):
+        model = run(LOOP, TwoBitPredictor())
+        # Weakly not taken: wrong once warming up, once at loop exit
+        self.assertEqual(model.correct, 8)
+        self.assertAlmostEqual(model.accuracy(), 0.8)
+
+    def test_gshare_learns_patterns(self):
+        predictor = GsharePredictor(entries=64, history_bits=4)
+        # Alternating outcomes defeat a plain counter but not gshare
+        for i in range(200):
+            taken = bool(i % 2)
+            predictor.predict(7, None)
+            predictor.update(7, None, taken)
+        right = 0
+        for i in range(200, 240):
+            taken = bool(i % 2)
+            right += predictor.predict(7, None) == taken
+            predictor.update(7, None, taken)
+        self.assertEqual(right, 40)
+
+    def test_unknown_predictor(self):
+        self.assertRaises(ValueError, make_predictor, "oracle")
+        self.assertIsInstance(make_predictor("gshare"), GsharePredictor)
+
+    def test_report(self):
+        report = run(LOOP, make_predictor("2bit")).report()
+        self.assertIn("CPI", report)
+        self.assertIn("accuracy 80.00%", report)
+
+
+if __name__ == "__main__":
+    unittest.main()
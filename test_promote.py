@@ -0,0 +1,111 @@
+"""
+Tests for register promotion.
+"""
+
+from promote import promote
+from peephole import optimize, measure, run_program
+from assembler_pass1 import build_table, transform_lines
+from assembler_pass2 import assemble
+from memory import MemoryMappedIO
+from devices import ConsoleIn, ConsoleOut
+from cpu import CPU
+
+import io
+import unittest
+
+
+def final_memory(lines, labels):
+    """Run a program and read the words at some labels"""
+    table = build_table(lines)
+    mem = MemoryMappedIO(512)
+    mem.attach(ConsoleIn([], eof_value=0), 510)
+    mem.attach(ConsoleOut(io.BytesIO()), 511)
+    mem.load_image(assemble(transform_lines(lines, table)))
+    CPU(mem).run()
+    return [mem.get(table[label]) for label in labels]
+
+
+# Sum 1..n, with three variables
+SUM = ["   LOAD r1,zero", "   STORE r1,total",
+       "top: LOAD r1,n", "   SUB r0,r1,r0", "   JUMP/Z done",
+       "   LOAD r1,total", "   LOAD r2,n", "   ADD r1,r1,r2", "   STORE r1,total",
+       "   LOAD r1,n", "   LOAD r2,one", "   SUB r1,r1,r2", "   STORE r1,n",
+       "   JUMP top",
+       "done: LOAD r1,total", "   STORE r1,r0,r0[511]", "   HALT r0,r0,r0",
+       "n: DATA 40", "total: DATA 0", "zero: DATA 0", "one: DATA 1"]
+
+
+class TestPromote(unittest.TestCase):
+
+    def test_loop_uses_no_memory(self):
+        promoted, report = promote(SUM)
+        self.assertEqual(set(report["registers"]), {"n", "total", "one"})
+        loop = promoted[[line.startswith("top:") for line in promoted].index(True):
+                        promoted.index("   JUMP top")]
+        self.assertFalse([line for line in loop if "LOAD" in line or "STORE" in line])
+        self.assertEqual(run_program(promoted)["output"], b"820\n")
+        savings = measure(SUM, promoted)
+        self.assertLess(savings["memory_after"] * 10, savings["memory_before"])
+
+    def test_memory_ends_the_same(self):
+        promoted, report = promote(SUM)
+        self.assertEqual(final_memory(promoted, ["n", "total"]),
+                         final_memory(SUM, ["n", "total"]))
+
+    def test_with_peephole(self):
+        optimized, _ = optimize(SUM)
+        promoted, report = promote(optimized)
+        self.assertNotIn("one", report["registers"])   # Now an immediate
+        self.assertEqual(run_program(promoted)["output"], b"820\n")
+
+    def test_busy_registers_are_not_used(self):
+        # r3..r14 hold values live across the loop
+        setup = ["   ADD r{},r0,r0[{}]".format(r, r) for r in range(3, 15)]
+        uses = ["   ADD r1,r1,r{}".format(r) for r in range(3, 15)]
+        lines = setup + SUM[:-4] + uses + ["   HALT r0,r0,r0"] + SUM[-4:]
+        lines.remove("   HALT r0,r0,r0")
+        promoted, report = promote(lines)
+        self.assertLessEqual(set(report["registers"].values()), {"r1", "r2"})
+        self.assertEqual(run_program(promoted)["output"], run_program(lines)["output"])
+
+    def test_variables_share_registers(self):
+        # Only r1 is free; big is dead before y is first written
+        busy = ["   ADD r{},r0,r0[{}]".format(r, r) for r in range(2, 15)]
+        keep = ["   STORE r{},r0,r0[511]".format(r) for r in range(2, 15)]
+        lines = busy + ["   LOAD r1,big", "   STORE r1,r0,r0[511]",
+                        "   LOAD r1,big", "   STORE r1,r0,r0[511]",
+                        "   ADD r1,r0,r0[9]", "   STORE r1,y",
+                        "   LOAD r1,y", "   STORE r1,r0,r0[511]"] + keep + \
+            ["   HALT r0,r0,r0", "big: DATA 1000", "y: DATA 0"]
+        promoted, report = promote(lines)
+        self.assertEqual(report["registers"], {"big": "r1", "y": "r1"})
+        self.assertEqual(run_program(promoted)["output"], run_program(lines)["output"])
+        self.assertEqual(final_memory(promoted, ["y"]), [9])
+
+    def test_program_addressing_its_image_is_unchanged(self):
+        lines = ["   LOAD r1,x", "   ADD r1,r1,r0[1]", "   STORE r1,x",
+                 "   ADD r15,r0,r15[-3]", "x: DATA 0"]
+        promoted, report = promote(lines)
+        self.assertFalse(report["movable"])
+        self.assertEqual(promoted, lines)
+
+    def test_flags_read_after_access(self):
+        lines = ["   LOAD r1,x", "   LOAD r1,x", "   JUMP/Z out", "   STORE r1,r0,r0[511]",
+                 "out: HALT r0,r0,r0", "x: DATA 0"]
+        promoted, report = promote(lines)
+        self.assertEqual(report["registers"], {})
+        self.assertEqual(promoted, lines)
+
+    def test_jump_to_halt_spills(self):
+        lines = ["   ADD r2,r0,r0", "top: LOAD r1,x", "   ADD r1,r1,r0[1]", "   STORE r1,x",
+                 "   LOAD r1,x", "   SUB r0,r1,r0[5]", "   JUMP/Z stop", "   JUMP top",
+                 "stop: HALT r0,r0,r0", "x: DATA 0"]
+        promoted, report = promote(lines)
+        self.assertEqual(report["registers"], {"x": "r1"})
+        index = promoted.index("stop:")
+        self.assertEqual(promoted[index + 1], "   STORE r1,x")
+        self.assertEqual(final_memory(promoted, ["x"]), [5])
+
+
+if __name__ == "__main__":
+    unittest.main()
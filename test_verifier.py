@@ -0,0 +1,116 @@
+"""
+Tests for the static verifier and the unchecked run mode.
+"""
+
+from verifier import verify_image, verify_memory
+from memory import Memory, MemoryMappedIO
+from cpu import CPU
+from instr_format import instruction_from_string
+from test_memory import Recorder
+
+import unittest
+
+
+def assemble(lines):
+    return [instruction_from_string(line).encode() if isinstance(line, str) else line
+            for line in lines]
+
+
+# Sum 10 + 9 + ... + 1 into the word at 9, printing the total
+SUM = assemble(["ADD ALWAYS r1 r0 r0 10",
+                "LOAD ALWAYS r2 r0 r0 9",
+                "ADD ALWAYS r2 r2 r1 0",
+                "STORE ALWAYS r2 r0 r0 9",
+                "SUB ALWAYS r1 r1 r0 1",
+                "ADD P r15 r0 r15 -4",
+                "STORE ALWAYS r2 r0 r0 511",
+                "HALT ALWAYS r0 r0 r0 0",
+                0,
+                0])
+
+
+class TestVerifier(unittest.TestCase):
+
+    def test_loop_verifies(self):
+        result = verify_image(SUM, 512, (510, 512))
+        self.assertTrue(result.ok, result.report())
+        self.assertEqual([addr for addr, instr in enumerate(result.instructions)
+                          if instr is not None], list(range(8)))
+
+    def test_bad_address(self):
+        words = assemble(["ADD ALWAYS r1 r0 r0 500",
+                          "LOAD ALWAYS r2 r1 r1 0",
+                          "HALT ALWAYS r0 r0 r0 0"])
+        result = verify_image(words, 512)
+        self.assertFalse(result.ok)
+        self.assertIn("LOAD at 1 may use address 1000..1000", result.reasons)
+
+    def test_store_into_code(self):
+        words = assemble(["STORE ALWAYS r0 r0 r0 2",
+                          "HALT ALWAYS r0 r0 r0 0",
+                          "HALT ALWAYS r0 r0 r0 0"])
+        result = verify_image(words, 512)
+        self.assertEqual(result.reasons, [])
+        words = assemble(["STORE ALWAYS r0 r0 r0 1",
+                          "HALT ALWAYS r0 r0 r0 0"])
+        self.assertIn("STORE at 0 may overwrite the instruction at 1",
+                      verify_image(words, 512).reasons)
+
+    def test_unknown_control_flow(self):
+        words = assemble(["LOAD ALWAYS r15 r0 r0 510",
+                          "HALT ALWAYS r0 r0 r0 0"])
+        self.assertFalse(verify_image(words, 512, (510, 512)).ok)
+        words = assemble(["ADD ALWAYS r1 r0 r0 1"])
+        self.assertIn("Control may leave the image at 1 (from 0)",
+                      verify_image(words, 512).reasons)
+
+    def test_unbounded_loop_counter(self):
+        # r1 grows without limit; the store address cannot be bounded
+        words = assemble(["ADD ALWAYS r1 r1 r0 1",
+                          "STORE ALWAYS r1 r1 r0 100",
+                          "ADD ALWAYS r15 r0 r15 -2"])
+        self.assertFalse(verify_image(words, 512).ok)
+
+
+class TestUncheckedRun(unittest.TestCase):
+
+    def run_program(self, verified_run, listener=False):
+        mem = MemoryMappedIO(512)
+        written = []
+        mem.map_address_out(511, lambda addr, value: written.append(value))
+        mem.load_image(SUM)
+        if listener:
+            mem.register_listener(Recorder())
+        cpu = CPU(mem)
+        verified = verify_memory(mem, len(SUM)) if verified_run else None
+        cpu.run(verified=verified)
+        return cpu, mem, written
+
+    def test_same_results_as_checked(self):
+        checked, checked_mem, checked_out = self.run_program(False)
+        fast, fast_mem, fast_out = self.run_program(True)
+        self.assertEqual(fast_out, [55])
+        self.assertEqual(fast_out, checked_out)
+        self.assertEqual(fast_mem.read_block(0, 512), checked_mem.read_block(0, 512))
+        self.assertEqual([r.get() for r in fast.registers], [r.get() for r in checked.registers])
+        self.assertEqual((fast.step_count, fast.loads, fast.stores, fast.skips),
+                         (checked.step_count, checked.loads, checked.stores, checked.skips))
+
+    def test_falls_back_when_not_applicable(self):
+        mem = Memory(512)
+        mem.load_image(SUM[:6] + assemble(["HALT ALWAYS r0 r0 r0 0"]))
+        cpu = CPU(mem)
+        verified = verify_memory(mem, 7)
+        self.assertEqual(cpu.fast_mode_problems(verified, 1),
+                         ["verified from 0, not 1"])
+        mem.register_listener(Recorder())
+        self.assertEqual(len(cpu.fast_mode_problems(verified)), 1)
+        mem.put(2, 0)
+        self.assertIn("memory does not hold the verified program",
+                      cpu.fast_mode_problems(verified))
+        cpu, mem, written = self.run_program(True, listener=True)
+        self.assertEqual(written, [55])
+
+
+if __name__ == "__main__":
+    unittest.main()
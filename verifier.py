@@ -0,0 +1,260 @@
+"""
+Static verifier for Duck Machine object code.
+
+Explores every path a program can take from its entry point,
+keeping for each register a range of values it may hold and for
+the condition code the set of values it may have.  If it can
+show that
+
+* every jump (write to r15) lands on a word of the image,
+* control never runs off the end of the image,
+* every LOAD and STORE address is inside memory or a device
+  window, and
+* no STORE can change a word that is executed as an instruction,
+
+the program is verified, and CPU.run(verified=...) may run it
+without bounds checks, with each instruction decoded only once.
+Otherwise the verification lists the reasons, and CPU.run falls
+back to ordinary checked execution.
+
+Ranges that keep growing around a loop are widened to infinity,
+so the analysis always finishes, at the price of giving up on
+some safe programs.
+"""
+
+from instr_format import OpCode, CondFlag, decode
+from memory import SegFault
+
+from typing import Sequence, Tuple
+
+import bisect
+import math
+import logging
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+PC = 15
+WIDEN_AFTER = 3     # Joins at one address before ranges are widened
+MAX_TARGETS = 64    # Largest range of jump targets we will follow
+MAX_REASONS = 20
+
+INF = math.inf
+TOP = (-INF, INF)
+WORD_RANGE = (-(1 << 31), (1 << 31) - 1)
+
+
+class Verification(object):
+    """The result of verify_image.  instructions[addr] is the
+    decoded instruction at each address reached, None elsewhere.
+    """
+
+    def __init__(self, words: Sequence[int], capacity: int,
+                 io_span: Tuple[int, int], entry: int) -> None:
+        self.words = list(words)
+        self.length = len(words)
+        self.capacity = capacity
+        self.io_span = io_span
+        self.entry = entry
+        self.instructions = self.length * [None]
+        self.reasons = []
+
+    @property
+    def ok(self) -> bool:
+        return not self.reasons
+
+    def fail(self, reason: str) -> None:
+        if len(self.reasons) < MAX_REASONS:
+            self.reasons.append(reason)
+
+    def report(self) -> str:
+        if self.ok:
+            return "Verified: {} instructions reachable from {}".format(
+                sum(1 for instr in self.instructions if instr is not None), self.entry)
+        return "Not verified:\n" + "\n".join("  " + reason for reason in self.reasons)
+
+
+def _add(a: tuple, b: tuple) -> tuple:
+    return (a[0] + b[0], a[1] + b[1])
+
+
+def _sub(a: tuple, b: tuple) -> tuple:
+    return (a[0] - b[1], a[1] - b[0])
+
+
+def _mul(a: tuple, b: tuple) -> tuple:
+    products = [x * y if x and y else 0 for x in a for y in b]
+    return (min(products), max(products))
+
+
+def _div(a: tuple, b: tuple) -> Tuple[tuple, bool]:
+    """Range of a // b, and whether b may be zero"""
+    zero = b[0] <= 0 <= b[1]
+    if INF in a or -INF in a or INF in b or -INF in b:
+        return TOP, zero
+    divisors = []
+    if b[0] < 0:
+        divisors += [b[0], min(b[1], -1)]
+    if b[1] > 0:
+        divisors += [max(b[0], 1), b[1]]
+    quotients = [x // d for x in a for d in divisors]
+    if zero:
+        quotients.append(0)   # The ALU's result on division by zero
+    return (min(quotients), max(quotients)), zero
+
+
+def _flags_of(result: tuple, zero_divide: bool = False) -> frozenset:
+    flags = set()
+    if result[0] < 0:
+        flags.add(CondFlag.M.value)
+    if result[0] <= 0 <= result[1]:
+        flags.add(CondFlag.Z.value)
+    if result[1] > 0:
+        flags.add(CondFlag.P.value)
+    if zero_divide or result[0] < WORD_RANGE[0] or result[1] > WORD_RANGE[1]:
+        flags.add(CondFlag.V.value)
+    return frozenset(flags)
+
+
+def _join(old: tuple, new: tuple, widen: bool) -> tuple:
+    """Join two states (registers, flags)"""
+    regs = []
+    for a, b in zip(old[0], new[0]):
+        lo, hi = min(a[0], b[0]), max(a[1], b[1])
+        if widen:
+            if lo < a[0]:
+                lo = -INF
+            if hi > a[1]:
+                hi = INF
+        regs.append((lo, hi))
+    return tuple(regs), old[1] | new[1]
+
+
+def verify_image(words: Sequence[int], capacity: int,
+                 io_span: Tuple[int, int] = (0, 0), entry: int = 0) -> Verification:
+    """Verify the program in words, loaded at address 0 of a
+    memory of capacity words with devices at io_span, run from
+    entry by a freshly created CPU.
+    """
+    result = Verification(words, capacity, io_span, entry)
+    length = len(words)
+    io_base, io_end = io_span
+
+    def in_bounds(addr: tuple) -> bool:
+        lo, hi = addr
+        return (0 <= lo and hi < capacity) or (io_base <= lo and hi < io_end)
+
+    if not 0 <= entry < length:
+        result.fail("Entry point {} is outside the image".format(entry))
+        return result
+    states = {entry: (16 * ((0, 0),), frozenset([CondFlag.ALWAYS.value]))}
+    joins = {}
+    stores = {}   # pc -> range of addresses it may store to
+    decoded = result.instructions
+    work = [entry]
+    queued = {entry}
+
+    def flow(target: int, state: tuple, pc: int) -> None:
+        if not 0 <= target < length:
+            result.fail("Control may leave the image at {} (from {})".format(target, pc))
+            return
+        if io_base <= target < io_end:
+            result.fail("Control may reach device address {} (from {})".format(target, pc))
+            return
+        old = states.get(target)
+        if old is None:
+            new = state
+        else:
+            joins[target] = joins.get(target, 0) + 1
+            new = _join(old, state, joins[target] > WIDEN_AFTER)
+            if new == old:
+                return
+        states[target] = new
+        if target not in queued:
+            queued.add(target)
+            work.append(target)
+
+    while work:
+        pc = work.pop()
+        queued.discard(pc)
+        regs, flags = states[pc]
+        instr = decoded[pc]
+        if instr is None:
+            instr = decode(words[pc])
+            decoded[pc] = instr
+        cond = instr.cond.value
+        if any(not f & cond for f in flags):
+            # Skipped: nothing changes
+            flow(pc + 1, (regs, flags), pc)
+        if not any(f & cond for f in flags):
+            continue
+        op = instr.op
+        val1 = (pc, pc) if instr.reg_src1 == PC else regs[instr.reg_src1]
+        val2 = (pc, pc) if instr.reg_src2 == PC else regs[instr.reg_src2]
+        val2 = _add(val2, (instr.offset, instr.offset))
+        zero_divide = False
+        if op is OpCode.SUB:
+            value = _sub(val1, val2)
+        elif op is OpCode.MUL:
+            value = _mul(val1, val2)
+        elif op is OpCode.DIV:
+            value, zero_divide = _div(val1, val2)
+        else:
+            value = _add(val1, val2)
+        new_flags = _flags_of(value, zero_divide)
+        if value[0] < WORD_RANGE[0] or value[1] > WORD_RANGE[1]:
+            # The ALU may wrap: any value, any sign
+            value = TOP
+            new_flags = _flags_of(TOP, zero_divide)
+        if op is OpCode.HALT:
+            continue
+        target = instr.reg_target
+        if op is OpCode.LOAD or op is OpCode.STORE:
+            if not in_bounds(value):
+                result.fail("{} at {} may use address {}..{}".format(
+                    op.name, pc, value[0], value[1]))
+                continue
+            if op is OpCode.STORE:
+                lo, hi = stores.get(pc, value)
+                stores[pc] = (min(lo, value[0]), max(hi, value[1]))
+                target = 0
+            else:
+                value = TOP
+        if target == PC:
+            if op is OpCode.LOAD:
+                result.fail("Jump at {} loads its target from memory".format(pc))
+                continue
+            lo, hi = value
+            if hi - lo >= MAX_TARGETS:
+                result.fail("Jump at {} has unknown target {}..{}".format(pc, lo, hi))
+                continue
+            for dest in range(int(lo), int(hi) + 1):
+                flow(dest, (regs, new_flags), pc)
+            continue
+        if target != 0:
+            regs = regs[:target] + (value,) + regs[target + 1:]
+        flow(pc + 1, (regs, new_flags), pc)
+
+    # Stores may not touch any word executed as an instruction
+    code = [addr for addr in range(length) if decoded[addr] is not None]
+    for pc, (lo, hi) in sorted(stores.items()):
+        i = bisect.bisect_left(code, lo)
+        if i < len(code) and code[i] <= hi:
+            result.fail("STORE at {} may overwrite the instruction at {}".format(pc, code[i]))
+    return result
+
+
+def verify_memory(memory, length: int, entry: int = 0) -> Verification:
+    """Verify the first length words of a memory, e.g. after loading
+    an object file of that many words
+    """
+    io_span = (getattr(memory, "io_base", 0), getattr(memory, "io_end", 0))
+    read = getattr(memory, "read_ram_block", memory.read_block)
+    try:
+        words = read(0, length)
+    except SegFault as e:
+        result = Verification([], memory.capacity, io_span, entry)
+        result.fail("Cannot read the program: {}".format(e))
+        return result
+    return verify_image(words, memory.capacity, io_span, entry)
@@ -4,7 +4,7 @@ Graphical display of the duck machine state.
 
 from mvc import MVCEvent
 from cpu import CPU, CPUStep
-from memory import MemoryEvent, MemoryRead, MemoryWrite
+from memory import MemoryEvent, MemoryRead, MemoryWrite, MemoryImageLoaded
 
 import graphics.graphics
 from graphics.graphics import Rectangle, Point, Text
@@ -133,6 +133,8 @@ class MachineStateView(object):
         """Something to depict"""
         if isinstance(event, CPUStep):
             self._cpu_step(event)
+        elif isinstance(event, MemoryImageLoaded):
+            self._memory_image(event)
         elif isinstance(event, MemoryEvent):
             self._memory_event(event)
 
@@ -159,3 +161,11 @@ class MachineStateView(object):
         elif isinstance(event, MemoryWrite):
             cell_display.setFill("#DDDDFF")
         cell_display.label.setText(str(value))
+
+    def _memory_image(self, event: MemoryImageLoaded):
+        """A block of memory was loaded; show the visible part"""
+        last = min(event.addr + len(event.words), len(self.mem_cells))
+        for address in range(max(event.addr, 0), last):
+            cell_display = self.mem_cells[address]
+            cell_display.setFill("#DDDDFF")
+            cell_display.label.setText(str(event.words[address - event.addr]))